@@ -0,0 +1,220 @@
+import asyncio
+import time
+
+import aiohttp
+
+from indextoolmanager import IndexToolManager
+
+
+class AsyncIndexToolManager(IndexToolManager):
+    '''
+    A query only IndexToolManager that sends the Elasticsearch and ArangoDB
+    queries over aiohttp, keeping up to max_in_flight requests in flight on a
+    pool of keep-alive connections.
+    The queries are I/O bound, so a single process with many requests in flight
+    replaces the pool of forked query workers.
+
+    Attributes
+    ----------
+    max_in_flight : int
+        Maximum number of concurrent requests (and open connections)
+
+    elastic_url : str
+        Base URL of the Elasticsearch REST API
+
+    arango_url : str
+        Base URL of the ArangoDB HTTP API
+
+    Methods
+    -------
+    get_IR_variables_concurrent(texts, tool, positive_class, ignore_first_result)
+        Query all the texts concurrently, returns the IR variables and the time of each query.
+
+    '''
+
+    def __init__(self, indexName='default_index',
+                 bm25_b=0.75, bm25_k1=1.2, bm25_k3=0.0, top_k=100,
+                 max_in_flight=64, ir_cache_path=None, ir_cache_size=10000,
+                 elastic_url='http://localhost:9200',
+                 arango_url='http://localhost:8529',
+                 compact_queries=False, query_max_terms=None, drop_stopwords=True):
+        super().__init__(indexName=indexName, bm25_b=bm25_b, bm25_k1=bm25_k1,
+                         bm25_k3=bm25_k3, top_k=top_k, query_only=True,
+                         ir_cache_path=ir_cache_path, ir_cache_size=ir_cache_size,
+                         compact_queries=compact_queries, query_max_terms=query_max_terms,
+                         drop_stopwords=drop_stopwords)
+        self.max_in_flight = int(max_in_flight)
+        self.elastic_url = str(elastic_url).rstrip('/')
+        self.arango_url = str(arango_url).rstrip('/')
+        # The session and the semaphore belong to this loop, which is reused
+        # by every call so the connections are kept alive between them
+        self.loop = asyncio.new_event_loop()
+        self.session = None
+        self.semaphore = None
+
+    async def async_open(self):
+        '''
+        Creates the aiohttp session, must run inside the manager loop.
+        '''
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.max_in_flight,
+                                             keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector)
+            self.semaphore = asyncio.Semaphore(self.max_in_flight)
+
+    async def async_close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+            self.semaphore = None
+
+    def close(self):
+        '''
+        Closes the connections and the event loop of the manager.
+        '''
+        if not self.loop.is_closed():
+            self.loop.run_until_complete(self.async_close())
+            self.loop.close()
+
+    async def post_json(self, url, body):
+        '''
+        Sends a JSON POST request respecting the in-flight limit, returns the decoded response.
+        '''
+        async with self.semaphore:
+            async with self.session.post(url, json=body) as response:
+                result = await response.json(content_type=None)
+                if response.status >= 400:
+                    raise RuntimeError(f'Request to {url} failed ({response.status}): {result}')
+                return result
+
+    async def elastic_query_async(self, query, ignore_first_result=False, as_arrays=False,
+                                  exclude_ids=None):
+        '''
+        Asynchronous elastic_query, returns a Pandas DataFrame (or a QueryResult) with the results.
+
+        Parameters
+        ----------
+        query : str
+            Text to be queried to the index using BM25 similarity
+            implemented by Elasticsearch.
+
+        as_arrays : bool
+            Return a QueryResult instead of a Pandas DataFrame.
+
+        exclude_ids : list
+            Ids of the documents filtered out of the results (e.g. the queried document).
+        '''
+        nResults = int(self.numberResults)
+        if ignore_first_result:
+            nResults += 1
+        result = await self.post_json(f'{self.elastic_url}/{self.indexName}/_search',
+                                      {"query": self.elastic_query_body(
+                                          query, self.exclusion_keys(exclude_ids)),
+                                       "size": nResults})
+        hit_list = [[hit['_score'], hit['_id'], hit['_source']['class']]
+                    for hit in result['hits']['hits']]
+        if ignore_first_result and (len(hit_list) > 0):
+            hit_list.pop(0)
+        return self.make_result(hit_list, as_arrays)
+
+    async def arango_query_async(self, query, ignore_first_result=False, as_arrays=False,
+                                 exclude_ids=None):
+        '''
+        Asynchronous arango_query, returns a Pandas DataFrame (or a QueryResult) with the results.
+        The query text is sent as a bind variable, so it does not need escaping.
+
+        Parameters
+        ----------
+        query : str
+            Text to be queried to the view using BM25 analyzer.
+
+        as_arrays : bool
+            Return a QueryResult instead of a Pandas DataFrame.
+
+        exclude_ids : list
+            Keys of the documents filtered out of the results (e.g. the queried document).
+        '''
+        nResults = int(self.numberResults)
+        if ignore_first_result:
+            nResults += 1
+        result = await self.post_json(f'{self.arango_url}/_db/{self.indexName}/_api/cursor',
+                                      {'query': self.arango_aql('query'),
+                                       'bindVars': self.arango_bind_vars(
+                                           text=str(self.compact_query(query)),
+                                           exclude_ids=self.exclusion_keys(exclude_ids),
+                                           limit=nResults),
+                                       'batchSize': nResults,
+                                       'options': {'optimizer': {'rules': ['+all']}}})
+        item_list = [[hit['score'], hit['id'], hit['class']] for hit in result['result']]
+        if ignore_first_result and (len(item_list) > 0):
+            item_list.pop(0)
+        return self.make_result(item_list, as_arrays)
+
+    async def query_async(self, query, tool='elastic', ignore_first_result=False,
+                          exclude_ids=None):
+        '''
+        Runs one query with the IR results cache, returns a QueryResult
+        and the time spent on it.
+        '''
+        initial = time.time()
+        key = None
+        result = None
+        if self.irCache is not None:
+            key = self.cache_key(tool, query, ignore_first_result, exclude_ids)
+            result = self.cache_get(key, as_arrays=True)
+        if result is None:
+            if (tool == 'elastic'):
+                result = await self.elastic_query_async(
+                    query, ignore_first_result=ignore_first_result, as_arrays=True,
+                    exclude_ids=exclude_ids)
+            elif (tool == 'arango'):
+                result = await self.arango_query_async(
+                    query, ignore_first_result=ignore_first_result, as_arrays=True,
+                    exclude_ids=exclude_ids)
+            else:
+                raise ValueError(f'Unknown asynchronous tool: {tool}')
+            if key is not None:
+                self.cache_put(key, result)
+        return result, float(time.time() - initial)
+
+    async def get_IR_variables_async(self, texts, tool='elastic', positive_class='true',
+                                     ignore_first_result=False, class_names=None,
+                                     exclude_ids=None):
+        '''
+        Query all the texts concurrently, returns a NumPy array with the IR variables
+        of each text (see get_IR_variables_batch) and the list of query times.
+
+        Parameters
+        ----------
+        texts : list
+            Texts to be queried using BM25.
+
+        tool : str
+            Tool used to run the queries { arango | elastic }.
+
+        positive_class : str
+            Specifies which 'class' is the positive class.
+
+        class_names : list
+            Classes used for the per class IR variables, e.g. ['bot', 'female', 'male'].
+
+        exclude_ids : list
+            Ids of the documents filtered out of the results of each text.
+        '''
+        await self.async_open()
+        exclude_ids = self.batch_exclusion_keys(texts, exclude_ids)
+        responses = await asyncio.gather(*[self.query_async(text, tool, ignore_first_result,
+                                                            exclude)
+                                           for text, exclude in zip(texts, exclude_ids)])
+        results = [result for result, _ in responses]
+        time_query_list = [time_query for _, time_query in responses]
+        return self.calc_IR_results(results, positive_class, class_names), time_query_list
+
+    def get_IR_variables_concurrent(self, texts, tool='elastic', positive_class='true',
+                                    ignore_first_result=False, class_names=None,
+                                    exclude_ids=None):
+        '''
+        Synchronous entry point of get_IR_variables_async, runs it in the manager loop.
+        '''
+        return self.loop.run_until_complete(self.get_IR_variables_async(
+            list(texts), tool, positive_class, ignore_first_result, class_names, exclude_ids))
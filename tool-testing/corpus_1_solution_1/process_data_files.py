@@ -33,7 +33,7 @@ currentdir = os.path.dirname(os.path.abspath(
 parentdir = os.path.dirname(currentdir)
 # sys.path.insert(0, parentdir)
 sys.path.insert(0, '/home/ruan/Documentos/git/tcc-ii-ir-features-text-mining/tool-testing/')
-from indextoolmanager import IndexToolManager
+from indextoolmanager import IndexToolManager, IR_VARIABLE_NAMES
 
 
 variable_name = 'TRAIN_CLF'
@@ -90,55 +90,151 @@ global_exp_dict = {}
 
 from multiprocessing import Pool, current_process
 
+# Pool of query workers, created once per *load_pan_data* call and reused for every author
+query_pool = None
+# IndexToolManager of each worker process, built once by *init_query_worker*
+worker_tool = None
+# AsyncIndexToolManager used instead of the pool when exp_dict['ir_async'] is set
+async_tool = None
 
-def get_ir_variable(text):
+
+def init_query_worker(exp_dict):
+    """Pool initializer: builds the query-only IndexToolManager used by this worker process."""
     global global_exp_dict
+    global worker_tool
+    global_exp_dict = exp_dict
+    worker_tool = IndexToolManager(
+        indexName=str(authorprof_db_name), top_k=global_exp_dict['ir_top_k'],
+        query_only=True, ir_cache_path=global_exp_dict.get('ir_cache_path'),
+        local_pruning=global_exp_dict.get('ir_local_pruning', False),
+        local_max_terms=global_exp_dict.get('ir_local_max_terms'),
+        local_term_mass=global_exp_dict.get('ir_local_term_mass', 1.0),
+        compact_queries=global_exp_dict.get('ir_compact_queries', False),
+        query_max_terms=global_exp_dict.get('ir_query_max_terms'),
+        drop_stopwords=global_exp_dict.get('ir_drop_stopwords', True))
+
+
+def parse_author_xml(xml_path):
+    """Parse the XML file of an author and return the list of its tweets (None for non-XML files).
+
+    It is a module function so it can run in the worker processes of the parsing pool.
+    """
+    if not fnmatch.fnmatch(xml_path, '*.xml'):
+        return None
+    # Parser is explicitly defined to ensure UTF-8 encoding.
+    tree = ElementTree.parse(xml_path, parser=ElementTree.XMLParser(encoding="utf-8"))
+    root = tree.getroot()
+    return [child.text for child in root[0]]
+
+
+def get_ir_variable(text, doc_id=None):
+    global global_exp_dict
+    global worker_tool
     ir_variables = {}
     time_query = 0.0
-    testToolI = IndexToolManager(
-        indexName=str(authorprof_db_name), top_k=global_exp_dict['ir_top_k'])
+    if worker_tool is None:
+        init_query_worker(global_exp_dict)
+    testToolI = worker_tool
     initial = None
     final = None
     if (global_exp_dict['tool'] == 'arango'):
         initial = time.time()
         ir_variables = testToolI.arango_get_IR_variables(
-            text, 'male', ignore_first_result=global_exp_dict['ignore_first_result'])
+            text, 'male', ignore_first_result=global_exp_dict['ignore_first_result'],
+            exclude_ids=doc_id)
         final = time.time()
     elif (global_exp_dict['tool'] == 'elastic'):
         initial = time.time()
         ir_variables = testToolI.elastic_get_IR_variables(
-            text, 'male', ignore_first_result=global_exp_dict['ignore_first_result']) 
+            text, 'male', ignore_first_result=global_exp_dict['ignore_first_result'],
+            exclude_ids=doc_id)
         final = time.time()
     elif (global_exp_dict['tool'] == 'zettair'):
         initial = time.time()
         ir_variables = testToolI.zettair_get_IR_variables(
-            text, 'male', ignore_first_result=global_exp_dict['ignore_first_result'])
+            text, 'male', ignore_first_result=global_exp_dict['ignore_first_result'],
+            exclude_ids=doc_id)
+        final = time.time()
+    elif (global_exp_dict['tool'] == 'local'):
+        initial = time.time()
+        ir_variables = testToolI.local_get_IR_variables(
+            text, 'male', ignore_first_result=global_exp_dict['ignore_first_result'],
+            exclude_ids=doc_id)
         final = time.time()
     # print(ir_variables)
     time_query = float(final-initial)
     return ir_variables, time_query
 
 
-def get_ir_variables(text_list):
+def get_ir_variables(text_list, id_list=None):
     ir_variables_of_this_author = []
     time_query_list = []
     global global_exp_dict
+    global query_pool
+    # Ids of the indexed tweets, each one is excluded from the results of its own query
+    if id_list is None:
+        id_list = [None] * len(text_list)
 
-    if (global_exp_dict['tool'] == 'zettair'):
-        for text in text_list:
+    if (global_exp_dict.get('ir_neighbour_table', False) and None not in id_list):
+        # The tweets are indexed, their neighbours were precomputed by neighbour-table.py
+        initial = time.time()
+        ir_array = testTool.neighbours_get_IR_variables(
+            id_list, 'male', top_k=global_exp_dict['ir_top_k'])
+        final = time.time()
+        ir_variables_of_this_author = pd.DataFrame(ir_array, columns=IR_VARIABLE_NAMES)
+        time_query_list = [float(final-initial) / len(text_list)] * len(text_list)
+    elif (async_tool is not None):
+        # All the tweets of the author are queried concurrently by the asyncio client
+        ir_array, time_query_list = async_tool.get_IR_variables_concurrent(
+            text_list, global_exp_dict['tool'], 'male',
+            ignore_first_result=global_exp_dict['ignore_first_result'], exclude_ids=id_list)
+        ir_variables_of_this_author = pd.DataFrame(ir_array, columns=IR_VARIABLE_NAMES)
+    elif (global_exp_dict.get('ir_batch_queries', False)):
+        # All the tweets of the author are sent together, the query time is split evenly among them
+        initial = time.time()
+        ir_array = testTool.get_IR_variables_batch(
+            text_list, global_exp_dict['tool'], 'male',
+            ignore_first_result=global_exp_dict['ignore_first_result'], exclude_ids=id_list)
+        final = time.time()
+        ir_variables_of_this_author = pd.DataFrame(ir_array, columns=IR_VARIABLE_NAMES)
+        time_query_list = [float(final-initial) / len(text_list)] * len(text_list)
+    elif (global_exp_dict['tool'] == 'zettair' and global_exp_dict.get('zettair_workers', 0) > 0):
+        # The tweets of the author are spread among the zet processes of the worker pool
+        initial = time.time()
+        ir_array = testTool.get_IR_variables_batch(
+            text_list, 'zettair', 'male',
+            ignore_first_result=global_exp_dict['ignore_first_result'], exclude_ids=id_list)
+        final = time.time()
+        ir_variables_of_this_author = pd.DataFrame(ir_array, columns=IR_VARIABLE_NAMES)
+        time_query_list = [float(final-initial) / len(text_list)] * len(text_list)
+    elif (global_exp_dict['tool'] == 'zettair'):
+        for text, doc_id in zip(text_list, id_list):
             initial = time.time()
             ir_variables = testTool.zettair_get_IR_variables(
-                text, 'male', ignore_first_result=global_exp_dict['ignore_first_result'])
+                text, 'male', ignore_first_result=global_exp_dict['ignore_first_result'],
+                exclude_ids=doc_id)
             final = time.time()
             time_query_list.append(float(final-initial))
             ir_variables_of_this_author.append(ir_variables)
-    # Run this with a pool of 5 agents having a chunksize of 3 until finished
+    elif (global_exp_dict['tool'] == 'local'):
+        # The local index lives in this process, there is no I/O to overlap
+        for text, doc_id in zip(text_list, id_list):
+            initial = time.time()
+            ir_variables = testTool.local_get_IR_variables(
+                text, 'male', ignore_first_result=global_exp_dict['ignore_first_result'],
+                exclude_ids=doc_id)
+            final = time.time()
+            time_query_list.append(float(final-initial))
+            ir_variables_of_this_author.append(ir_variables)
+    # Run this with a pool of 6 agents having a chunksize of 4 until finished
     else:
         agents = 6
         chunksize = 4
-        with Pool(processes=agents) as pool:
-            ir_variables_of_this_author, time_query_list = \
-                zip(*pool.map(get_ir_variable, text_list, chunksize))
+        if query_pool is None:
+            query_pool = Pool(processes=agents, initializer=init_query_worker,
+                              initargs=(global_exp_dict,))
+        ir_variables_of_this_author, time_query_list = \
+            zip(*query_pool.starmap(get_ir_variable, zip(text_list, id_list), chunksize))
 
     return ir_variables_of_this_author, time_query_list
 
@@ -186,13 +282,39 @@ def load_pan_data(xmls_directory, truth_path,
     '''
     global global_exp_dict
     global testTool
+    global query_pool
+    global async_tool
     global_exp_dict = exp_dict.copy()
     testTool = IndexToolManager(
-        indexName=str(authorprof_db_name), top_k=global_exp_dict['ir_top_k'])
+        indexName=str(authorprof_db_name), top_k=global_exp_dict['ir_top_k'],
+        ir_cache_path=global_exp_dict.get('ir_cache_path'),
+        zettair_workers=global_exp_dict.get('zettair_workers', 0),
+        local_pruning=global_exp_dict.get('ir_local_pruning', False),
+        local_max_terms=global_exp_dict.get('ir_local_max_terms'),
+        local_term_mass=global_exp_dict.get('ir_local_term_mass', 1.0),
+        compact_queries=global_exp_dict.get('ir_compact_queries', False),
+        query_max_terms=global_exp_dict.get('ir_query_max_terms'),
+        drop_stopwords=global_exp_dict.get('ir_drop_stopwords', True))
+    if (global_exp_dict.get('ir_async', False) and global_exp_dict['tool'] in ['arango', 'elastic']):
+        # aiohttp is only needed when the asyncio client is enabled
+        from asyncindextoolmanager import AsyncIndexToolManager
+        async_tool = AsyncIndexToolManager(
+            indexName=str(authorprof_db_name), top_k=global_exp_dict['ir_top_k'],
+            max_in_flight=global_exp_dict.get('ir_max_in_flight', 64),
+            ir_cache_path=global_exp_dict.get('ir_cache_path'),
+            compact_queries=global_exp_dict.get('ir_compact_queries', False),
+            query_max_terms=global_exp_dict.get('ir_query_max_terms'),
+            drop_stopwords=global_exp_dict.get('ir_drop_stopwords', True))
     xml_filenames = sorted(os.listdir(xmls_directory))
 
     if exec_type == 'testing':
         global_exp_dict['ignore_first_result'] = False
+    # The training tweets are in the index, each one is excluded from its own results by id
+    exclude_self = (exec_type == 'training' and global_exp_dict.get('ir_exclude_self', False))
+    if exclude_self:
+        global_exp_dict['ignore_first_result'] = False
+    # Author mode aggregates the IR variables of all the tweets of an author in one call
+    author_mode = global_exp_dict.get('ir_author_mode', False)
     # Store the Author IDs in a list
     # The Author IDs list will have the same order as the XML filenames list.
     author_ids = []  # Create an empty list
@@ -225,8 +347,18 @@ def load_pan_data(xmls_directory, truth_path,
     time_query_list = []
     time_query = 0.0
 
+    # The XML files are parsed by a pool of processes, *imap* returns them in the order of *xml_filenames*
+    parse_processes = global_exp_dict.get('xml_parse_processes', 1)
+    xml_paths = [os.path.join(xmls_directory, xml_filename) for xml_filename in xml_filenames]
+    parse_pool = None
+    if parse_processes != 1:
+        parse_pool = Pool(processes=parse_processes)
+        parsed_authors = parse_pool.imap(parse_author_xml, xml_paths, 16)
+    else:
+        parsed_authors = map(parse_author_xml, xml_paths)
+
     # Iterate over XML files
-    for author_index, xml_filename in enumerate(xml_filenames):
+    for (author_index, xml_filename), author_tweets in zip(enumerate(xml_filenames), parsed_authors):
         # Make sure only XML files go through
         if not fnmatch.fnmatch(xml_filename, '*.xml'):
             logger.error("Encountered a non-XML file inside the directory: %s >>> The program will now exit.",
@@ -235,11 +367,7 @@ def load_pan_data(xmls_directory, truth_path,
                 'Encountered a non-XML file inside the directory: %s' % xml_filename)
             # ↳ This is printf-style String Formatting.
 
-        # Read the XML file and parse it into a tree
-        # Parser is explicitly defined to ensure UTF-8 encoding.
-        tree = ElementTree.parse(os.path.join(xmls_directory, xml_filename),
-                                 parser=ElementTree.XMLParser(encoding="utf-8"))
-        root = tree.getroot()
+        # The XML file was read and parsed into a tree by *parse_author_xml*
         '''
         root is the root element of the parsed tree
         root[0], ..., root[m-1] are the children of root—elements one level below the root.
@@ -268,10 +396,9 @@ def load_pan_data(xmls_directory, truth_path,
         logger.info(f'{datetime.datetime.now().strftime("%Y%m%d-%H%M%S")} Author: {author_id}')
         # Iterate over the tweets within this parsed XML file:
         # Record the tweet length, replace line feeds, and append the tweet to a list
-        for child in root[0]:
+        for tweet in author_tweets:
             # Element.text accesses the element's text content,
             # which is saved with the following format in the XML files: <![CDATA[some text]]>
-            tweet = child.text
             text = tweet
             original_tweet_lengths[author_index].append(len(tweet))
 
@@ -311,8 +438,27 @@ def load_pan_data(xmls_directory, truth_path,
             #     time_query_list.append(float(final-initial))
 
             # ir_variables_of_this_author.append(ir_variables)
-        if (global_exp_dict['add_ir_variables']):
-            ir_variables_of_this_author, tq_list = get_ir_variables(text_list)
+        ir_vars_dict = []
+        id_list = None
+        if exclude_self:
+            # Same ids given to the tweets by parse_author_documents of indextoolmanager
+            id_list = [f'{author_id}-{number}' for number in range(1, len(text_list) + 1)]
+        if (global_exp_dict['add_ir_variables'] and author_mode):
+            # The aggregated IR variables of the author are computed from all its tweets at once,
+            # the query time is split evenly among them
+            initial = time.time()
+            if (global_exp_dict.get('ir_neighbour_table', False) and id_list is not None):
+                ir_vars_dict = testTool.calc_IR_aggregate(testTool.neighbours_get_IR_variables(
+                    id_list, 'male', top_k=global_exp_dict['ir_top_k'])).tolist()
+            else:
+                ir_vars_dict = testTool.get_IR_variables_author(
+                    text_list, global_exp_dict['tool'], 'male',
+                    ignore_first_result=global_exp_dict['ignore_first_result'],
+                    exclude_ids=id_list).tolist()
+            final = time.time()
+            time_query_list.extend([float(final-initial) / len(text_list)] * len(text_list))
+        elif (global_exp_dict['add_ir_variables']):
+            ir_variables_of_this_author, tq_list = get_ir_variables(text_list, id_list)
             # ir_variables_of_this_author = [{
             #     'CLASS_0_BM25_AVG': 0,
             #     'CLASS_0_BM25_COUNT': 0,
@@ -323,8 +469,7 @@ def load_pan_data(xmls_directory, truth_path,
             # }]
             time_query_list.extend(tq_list)
             # doc_id += 1
-        ir_vars_dict = []
-        if (global_exp_dict['add_ir_variables']):
+        if (global_exp_dict['add_ir_variables'] and not author_mode):
             ir_vars = pd.DataFrame(ir_variables_of_this_author)
             ir_vars_mean = ir_vars.mean()
             ir_vars_sum = ir_vars.sum()
@@ -365,6 +510,18 @@ def load_pan_data(xmls_directory, truth_path,
         # print('\n\nir_vars_dict')
         # print(ir_vars_dict)
 
+    if parse_pool is not None:
+        parse_pool.close()
+        parse_pool.join()
+    if query_pool is not None:
+        query_pool.close()
+        query_pool.join()
+        query_pool = None
+    if async_tool is not None:
+        async_tool.close()
+        async_tool = None
+    testTool.zettair_close_pools()
+
     logger.info("@ %.2f seconds: Finished loading the dataset",
                 time.process_time())
 
@@ -111,10 +111,41 @@ add_ir_variables = True
 perform_dimentionality_reduction = False
 ir_variables_before_dim_reduction = True
 ignore_first_result = True
+# Training tweets exclude their own document from the results by id,
+# instead of dropping the first result (ignore_first_result is then not used)
+ir_exclude_self = True
 use_scaler = True
 use_scaler_only_ir = True
 use_only_ir_variables = True
 use_dumped_features = True
+ir_batch_queries = False
+# Author mode: all the tweets of an author are queried at once and the IR variables
+# are aggregated directly (the local tool scores them in one pass)
+ir_author_mode = False
+# Read the IR variables of the training tweets from the neighbour table built by
+# neighbour-table.py (top_k neighbours of every indexed tweet), without running queries
+ir_neighbour_table = False
+# Local tool: MaxScore pruning of the exact top k, and the approximate mode that only queries
+# the ir_local_max_terms terms (None: all) / ir_local_term_mass of the score bound (1.0: all)
+ir_local_pruning = False
+ir_local_max_terms = None
+ir_local_term_mass = 1.0
+# Send the tools the compact queries: each term once (weighted by bm25_k3), without stopwords,
+# and only the ir_query_max_terms terms with the largest IDF (None: all, needs the local index)
+ir_compact_queries = False
+ir_query_max_terms = None
+ir_drop_stopwords = True
+# SQLite file used to cache the raw query results, e.g. ROOT_PATH + 'ir_cache.sqlite' (None disables it)
+ir_cache_path = None
+# Query arango/elastic from one process over aiohttp, with up to ir_max_in_flight requests in flight
+ir_async = False
+ir_max_in_flight = 64
+# Number of interactive zet processes queried in parallel (0 keeps a single serial process,
+# so TIME_QUERY stays comparable with the previous runs; e.g. 6 to use the pool)
+zettair_workers = 0
+# Processes parsing the author XML files in load_pan_data (1 parses them in the main process,
+# e.g. 4 to parse them in a pool)
+xml_parse_processes = 1
 exp_id = str(datetime.datetime.now())
 tool = 'zettair'
 ir_top_k = 100
@@ -132,6 +163,21 @@ exp_dict = {
     'test_data_folder': TEST_DATA_ROOT_FOLDER,
     'ir_top_k': ir_top_k,
     'ignore_first_result': ignore_first_result,
+    'ir_exclude_self': ir_exclude_self,
+    'ir_batch_queries': ir_batch_queries,
+    'ir_author_mode': ir_author_mode,
+    'ir_neighbour_table': ir_neighbour_table,
+    'ir_local_pruning': ir_local_pruning,
+    'ir_local_max_terms': ir_local_max_terms,
+    'ir_local_term_mass': ir_local_term_mass,
+    'ir_compact_queries': ir_compact_queries,
+    'ir_query_max_terms': ir_query_max_terms,
+    'ir_drop_stopwords': ir_drop_stopwords,
+    'ir_cache_path': ir_cache_path,
+    'ir_async': ir_async,
+    'ir_max_in_flight': ir_max_in_flight,
+    'zettair_workers': zettair_workers,
+    'xml_parse_processes': xml_parse_processes,
     'random_seed': random_seed,
     'classifier': '',
     'perform_dimentionality_reduction': perform_dimentionality_reduction,
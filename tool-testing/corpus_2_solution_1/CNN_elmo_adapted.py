@@ -31,8 +31,6 @@ import logging
 import pandas as pd
 import inspect
 import sys
-import ast
-from keras.preprocessing import sequence
 from sklearn.preprocessing import LabelEncoder
 from sklearn.model_selection import train_test_split
 from sklearn.model_selection import StratifiedKFold
@@ -46,7 +44,9 @@ currentdir = os.path.dirname(os.path.abspath(
     inspect.getfile(inspect.currentframe())))
 parentdir = os.path.dirname(currentdir)
 sys.path.insert(0, parentdir)
-from indextoolmanager import IndexToolManager
+from indextoolmanager import IndexToolManager, IR_VARIABLE_NAMES
+sys.path.insert(0, os.path.join(currentdir, 'Preprocessing'))
+from elmostore import ElmoSequence, open_store
 
 variable_name = 'TRAIN_CLF'
 datestr = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
@@ -83,10 +83,33 @@ mylogger.addHandler(handler1)
 
 add_ir_variables = True
 ignore_first_result = True
+# The training articles exclude their own document from the results by id,
+# instead of dropping the first result (ignore_first_result is then not used)
+ir_exclude_self = True
+# Read the IR variables of the training articles from the neighbour table built by
+# neighbour-table.py (top_k neighbours of every indexed article), without running queries
+ir_neighbour_table = False
+# Local tool: MaxScore pruning of the exact top k, and the approximate mode that only queries
+# the ir_local_max_terms terms (None: all) / ir_local_term_mass of the score bound (1.0: all)
+ir_local_pruning = False
+ir_local_max_terms = None
+ir_local_term_mass = 1.0
+# Send the tools the compact queries: each term once (weighted by bm25_k3), without stopwords,
+# and only the ir_query_max_terms terms with the largest IDF (None: all, needs the local index)
+ir_compact_queries = False
+ir_query_max_terms = None
+ir_drop_stopwords = True
 exp_id = str(datetime.datetime.now())
 tool = 'zettair'
 ir_top_k = 100
 hyperpartisan_db_name = 'hyperpartisan_split_42_bulk'
+# SQLite file used to cache the raw query results (None disables it)
+ir_cache_path = None
+# Query arango/elastic from one process over aiohttp, with up to ir_max_in_flight requests
+# in flight, the documents are queried in chunks of ir_async_chunk
+ir_async = False
+ir_max_in_flight = 64
+ir_async_chunk = 1024
 
 
 exp_dict = {
@@ -99,87 +122,136 @@ exp_dict = {
     'solution_name': '1_bertha',
     'ir_top_k': ir_top_k,
     'ignore_first_result': ignore_first_result,
+    'ir_exclude_self': ir_exclude_self,
+    'ir_neighbour_table': ir_neighbour_table,
+    'ir_local_pruning': ir_local_pruning,
+    'ir_local_max_terms': ir_local_max_terms,
+    'ir_local_term_mass': ir_local_term_mass,
+    'ir_compact_queries': ir_compact_queries,
+    'ir_query_max_terms': ir_query_max_terms,
+    'ir_drop_stopwords': ir_drop_stopwords,
+    'ir_cache_path': ir_cache_path,
+    'ir_async': ir_async,
+    'ir_max_in_flight': ir_max_in_flight,
     'random_seed': random_seed,
     'train_input': '',
     'train_epochs': '',
 }
 
 testTool = IndexToolManager(
-    indexName=str(hyperpartisan_db_name), top_k=exp_dict['ir_top_k'])
+    indexName=str(hyperpartisan_db_name), top_k=exp_dict['ir_top_k'],
+    ir_cache_path=exp_dict['ir_cache_path'],
+    local_pruning=exp_dict['ir_local_pruning'],
+    local_max_terms=exp_dict['ir_local_max_terms'],
+    local_term_mass=exp_dict['ir_local_term_mass'],
+    compact_queries=exp_dict['ir_compact_queries'],
+    query_max_terms=exp_dict['ir_query_max_terms'],
+    drop_stopwords=exp_dict['ir_drop_stopwords'])
+
+asyncTool = None
+if (ir_async and tool in ['arango', 'elastic']):
+    # aiohttp is only needed when the asyncio client is enabled
+    from asyncindextoolmanager import AsyncIndexToolManager
+    asyncTool = AsyncIndexToolManager(
+        indexName=str(hyperpartisan_db_name), top_k=exp_dict['ir_top_k'],
+        max_in_flight=exp_dict['ir_max_in_flight'],
+        ir_cache_path=exp_dict['ir_cache_path'],
+        compact_queries=exp_dict['ir_compact_queries'],
+        query_max_terms=exp_dict['ir_query_max_terms'],
+        drop_stopwords=exp_dict['ir_drop_stopwords'])
 
 
 def load_elmo(path, max_len=200, add_ir_variables=False):
     '''
-    load ELMo embedding from tsv file.
-    :param path: tsv file path.
-    :param to_pickle: Convert elmo embeddings to .npy file, avoid read and pad every time.
-    :return: elmo embedding and its label.
+    load ELMo embedding store of the tsv file and the IR features of its articles.
+    :param path: tsv file path, its store is built the first time (see Preprocessing/elmostore.py).
+    :return: the ElmoStore, the (n_articles, 6) IR features (None without add_ir_variables),
+             the labels and the ids, to be batched by ElmoSequence.
     '''
-    X = []
+    store = open_store(path)
+    ir_features = []
     label = []
     ids = []
     i = 0
     l_encoder = LabelEncoder()
     time_query_list = []
     time_query = 0.0
-    with open(path, 'rb') as inf:
-        for line in inf:
-            gzip_fields = line.decode('utf-8').split('\t')
-            gzip_id = gzip_fields[0]
-
-            gzip_label = gzip_fields[1]
-            elmo_embd_str = gzip_fields[4].strip()
-            elmo_embd_list = ast.literal_eval(elmo_embd_str)
-            elmo_embd_array = np.array(elmo_embd_list)
-            padded_seq = sequence.pad_sequences(
-                [elmo_embd_array], maxlen=max_len, dtype='float32')[0]
-            if (add_ir_variables):
-                ir_variables = {}
-                initial = None
-                final = None
-                if (tool == 'arango'):
-                    text = testTool.arango_get_document(str(gzip_id))[
-                        'text']
-                    initial = time.time()
-                    ir_variables = testTool.arango_get_IR_variables(
-                        text, 'true', ignore_first_result=ignore_first_result)
-                    final = time.time()
-                elif (tool == 'elastic'):
-                    text = testTool.arango_get_document(str(gzip_id))[
-                        'text']
-                    initial = time.time()
-                    ir_variables = testTool.elastic_get_IR_variables(
-                        text, 'true', ignore_first_result=ignore_first_result)
-                    final = time.time()
-                elif (tool == 'zettair'):
-                    text = testTool.arango_get_document(str(gzip_id))[
-                        'text']
-                    initial = time.time()
-                    ir_variables = testTool.zettair_get_IR_variables(
-                        text, 'true', interactive=False,
-                        ignore_first_result=ignore_first_result)
-                    final = time.time()
-                # print(ir_variables)
-                time_query_list.append(float(final-initial))
-                padded_seq = np.concatenate((padded_seq, np.full(
-                    (1, 1024), ir_variables['CLASS_0_BM25_AVG'])))
-                padded_seq = np.concatenate((padded_seq, np.full(
-                    (1, 1024), ir_variables['CLASS_0_BM25_COUNT'])))
-                padded_seq = np.concatenate((padded_seq, np.full(
-                    (1, 1024), ir_variables['CLASS_0_BM25_SUM'])))
-                padded_seq = np.concatenate((padded_seq, np.full(
-                    (1, 1024), ir_variables['CLASS_1_BM25_AVG'])))
-                padded_seq = np.concatenate((padded_seq, np.full(
-                    (1, 1024), ir_variables['CLASS_1_BM25_COUNT'])))
-                padded_seq = np.concatenate((padded_seq, np.full(
-                    (1, 1024), ir_variables['CLASS_1_BM25_SUM'])))
-                # padded_seq = np.concatenate((padded_seq, np.full(
-                #     (1, 1024), gzip_id)))
-            X.append(padded_seq)
-            label.append(gzip_label)
-            ids.append(gzip_id)
-            i += 1
-            # print(i)
+    # (row of ir_features, text, excluded id) of the documents waiting to be queried by asyncTool
+    pending_ir = []
+    ignore_first = ignore_first_result and not ir_exclude_self
+
+    def add_pending_ir_variables():
+        ir_array, tq_list = asyncTool.get_IR_variables_concurrent(
+            [text for _, text, _ in pending_ir], tool, 'true',
+            ignore_first_result=ignore_first,
+            exclude_ids=[exclude for _, _, exclude in pending_ir])
+        time_query_list.extend(tq_list)
+        # The IR variables of each article, in the IR_VARIABLE_NAMES order
+        for (row, _, _), ir_values in zip(pending_ir, ir_array):
+            ir_features[row] = ir_values
+        pending_ir.clear()
+
+    for gzip_id, gzip_label, _ in store:
+        # The article itself is indexed, it is left out of its own results
+        exclude_ids = [str(gzip_id)] if ir_exclude_self else None
+        ir_values = None
+        if (add_ir_variables and ir_neighbour_table):
+            # Neither the text nor a query is needed, the neighbours were precomputed
+            initial = time.time()
+            ir_values = testTool.neighbours_get_IR_variables(
+                [str(gzip_id)], 'true', top_k=ir_top_k)[0]
+            time_query_list.append(float(time.time() - initial))
+        elif (add_ir_variables and asyncTool is not None):
+            text = testTool.arango_get_document(str(gzip_id))['text']
+            pending_ir.append((len(ir_features), text, exclude_ids))
+        elif (add_ir_variables):
+            ir_variables = {}
+            initial = None
+            final = None
+            if (tool == 'arango'):
+                text = testTool.arango_get_document(str(gzip_id))[
+                    'text']
+                initial = time.time()
+                ir_variables = testTool.arango_get_IR_variables(
+                    text, 'true', ignore_first_result=ignore_first,
+                    exclude_ids=exclude_ids)
+                final = time.time()
+            elif (tool == 'elastic'):
+                text = testTool.arango_get_document(str(gzip_id))[
+                    'text']
+                initial = time.time()
+                ir_variables = testTool.elastic_get_IR_variables(
+                    text, 'true', ignore_first_result=ignore_first,
+                    exclude_ids=exclude_ids)
+                final = time.time()
+            elif (tool == 'zettair'):
+                text = testTool.arango_get_document(str(gzip_id))[
+                    'text']
+                initial = time.time()
+                ir_variables = testTool.zettair_get_IR_variables(
+                    text, 'true', interactive=False,
+                    ignore_first_result=ignore_first, exclude_ids=exclude_ids)
+                final = time.time()
+            elif (tool == 'local'):
+                text = testTool.arango_get_document(str(gzip_id))[
+                    'text']
+                initial = time.time()
+                ir_variables = testTool.local_get_IR_variables(
+                    text, 'true', ignore_first_result=ignore_first,
+                    exclude_ids=exclude_ids)
+                final = time.time()
+            # print(ir_variables)
+            time_query_list.append(float(final-initial))
+            ir_values = np.array([ir_variables[name] for name in IR_VARIABLE_NAMES])
+        ir_features.append(ir_values)
+        label.append(gzip_label)
+        ids.append(gzip_id)
+        i += 1
+        # print(i)
+        if (len(pending_ir) >= ir_async_chunk):
+            add_pending_ir_variables()
+    if (len(pending_ir) > 0):
+        add_pending_ir_variables()
     Y = l_encoder.fit_transform(label)
 
     result_id = datetime.datetime.now().strftime("%Y%m%d-%H%M%S.%f")
@@ -207,7 +279,11 @@ def load_elmo(path, max_len=200, add_ir_variables=False):
         'number_queries': str(len(time_query_list)),
         'value': str(time_query),
     })
-    return np.array(X), np.array(Y), np.array(ids)
+    if add_ir_variables:
+        ir_features = np.array(ir_features, dtype='float64')
+    else:
+        ir_features = None
+    return store, ir_features, np.array(Y), np.array(ids)
 
 
 def conv1d(max_len, embed_size):
@@ -319,10 +395,12 @@ seed = 7
 max_len = 200
 embed_size = 1024
 
-x_data, y_data, ids = load_elmo(
+# The batches are padded from the memory-mapped store by ElmoSequence, only one is in memory
+elmo_store, ir_features, y_data, ids = load_elmo(
     args.inputTSV, max_len=max_len, add_ir_variables=add_ir_variables)
+sentence_len = max_len
 
-mylogger.info(f'x_data shape: {x_data.shape}')
+mylogger.info(f'x_data shape: {(len(elmo_store), max_len + (6 if add_ir_variables else 0), elmo_store.dim)}')
 mylogger.info(f'y_data shape: {y_data.shape}')
 # X_train, X_test, y_train, y_test = train_test_split(x_data, y_data,
 #                                                     test_size=0.33,
@@ -346,16 +424,18 @@ if (add_ir_variables):
 exp_dict['train_input'] = args.inputTSV
 exp_dict['train_epochs'] = str(epochs)
 
-for train, test in kfold.split(x_data, y_data):
+for train, test in kfold.split(np.zeros((len(y_data), 1)), y_data):
     i += 1
     print("current fold is : %s " % i)
     model = conv1d_BN(max_len, embed_size)
     checkpoints = ModelCheckpoint(filepath='./saved_models/BNCNN_vacc{val_acc:.4f}_f%s_e{epoch:02d}.hdf5' % str(i),
                                   verbose=1, monitor='val_acc', save_best_only=True)
-    history = model.fit(x_data[train], y_data[train], batch_size=32, verbose=1,
-                        epochs=epochs, callbacks=[checkpoints],
-                        validation_data=[x_data[test], y_data[test]],
-                        shuffle=False)
+    history = model.fit_generator(ElmoSequence(elmo_store, train, y_data, ir_features,
+                                               max_len=sentence_len, batch_size=32),
+                                  verbose=1, epochs=epochs, callbacks=[checkpoints],
+                                  validation_data=ElmoSequence(elmo_store, test, y_data, ir_features,
+                                                               max_len=sentence_len, batch_size=32),
+                                  shuffle=False)
     # use the last validation accuracy from the 30 epochs
     his_val = history.history['val_acc']
     cv_history_val_acc.append(his_val)
@@ -0,0 +1,224 @@
+'''
+Binary store of the ELMo sentence embeddings of the articles, replacing the JSON
+column of the elmo TSV files.
+
+A store with base path P is made of:
+  P.vectors      the sentence vectors of all the articles, one after the other (raw float16/float32)
+  P.offsets.npy  int64 array, the vectors of article i are the rows offsets[i]:offsets[i+1]
+  P.meta.tsv     one line per article with the first 4 columns of the elmo TSV: id, label, bias, domain
+  P.json         dtype and vector dimension
+The vectors are read through a memory map, so loading a store does not parse anything.
+'''
+
+import json
+import os
+import numpy as np
+try:
+    # Keras is only needed by ElmoSequence
+    from keras.utils import Sequence
+except ImportError:
+    Sequence = object
+
+
+def store_path(tsv_path):
+    '''
+    Base path of the store that corresponds to an elmo TSV file.
+    '''
+    return tsv_path + '.store'
+
+
+def store_exists(path):
+    return os.path.exists(path + '.json')
+
+
+def pad_vectors(vectors, max_len):
+    '''
+    Pads or truncates the sentence vectors of an article to max_len rows, like
+    keras pad_sequences with the default 'pre' padding and truncating.
+    '''
+    padded = np.zeros((max_len, vectors.shape[1]), dtype='float32')
+    vectors = vectors[-max_len:]
+    if len(vectors) > 0:
+        padded[max_len - len(vectors):] = vectors
+    return padded
+
+
+class ElmoStoreWriter:
+    '''
+    Writes a store one article at a time, to be used as a context manager.
+    '''
+
+    def __init__(self, path, dtype='float32'):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.dim = None
+        self.offsets = [0]
+        self.vectors_file = open(path + '.vectors', 'wb')
+        self.meta_file = open(path + '.meta.tsv', 'wt', encoding='utf8')
+
+    def add(self, fields, vectors):
+        '''
+        Appends an article.
+
+        Parameters
+        ----------
+        fields : list
+            id, label, bias and domain of the article (the first 4 columns of the elmo TSV).
+
+        vectors : list
+            Sentence vectors of the article, all of the same dimension.
+        '''
+        vectors = np.asarray(vectors, dtype=self.dtype)
+        if len(vectors) == 0:
+            vectors = vectors.reshape(0, self.dim or 0)
+        if self.dim is None and len(vectors) > 0:
+            self.dim = vectors.shape[1]
+        if len(vectors) > 0 and vectors.shape[1] != self.dim:
+            raise ValueError(f'Article {fields[0]} has vectors of dimension {vectors.shape[1]}'
+                             f', the store has {self.dim}')
+        self.vectors_file.write(vectors.tobytes())
+        self.offsets.append(self.offsets[-1] + len(vectors))
+        print(*[str(field).replace('\t', ' ') for field in fields[:4]], sep='\t', file=self.meta_file)
+
+    def close(self):
+        self.vectors_file.close()
+        self.meta_file.close()
+        np.save(self.path + '.offsets.npy', np.array(self.offsets, dtype=np.int64))
+        # The json is written last, store_exists is only true for complete stores
+        with open(self.path + '.json', 'wt') as outp:
+            json.dump({'dtype': self.dtype.name, 'dim': self.dim or 0}, outp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ElmoStore:
+    '''
+    Reads a store, the vectors are memory-mapped.
+    '''
+
+    def __init__(self, path):
+        with open(path + '.json', 'rt') as inp:
+            info = json.load(inp)
+        self.offsets = np.load(path + '.offsets.npy')
+        self.meta = []
+        with open(path + '.meta.tsv', 'rt', encoding='utf8') as inp:
+            for line in inp:
+                self.meta.append(line.rstrip('\n').split('\t'))
+        n_vectors = int(self.offsets[-1])
+        if n_vectors > 0:
+            self.vectors = np.memmap(path + '.vectors', dtype=info['dtype'], mode='r',
+                                     shape=(n_vectors, info['dim']))
+        else:
+            self.vectors = np.zeros((0, info['dim']), dtype=info['dtype'])
+
+    def __len__(self):
+        return len(self.meta)
+
+    @property
+    def dim(self):
+        return self.vectors.shape[1]
+
+    def article(self, i):
+        '''
+        Returns the sentence vectors of article i, a view of the memory map.
+        '''
+        return self.vectors[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        '''
+        Yields the (id, label, vectors) of the articles, in order.
+        '''
+        for i, fields in enumerate(self.meta):
+            yield fields[0], fields[1], self.article(i)
+
+
+def convert_tsv(tsv_path, path, dtype='float32', log_every=1000):
+    '''
+    Converts an elmo TSV file (id, label, bias, domain, json vectors) into a store.
+    '''
+    with ElmoStoreWriter(path, dtype) as writer:
+        with open(tsv_path, 'rt', encoding='utf8') as inp:
+            for nlines, line in enumerate(inp, 1):
+                fields = line.rstrip('\n').split('\t')
+                writer.add(fields[:4], json.loads(fields[4]))
+                if nlines % log_every == 0:
+                    print('Converted lines:', nlines)
+
+
+def open_store(tsv_path, dtype='float32'):
+    '''
+    Opens the store of an elmo TSV file, it is converted from the TSV file
+    the first time (and again if the TSV file is newer).
+    '''
+    path = store_path(tsv_path)
+    if not store_exists(path) or os.path.getmtime(path + '.json') < os.path.getmtime(tsv_path):
+        convert_tsv(tsv_path, path, dtype)
+    return ElmoStore(path)
+
+
+class ElmoSequence(Sequence):
+    '''
+    Keras Sequence of the articles of a store, each batch is padded when it is requested,
+    so only one batch is in memory (to be used by fit_generator and predict_generator).
+    The IR features of the articles are kept apart as a (n_articles, 6) array, in the batch
+    they are broadcast to rows of the vector dimension after the max_len sentence rows,
+    which is the input the models are trained on.
+
+    Parameters
+    ----------
+    store : ElmoStore
+        Store of the articles.
+
+    indices : array
+        Articles of the sequence, in order (None: all the articles of the store).
+
+    labels : array
+        Label of every article of the store, None for batches without labels.
+
+    ir_features : array
+        IR features of every article of the store, None if the models do not use them.
+    '''
+
+    def __init__(self, store, indices=None, labels=None, ir_features=None,
+                 max_len=200, batch_size=32):
+        self.store = store
+        self.indices = np.arange(len(store)) if indices is None else np.asarray(indices)
+        self.labels = labels
+        self.ir_features = ir_features
+        self.max_len = int(max_len)
+        self.batch_size = int(batch_size)
+
+    def __len__(self):
+        return (len(self.indices) + self.batch_size - 1) // self.batch_size
+
+    def __getitem__(self, batch):
+        indices = self.indices[batch * self.batch_size:(batch + 1) * self.batch_size]
+        n_rows = self.max_len
+        if self.ir_features is not None:
+            n_rows += self.ir_features.shape[1]
+        X = np.zeros((len(indices), n_rows, self.store.dim), dtype='float32')
+        for row, i in enumerate(indices):
+            # 'pre' padding and truncating, like pad_vectors
+            vectors = self.store.article(i)[-self.max_len:]
+            X[row, self.max_len - len(vectors):self.max_len] = vectors
+        if self.ir_features is not None:
+            X[:, self.max_len:, :] = self.ir_features[indices][:, :, None]
+        if self.labels is None:
+            return X
+        return X, self.labels[indices]
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("infile", type=str, help="Input file, the elmo TSV written by line2elmo2.py")
+    parser.add_argument("outfile", type=str, nargs='?', default=None,
+                        help="Base path of the store (default: infile.store)")
+    parser.add_argument("--dtype", type=str, default='float32',
+                        help="float32 or float16, half the size (float32)")
+    args = parser.parse_args()
+    convert_tsv(args.infile, args.outfile or store_path(args.infile), args.dtype)
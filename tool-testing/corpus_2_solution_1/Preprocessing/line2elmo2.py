@@ -4,6 +4,12 @@ NOTE: This uses the alannlp PyTorch implementation of Elmo!
 Process a line corpus and convert text to elmo embeddings, save as json array of sentence vectors.
 This expects the sents corpus which has fields title, article, domains. and treates
 title as the first sentence, then splits the article sentences. The domains are ignored
+With --packed, the sentences of --chunk articles at a time are sorted by length and embedded
+in full batches of -b sentences, by -w worker processes, the articles are written in input order.
+The ids of the written articles are appended to outfile.done with the size of outfile after them,
+a run that finds it resumes after the last written article (if the embedding options recorded on
+its first line are the same, --restart starts again from scratch). With --shard i/N only one article of
+every N is processed, into outfile.i-of-N, and --merge N writes the N shard files to outfile.
 '''
 
 import argparse
@@ -11,7 +17,10 @@ from allennlp.commands.elmo import ElmoEmbedder
 import os
 import json
 import math
+import multiprocessing
+import threading
 import numpy as np
+from elmostore import ElmoStoreWriter, convert_tsv, store_path
 
 configs = {
   "small": "elmo_2x1024_128_2048cnn_1xhighway_options.json",
@@ -28,6 +37,158 @@ models = {
 
 }
 
+
+def article_sentences(line, maxsents, maxtoks):
+    '''
+    Returns the first 4 fields of a line of the sents corpus and the tokens
+    of its sentences, the title first.
+    '''
+    fields = line.split("\t")
+    sents = [fields[5]]
+    sents.extend(fields[4].split(" <splt> ")[:maxsents])
+    sents = [s.split()[:maxtoks] for s in sents]
+    for s in sents:
+        if len(s) == 0:
+            s.append("")  # otherwise we get a shape (3,0,dims) result
+    return fields[:4], sents
+
+
+def sentence_vectors(elmo, sentsbatch, concat):
+    '''
+    Embeds a batch of tokenized sentences, returns one vector per sentence.
+    '''
+    ret = list(elmo.embed_sentences(sentsbatch))
+    # the ret is the original representation of three vectors per word
+    # We first combine per word through concatenation or average, then average
+    if concat:
+        ret = [np.concatenate(x, axis=1) for x in ret]
+    else:
+        ret = [np.average(x, axis=1) for x in ret]
+    return [np.average(x, axis=0) for x in ret]
+
+
+def embed_packed(elmo, articles, batchsize, concat):
+    '''
+    Embeds the sentences of several articles together, sorted by length so that the
+    batches of batchsize sentences need little padding.
+    Returns the (fields, sentence vectors) of each article, in the same order.
+    '''
+    order = sorted(((len(sent), nart, nsent)
+                    for nart, (_, sents) in enumerate(articles)
+                    for nsent, sent in enumerate(sents)), reverse=True)
+    outs = [[None] * len(sents) for _, sents in articles]
+    for fromidx in range(0, len(order), batchsize):
+        batch = order[fromidx:fromidx + batchsize]
+        ret = sentence_vectors(elmo, [articles[nart][1][nsent] for _, nart, nsent in batch], concat)
+        for (_, nart, nsent), vector in zip(batch, ret):
+            outs[nart][nsent] = vector
+    return [(fields, out) for (fields, _), out in zip(articles, outs)]
+
+
+# Embedder and options of a worker process, set by init_worker
+worker = {}
+
+
+def init_worker(options_file, weight_file, batchsize, concat, threads):
+    import torch
+    torch.set_num_threads(threads)
+    worker['elmo'] = ElmoEmbedder(options_file=options_file, weight_file=weight_file, cuda_device=-1)
+    worker['batchsize'] = batchsize
+    worker['concat'] = concat
+
+
+def embed_chunk(articles):
+    '''
+    Task of the worker processes, embed_packed with the embedder of the process.
+    '''
+    return embed_packed(worker['elmo'], articles, worker['batchsize'], worker['concat'])
+
+
+def read_chunks(lines, chunk, maxsents, maxtoks, pending=None):
+    '''
+    Yields the (fields, sentences) of the articles of the input lines, chunk articles at a time.
+    If pending is given (a semaphore), it is acquired before each chunk, so the chunks
+    read ahead of the ones being written are bounded.
+    '''
+    articles = []
+    for line in lines:
+        articles.append(article_sentences(line, maxsents, maxtoks))
+        if len(articles) == chunk:
+            if pending is not None:
+                pending.acquire()
+            yield articles
+            articles = []
+    if len(articles) > 0:
+        if pending is not None:
+            pending.acquire()
+        yield articles
+
+
+def shard_path(outfile, shard, nshards):
+    return "{}.{}-of-{}".format(outfile, shard, nshards)
+
+
+def read_done(outfile):
+    '''
+    Reads the index of the articles already written to outfile, returns the embedding options
+    written on its first line (None if there are none), the ids of the articles, the size
+    of outfile after the last one (the rest of outfile is an unfinished article) and the
+    size of the complete lines of the index.
+    '''
+    options = None
+    done = set()
+    size = 0
+    done_size = 0
+    if os.path.exists(outfile + ".done"):
+        with open(outfile + ".done", "rb") as inp:
+            for line in inp:
+                # A line without its newline was cut by the end of the previous run
+                if not line.endswith(b"\n"):
+                    break
+                done_size += len(line)
+                line = line.decode("utf8")
+                if line.startswith("# "):
+                    options = json.loads(line[2:])
+                else:
+                    doc_id, size = line.rstrip("\n").split("\t")
+                    done.add(doc_id)
+        size = int(size)
+    return options, done, size, done_size
+
+
+def todo_lines(inp, done, shard=0, nshards=1):
+    '''
+    Yields the lines of the input file of the shard whose articles are not done yet.
+    '''
+    for nline, line in enumerate(inp):
+        if nline % nshards == shard and line.split("\t", 1)[0] not in done:
+            yield line
+
+
+def merge_shards(infile, outfile, nshards):
+    '''
+    Writes the lines of the N shard files of outfile to outfile in the input order,
+    the shards must be complete.
+    '''
+    with open(infile, "rt", encoding="utf8") as inp:
+        nlines = sum(1 for _ in inp)
+    options = [read_done(shard_path(outfile, shard, nshards))[0] for shard in range(nshards)]
+    if any(shard_options != options[0] for shard_options in options):
+        raise ValueError("The shards were embedded with different options: {}".format(options))
+    shards = [open(shard_path(outfile, shard, nshards), "rt", encoding="utf8") for shard in range(nshards)]
+    with open(outfile, "wt", encoding="utf8") as outp:
+        for nline in range(nlines):
+            line = shards[nline % nshards].readline()
+            if not line.endswith("\n"):
+                raise ValueError("Shard {} of {} is not complete".format(nline % nshards, nshards))
+            outp.write(line)
+    for shard in shards:
+        if shard.readline() != "":
+            raise ValueError("{} has more lines than its shard of {}".format(shard.name, infile))
+        shard.close()
+    return nlines
+
+
 if __name__ == '__main__':
 
     default_m = "original"
@@ -42,8 +203,29 @@ if __name__ == '__main__':
                         help="Model (small, medium, original, original5b ({})".format(default_m))
     parser.add_argument("-g", action='store_true', help="Use the GPU (default: don't)")
     parser.add_argument("--concat", action='store_true', help="Concatenate representations instead of averaging")
+    parser.add_argument("--store", action='store_true',
+                        help="Also write the vectors to the binary store outfile.store (see elmostore.py)")
+    parser.add_argument("--store-dtype", type=str, default='float32', help="Store dtype, float32 or float16 (float32)")
+    parser.add_argument("--packed", action='store_true',
+                        help="Batch together the sentences of several articles sorted by length, implies --store")
+    parser.add_argument("--chunk", type=int, default=200, help="Articles packed together with --packed (200)")
+    parser.add_argument("-w", type=int, default=1,
+                        help="Worker processes with --packed, each one loads the model, CPU only (1)")
+    parser.add_argument("--shard", type=str, default=None,
+                        help="i/N: process the articles of lines i, i+N, ... into outfile.i-of-N")
+    parser.add_argument("--merge", type=int, default=None,
+                        help="N: merge the N shard files of outfile into outfile, nothing is embedded")
+    parser.add_argument("--restart", action='store_true',
+                        help="Ignore the articles done by a previous run into outfile, start from the first one")
     args = parser.parse_args()
 
+    if args.merge is not None:
+        nlines = merge_shards(args.infile, args.outfile, args.merge)
+        print("Total merged lines:", nlines)
+        if args.store or args.packed:
+            convert_tsv(args.outfile, store_path(args.outfile), args.store_dtype, args.l)
+        raise SystemExit(0)
+
     outfile = args.outfile
     infile = args.infile
     batchsize = args.b
@@ -54,55 +236,111 @@ if __name__ == '__main__':
     concat = args.concat
     maxtoks = args.maxtoks
     maxsents = args.maxsents
+    packed = args.packed
+    nworkers = args.w if packed else 1
+    shard, nshards = 0, 1
+    if args.shard is not None:
+        shard, nshards = [int(x) for x in args.shard.split("/")]
+        if not 0 <= shard < nshards:
+            parser.error("--shard i/N needs 0 <= i < N")
+        outfile = shard_path(outfile, shard, nshards)
+    if nworkers > 1 and use_gpu:
+        parser.error("-w is only supported without -g")
+
+    # The articles of a previous run are only kept if they were embedded the same way
+    options = {"model": args.m, "concat": concat, "maxtoks": maxtoks, "maxsents": maxsents}
+    if args.restart:
+        done, size, done_size = set(), 0, 0
+    else:
+        done_options, done, size, done_size = read_done(outfile)
+        if len(done) > 0 and done_options != options:
+            parser.error("{}.done was written with the options {}, not {}; use --restart to embed "
+                         "the articles again".format(outfile, done_options, options))
 
     print("Loading model {}...".format(args.m))
     if use_gpu:
         device = 0
     else:
         device = -1
-    elmo = ElmoEmbedder(options_file=config, weight_file=model, cuda_device=device)
+    pool = None
+    if nworkers > 1:
+        # Every worker loads its own model, the CPU threads are shared between them
+        threads = max(1, multiprocessing.cpu_count() // nworkers)
+        pool = multiprocessing.Pool(nworkers, initializer=init_worker,
+                                    initargs=(config, model, batchsize, concat, threads))
+    else:
+        elmo = ElmoEmbedder(options_file=config, weight_file=model, cuda_device=device)
+
+    if len(done) > 0:
+        print("Resuming after {} done articles".format(len(done)))
+    store = None
+    if (args.store or packed) and len(done) == 0:
+        store = ElmoStoreWriter(store_path(outfile), args.store_dtype)
 
+    def article_done(doc_id):
+        # The index only lists articles whose line is complete in outfile
+        outp.flush()
+        print(doc_id, outp.tell(), sep="\t", file=donefile, flush=True)
 
     print("Processing lines...")
     with open(infile, "rt", encoding="utf8") as inp:
+        lines = todo_lines(inp, done, shard, nshards)
         nlines = 0
-        with open(outfile, "wt", encoding="utf8") as outp:
-            for line in inp:
-                fields = line.split("\t")
-                title = fields[5]
-                tmp = fields[4]
-                tmp = tmp.split(" <splt> ")[:maxsents]
-                sents = [title]
-                sents.extend(tmp)
-                # now processes the sents in batches
-                outs = []
-                # unlike the tensorflow version we can have dynamic batch sizes here!
-                for batchnr in range(math.ceil(len(sents)/batchsize)):
-                    fromidx = batchnr * batchsize
-                    toidx = (batchnr+1) * batchsize
-                    actualtoidx = min(len(sents), toidx)
-                    # print("Batch: from=",fromidx,"toidx=",toidx,"actualtoidx=",actualtoidx)
-                    sentsbatch = sents[fromidx:actualtoidx]
-                    sentsbatch = [s.split()[:maxtoks] for s in sentsbatch]
-                    for s in sentsbatch:
-                        if len(s) == 0:
-                            s.append("")  # otherwise we get a shape (3,0,dims) result
-                    ret = list(elmo.embed_sentences(sentsbatch))
-                    # the ret is the original representation of three vectors per word
-                    # We first combine per word through concatenation or average, then average
-                    if concat:
-                        ret = [np.concatenate(x, axis=1) for x in ret]
-                    else:
-                        ret = [np.average(x, axis=1) for x in ret]
-                    # print("DEBUG tmpembs=", [l.shape for l in tmpembs])
-                    ret = [np.average(x, axis=0) for x in ret]
-                    # print("DEBUG finalreps=", [l.shape for l in finalreps])
-                    outs.extend(ret)
-
-                # print("Result lines:", len(outs))
-                outs = [a.tolist() for a in outs]
-                print(fields[0], fields[1], fields[2], fields[3], json.dumps(outs), sep="\t", file=outp)
-                nlines += 1
-                if nlines % every == 0:
-                    print("Processed lines:", nlines)
+        with open(outfile, "at" if len(done) > 0 else "wt", encoding="utf8") as outp, \
+                open(outfile + ".done", "at" if len(done) > 0 else "wt", encoding="utf8") as donefile:
+            outp.truncate(size)
+            donefile.truncate(done_size)
+            if len(done) == 0:
+                print("#", json.dumps(options, sort_keys=True), file=donefile, flush=True)
+            if packed:
+                if pool is not None:
+                    # imap keeps the input order, at most two chunks per worker are read ahead
+                    pending = threading.BoundedSemaphore(2 * nworkers)
+                    chunks = pool.imap(embed_chunk, read_chunks(lines, args.chunk, maxsents, maxtoks, pending))
+                else:
+                    pending = None
+                    chunks = (embed_packed(elmo, articles, batchsize, concat)
+                              for articles in read_chunks(lines, args.chunk, maxsents, maxtoks))
+                for chunk in chunks:
+                    for fields, outs in chunk:
+                        if store is not None:
+                            store.add(fields, outs)
+                        print(*fields, json.dumps([a.tolist() for a in outs]), sep="\t", file=outp)
+                        article_done(fields[0])
+                        nlines += 1
+                        if nlines % every == 0:
+                            print("Processed lines:", nlines)
+                    if pending is not None:
+                        pending.release()
+            else:
+                for line in lines:
+                    fields, sents = article_sentences(line, maxsents, maxtoks)
+                    # now processes the sents in batches
+                    outs = []
+                    # unlike the tensorflow version we can have dynamic batch sizes here!
+                    for batchnr in range(math.ceil(len(sents)/batchsize)):
+                        fromidx = batchnr * batchsize
+                        toidx = (batchnr+1) * batchsize
+                        actualtoidx = min(len(sents), toidx)
+                        # print("Batch: from=",fromidx,"toidx=",toidx,"actualtoidx=",actualtoidx)
+                        outs.extend(sentence_vectors(elmo, sents[fromidx:actualtoidx], concat))
+
+                    # print("Result lines:", len(outs))
+                    if store is not None:
+                        store.add(fields, outs)
+                    outs = [a.tolist() for a in outs]
+                    print(fields[0], fields[1], fields[2], fields[3], json.dumps(outs), sep="\t", file=outp)
+                    article_done(fields[0])
+                    nlines += 1
+                    if nlines % every == 0:
+                        print("Processed lines:", nlines)
         print("Total processed lines:", nlines)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if store is not None:
+        # Closed after the TSV file, so the store is not older than it
+        store.close()
+    elif (args.store or packed):
+        # A resumed run did not see the first articles, its store is converted from outfile
+        convert_tsv(outfile, store_path(outfile), args.store_dtype, every)
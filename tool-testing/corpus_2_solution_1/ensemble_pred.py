@@ -1,6 +1,4 @@
-import ast
 from sklearn.preprocessing import LabelEncoder
-from keras.preprocessing import sequence
 import numpy as np
 from keras.models import load_model
 from optparse import OptionParser
@@ -20,7 +18,9 @@ currentdir = os.path.dirname(os.path.abspath(
 parentdir = os.path.dirname(currentdir)
 # sys.path.insert(0, parentdir)
 sys.path.insert(0, '/home/ruan/Documentos/git/tcc-ii-ir-features-text-mining/tool-testing/')
-from indextoolmanager import IndexToolManager
+from indextoolmanager import IndexToolManager, IR_VARIABLE_NAMES, load_split_ids, write_split_lines
+sys.path.insert(0, os.path.join(currentdir, 'Preprocessing'))
+from elmostore import ElmoSequence, open_store
 
 variable_name = 'CLF'
 datestr = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
@@ -75,7 +75,27 @@ test_input = ''
 print(exp_dict)
 # exit()
 testTool = IndexToolManager(
-    indexName=str(hyperpartisan_db_name), top_k=exp_dict['ir_top_k'])
+    indexName=str(hyperpartisan_db_name), top_k=exp_dict['ir_top_k'],
+    ir_cache_path=exp_dict.get('ir_cache_path'),
+    local_pruning=exp_dict.get('ir_local_pruning', False),
+    local_max_terms=exp_dict.get('ir_local_max_terms'),
+    local_term_mass=exp_dict.get('ir_local_term_mass', 1.0),
+    compact_queries=exp_dict.get('ir_compact_queries', False),
+    query_max_terms=exp_dict.get('ir_query_max_terms'),
+    drop_stopwords=exp_dict.get('ir_drop_stopwords', True))
+
+asyncTool = None
+if (exp_dict.get('ir_async', False) and tool in ['arango', 'elastic']):
+    # aiohttp is only needed when the asyncio client is enabled
+    from asyncindextoolmanager import AsyncIndexToolManager
+    asyncTool = AsyncIndexToolManager(
+        indexName=str(hyperpartisan_db_name), top_k=exp_dict['ir_top_k'],
+        max_in_flight=exp_dict.get('ir_max_in_flight', 64),
+        ir_cache_path=exp_dict.get('ir_cache_path'),
+        compact_queries=exp_dict.get('ir_compact_queries', False),
+        query_max_terms=exp_dict.get('ir_query_max_terms'),
+        drop_stopwords=exp_dict.get('ir_drop_stopwords', True))
+ir_async_chunk = 1024
 
 testToolOrig = IndexToolManager(
     indexName=str(hyperpartisan_orig_db_name), top_k=exp_dict['ir_top_k'])
@@ -161,70 +181,82 @@ def toEvaluationFormat(all_doc_ids, all_prediction):
 
 
 def load_data(data_path, max_len=200, add_ir_variables=False):
-    data = []
+    '''
+    Opens the ELMo store of the tsv file and gets the IR features of its articles,
+    returns the store, the (n_articles, 6) IR features (None without add_ir_variables),
+    the labels and the ids, to be batched by ElmoSequence.
+    '''
+    store = open_store(data_path)
+    ir_features = []
     l = []
     ids = []
     i = 0
     l_encoder = LabelEncoder()
     time_query_list = []
     time_query = 0.0
-    with open(data_path, 'rb') as inf:
-        for line in inf:
-            gzip_fields = line.decode('utf-8').split('\t')
-            gzip_id = gzip_fields[0]
-
-            gzip_label = gzip_fields[1]
-            elmo_embd_str = gzip_fields[4].strip()
-            elmo_embd_list = ast.literal_eval(elmo_embd_str)
-            elmo_embd_array = np.array(elmo_embd_list)
-            padded_seq = sequence.pad_sequences(
-                [elmo_embd_array], maxlen=max_len, dtype='float32')[0]
-
-            if (add_ir_variables):
-                ir_variables = {}
-                initial = None
-                final = None
-                if (tool == 'arango'):
-                    text = testToolOrig.arango_get_document(str(gzip_id))[
-                        'text']
-                    initial = time.time()
-                    ir_variables = testTool.arango_get_IR_variables(
-                        text, 'true')
-                    final = time.time()
-                elif (tool == 'elastic'):
-                    text = testToolOrig.elastic_get_document(str(gzip_id))[
-                        'text']
-                    initial = time.time()
-                    ir_variables = testTool.elastic_get_IR_variables(
-                        text, 'true')
-                    final = time.time()
-                elif (tool == 'zettair'):
-                    text = testToolOrig.arango_get_document(str(gzip_id))[
-                        'text']
-                    initial = time.time()
-                    ir_variables = testTool.zettair_get_IR_variables(
-                        text, 'true', interactive=False)
-                    final = time.time()
-                time_query_list.append(float(final-initial))
-                padded_seq = np.concatenate((padded_seq, np.full(
-                    (1, 1024), ir_variables['CLASS_0_BM25_AVG'])))
-                padded_seq = np.concatenate((padded_seq, np.full(
-                    (1, 1024), ir_variables['CLASS_0_BM25_COUNT'])))
-                padded_seq = np.concatenate((padded_seq, np.full(
-                    (1, 1024), ir_variables['CLASS_0_BM25_SUM'])))
-                padded_seq = np.concatenate((padded_seq, np.full(
-                    (1, 1024), ir_variables['CLASS_1_BM25_AVG'])))
-                padded_seq = np.concatenate((padded_seq, np.full(
-                    (1, 1024), ir_variables['CLASS_1_BM25_COUNT'])))
-                padded_seq = np.concatenate((padded_seq, np.full(
-                    (1, 1024), ir_variables['CLASS_1_BM25_SUM'])))
-                # padded_seq = np.concatenate((padded_seq, np.full(
-                #     (1, 1024), gzip_id)))
-            data.append(padded_seq)
-            l.append(gzip_label)
-            ids.append(gzip_id)
-            i += 1
-            # print(i)
+    # (row of ir_features, text) of the documents waiting to be queried by asyncTool
+    pending_ir = []
+
+    def add_pending_ir_variables():
+        ir_array, tq_list = asyncTool.get_IR_variables_concurrent(
+            [text for _, text in pending_ir], tool, 'true')
+        time_query_list.extend(tq_list)
+        # The IR variables of each article, in the IR_VARIABLE_NAMES order
+        for (row, _), ir_values in zip(pending_ir, ir_array):
+            ir_features[row] = ir_values
+        pending_ir.clear()
+
+    for gzip_id, gzip_label, _ in store:
+        ir_values = None
+        if (add_ir_variables and asyncTool is not None):
+            if (tool == 'elastic'):
+                text = testToolOrig.elastic_get_document(str(gzip_id))['text']
+            else:
+                text = testToolOrig.arango_get_document(str(gzip_id))['text']
+            pending_ir.append((len(ir_features), text))
+        elif (add_ir_variables):
+            ir_variables = {}
+            initial = None
+            final = None
+            if (tool == 'arango'):
+                text = testToolOrig.arango_get_document(str(gzip_id))[
+                    'text']
+                initial = time.time()
+                ir_variables = testTool.arango_get_IR_variables(
+                    text, 'true')
+                final = time.time()
+            elif (tool == 'elastic'):
+                text = testToolOrig.elastic_get_document(str(gzip_id))[
+                    'text']
+                initial = time.time()
+                ir_variables = testTool.elastic_get_IR_variables(
+                    text, 'true')
+                final = time.time()
+            elif (tool == 'zettair'):
+                text = testToolOrig.arango_get_document(str(gzip_id))[
+                    'text']
+                initial = time.time()
+                ir_variables = testTool.zettair_get_IR_variables(
+                    text, 'true', interactive=False)
+                final = time.time()
+            elif (tool == 'local'):
+                text = testToolOrig.arango_get_document(str(gzip_id))[
+                    'text']
+                initial = time.time()
+                ir_variables = testTool.local_get_IR_variables(
+                    text, 'true')
+                final = time.time()
+            time_query_list.append(float(final-initial))
+            ir_values = np.array([ir_variables[name] for name in IR_VARIABLE_NAMES])
+        ir_features.append(ir_values)
+        l.append(gzip_label)
+        ids.append(gzip_id)
+        i += 1
+        # print(i)
+        if (len(pending_ir) >= ir_async_chunk):
+            add_pending_ir_variables()
+    if (len(pending_ir) > 0):
+        add_pending_ir_variables()
     label = l_encoder.fit_transform(l)
     result_id = datetime.datetime.now().strftime("%Y%m%d-%H%M%S.%f")
     time_query = np.mean(time_query_list)
@@ -238,7 +270,11 @@ def load_data(data_path, max_len=200, add_ir_variables=False):
         'number_queries': str(len(time_query_list)),
         'value': str(time_query),
     })
-    return np.array(data), np.array(label), np.array(ids)
+    if add_ir_variables:
+        ir_features = np.array(ir_features, dtype='float64')
+    else:
+        ir_features = None
+    return store, ir_features, np.array(label), np.array(ids)
 
 
 def ensemble(models, model_input):
@@ -250,27 +286,21 @@ def ensemble(models, model_input):
     return model
 
 
+def save_split_elmo(data_path, max_len=200):
+    '''
+    Writes the train and test splits of the ELMo TSV file in a single pass over it.
+    '''
+    write_split_lines(data_path, [(load_split_ids('data/train_set.csv'), 'work/train-split.elmo.tsv'),
+                                  (load_split_ids('data/test_set.csv'), 'work/test-split.elmo.tsv')])
+
+
 def save_test_split_elmo(data_path, max_len=200):
-    df = pd.read_csv('data/test_set.csv', dtype=str)
-    with open('work/test-split.elmo.tsv', 'wb') as fo:
-        with open(data_path, 'rb') as inf:
-            for line in inf:
-                gzip_fields = line.decode('utf-8').split('\t')
-                gzip_id = gzip_fields[0]
-                if (df['0'].str.contains(str(gzip_id)).any()):
-                    fo.write(line)
+    write_split_lines(data_path, [(load_split_ids('data/test_set.csv'), 'work/test-split.elmo.tsv')])
     return
 
 
 def save_train_split_elmo(data_path, max_len=200):
-    df = pd.read_csv('data/train_set.csv', dtype=str)
-    with open('work/train-split.elmo.tsv', 'wb') as fo:
-        with open(data_path, 'rb') as inf:
-            for line in inf:
-                gzip_fields = line.decode('utf-8').split('\t')
-                gzip_id = gzip_fields[0]
-                if (df['0'].str.contains(str(gzip_id)).any()):
-                    fo.write(line)
+    write_split_lines(data_path, [(load_split_ids('data/train_set.csv'), 'work/train-split.elmo.tsv')])
     return
 
 
@@ -295,10 +325,11 @@ max_len = 200
 embed_size = 1024
 seed = 7
 
-x_data, y_data, doc_id = load_data(options.inputTSV, max_len=max_len,
-                                   add_ir_variables=add_ir_variables)
+# The batches are padded from the memory-mapped store by ElmoSequence, only one is in memory
+elmo_store, ir_features, y_data, doc_id = load_data(options.inputTSV, max_len=max_len,
+                                                    add_ir_variables=add_ir_variables)
 
-mylogger.info(f'x_data shape: {x_data.shape}')
+mylogger.info(f'x_data shape: {(len(elmo_store), max_len + (6 if add_ir_variables else 0), elmo_store.dim)}')
 mylogger.info(f'y_data shape: {y_data.shape}')
 mylogger.info(f'doc_id shape: {doc_id.shape}')
 
@@ -322,7 +353,8 @@ model_input = Input(shape=models[0].input_shape[1:], dtype='float32')
 
 ensemble_models = ensemble(models, model_input)
 
-pred = ensemble_models.predict(x_data)
+pred = ensemble_models.predict_generator(ElmoSequence(elmo_store, ir_features=ir_features,
+                                                     max_len=max_len, batch_size=32))
 
 all_pred = toEvaluationFormat(doc_id, pred)
 with open(options.output, 'w') as fo:
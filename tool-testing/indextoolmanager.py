@@ -1,16 +1,27 @@
-# import os
+import os
+import re
 import time
 # import timeit
 # import pprint
-import math
+import queue
 import subprocess
+import threading
+import hashlib
+import sqlite3
+from collections import Counter, OrderedDict
+from functools import partial
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 # from datetime import datetime
 from arango import ArangoClient
+from arango.exceptions import DocumentInsertError, ServerConnectionError
+from requests.exceptions import ConnectionError as RequestsConnectionError
 from elasticsearch import Elasticsearch
 from elasticsearch import helpers as ElasticsearchHelpers
 
 import xml.etree.ElementTree as ET
 
+import numpy as np
 import pandas as pd
 import json
 from shlex import quote
@@ -22,6 +33,477 @@ default_db_names = {
     'hyperpartisan_split_42': 'hyperpartisan_split_42'
 }
 
+IR_VARIABLE_NAMES = [
+    'CLASS_0_BM25_AVG',
+    'CLASS_0_BM25_COUNT',
+    'CLASS_0_BM25_SUM',
+    'CLASS_1_BM25_AVG',
+    'CLASS_1_BM25_COUNT',
+    'CLASS_1_BM25_SUM',
+]
+
+token_pattern = re.compile(r'\w+')
+
+
+def tokenize_text(text):
+    '''
+    Splits a text into lowercase word tokens, used by the local BM25 index
+    both when indexing documents and when parsing queries.
+
+    Parameters
+    ----------
+    text : str
+        Text to be tokenized.
+    '''
+    return token_pattern.findall(str(text).lower())
+
+
+# English stopwords dropped from the queries by IndexToolManager.prepare_query,
+# written as tokenize_text tokens (the contractions are split on the apostrophe)
+english_stopwords = frozenset([
+    'a', 'about', 'above', 'after', 'again', 'against', 'all', 'am', 'an', 'and', 'any',
+    'are', 'as', 'at', 'be', 'because', 'been', 'before', 'being', 'below', 'between',
+    'both', 'but', 'by', 'can', 'could', 'd', 'did', 'do', 'does', 'doing', 'don', 'down',
+    'during', 'each', 'few', 'for', 'from', 'further', 'had', 'has', 'have', 'having', 'he',
+    'her', 'here', 'hers', 'herself', 'him', 'himself', 'his', 'how', 'i', 'if', 'in',
+    'into', 'is', 'it', 'its', 'itself', 'just', 'll', 'm', 'me', 'more', 'most', 'my',
+    'myself', 'no', 'nor', 'not', 'now', 'of', 'off', 'on', 'once', 'only', 'or', 'other',
+    'our', 'ours', 'ourselves', 'out', 'over', 'own', 're', 's', 'same', 'she', 'should',
+    'so', 'some', 'such', 't', 'than', 'that', 'the', 'their', 'theirs', 'them',
+    'themselves', 'then', 'there', 'these', 'they', 'this', 'those', 'through', 'to',
+    'too', 'under', 'until', 'up', 've', 'very', 'was', 'we', 'were', 'what', 'when',
+    'where', 'which', 'while', 'who', 'whom', 'why', 'will', 'with', 'would', 'you',
+    'your', 'yours', 'yourself', 'yourselves',
+])
+
+
+# A result line of the interactive Zettair, e.g. "> 1. 0000012:true (Score 12.345, Docid 11)"
+zettair_result_pattern = re.compile(r'^(?:>\s*)*\d+\.\s+(\S+)\s+\(score:?\s*([-+0-9.eE]+)',
+                                    re.IGNORECASE)
+# The summary line printed after the results of every query, used as the end of a response,
+# e.g. "100 results of about 2345 documents in 0.01 seconds"
+zettair_summary_pattern = re.compile(r'^(?:>\s*)*\d+ results?\b.*\bdocuments?\b')
+
+
+def parse_author_documents(db, documents_xml_folder, line, append_class_to_id=False):
+    '''
+    Parses the XML file of one author of a DB_AUTHORPROF or DB_BOTGENDER truth file line,
+    returns the list of documents of the author.
+    It is a module function so it can be used by the worker processes of a Pool.
+
+    Parameters
+    ----------
+    db : str
+        Database name { authorprof | botgender }.
+
+    documents_xml_folder : str
+        Folder that contains the XML files from the authors' documents (twits).
+
+    line : str
+        Line of the truth file, author_id:::gender or author_id:::kind:::gender.
+    '''
+    separator = ':::'
+    if (db == 'botgender'):
+        author_id, kind, gender = line.split(separator)
+    else:
+        author_id, gender = line.split(separator)
+    author_xml = documents_xml_folder + author_id + '.xml'
+
+    # Open the author XML file
+    tree_author = ET.parse(str(author_xml),
+                           parser=ET.XMLParser(encoding="utf-8"))
+    root_author = tree_author.getroot()
+
+    documents = []
+    number = 1
+    for child in root_author[0]:
+        if (db == 'botgender'):
+            document = {'id': str(author_id + '-' + str(number)),
+                        'author_id': str(author_id),
+                        'kind': str(kind), 'gender': str(gender),
+                        'text': child.text, 'class': str(kind),
+                        }
+        else:
+            document = {'id': str(author_id + '-' + str(number)),
+                        'author_id': str(author_id),
+                        'gender': str(gender), 'class': str(gender),
+                        'text': child.text
+                        }
+        if append_class_to_id:
+            document['id'] += str(':' + str(document['class']))
+        number = number + 1
+        documents.append(document)
+    return documents
+
+
+def split_id_key(doc_id):
+    '''
+    Normalizes a DB_HYPERPARTISAN article id of the split files, the ELMo TSV files
+    or the indexes (with or without ':class'), e.g. '0000178' and '178:true' are article 178.
+    '''
+    doc_id = str(doc_id).split(':')[0].strip()
+    return int(doc_id) if doc_id.isdigit() else doc_id
+
+
+def load_split_ids(csv_path):
+    '''
+    Loads the article ids of a split file (e.g. db_hyperpartisan/train_set.csv,
+    one id per line under the '0' header) once, returns them as a set of split_id_key.
+
+    Parameters
+    ----------
+    csv_path : str
+        Path of the split CSV file.
+    '''
+    df = pd.read_csv(csv_path, dtype=str)
+    return set(split_id_key(doc_id) for doc_id in df['0'])
+
+
+def write_split_lines(tsv_path, splits):
+    '''
+    Writes the lines of a TSV file whose first field is the article id (e.g. the ELMo TSV)
+    to the output file of every split that contains the id, in a single pass.
+
+    Parameters
+    ----------
+    tsv_path : str
+        Path of the input TSV file.
+
+    splits : list
+        List of (split ids, output path) pairs, the split ids as returned by load_split_ids.
+    '''
+    outputs = [(split_ids, open(output_path, 'wb')) for split_ids, output_path in splits]
+    try:
+        with open(tsv_path, 'rb') as inf:
+            for line in inf:
+                key = split_id_key(line.split(b'\t', 1)[0].decode('utf-8'))
+                for split_ids, fo in outputs:
+                    if key in split_ids:
+                        fo.write(line)
+    finally:
+        for _, fo in outputs:
+            fo.close()
+
+
+class ZettairWorkerError(RuntimeError):
+    '''
+    Raised when an interactive Zettair process exits or does not answer in time.
+    '''
+
+
+class ZettairWorker:
+    '''
+    A long-lived interactive Zettair query process.
+    Its output is read by a thread into a queue, so the responses can be read
+    with a timeout, and each response ends at the summary line Zettair prints
+    after the results of a query.
+
+    Attributes
+    ----------
+    command : list
+        Command line of the zet process
+
+    timeout : float
+        Seconds to wait for each response
+    '''
+
+    def __init__(self, command, timeout=60):
+        self.command = list(command)
+        self.timeout = float(timeout)
+        self.lock = threading.Lock()
+        self.process = None
+        self.output = None
+        self.start()
+
+    def start(self):
+        self.process = subprocess.Popen(self.command,
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL)
+        self.output = queue.Queue()
+        reader = threading.Thread(target=self.read_output,
+                                  args=(self.process, self.output), daemon=True)
+        reader.start()
+
+    @staticmethod
+    def read_output(process, output):
+        for line in iter(process.stdout.readline, b''):
+            output.put(line.decode('utf-8', errors='replace'))
+        # End of file, the process exited
+        output.put(None)
+
+    def stop(self):
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+            except OSError:
+                pass
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+    def read_response(self):
+        '''
+        Reads the response of one query, returns a list of (docno, score).
+        '''
+        hits = []
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                line = self.output.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                raise ZettairWorkerError(f'Zettair did not answer in {self.timeout} seconds')
+            if line is None:
+                # End of its output, the process is exiting
+                try:
+                    code = self.process.wait(self.timeout)
+                except subprocess.TimeoutExpired:
+                    code = None
+                raise ZettairWorkerError(f'Zettair exited with code {code}')
+            if zettair_summary_pattern.match(line):
+                return hits
+            match = zettair_result_pattern.match(line)
+            if match:
+                hits.append((match.group(1), float(match.group(2))))
+
+    def query_many(self, escaped_queries):
+        '''
+        Sends the queries (already escaped, one per line), returns a list of
+        (docno, score) lists, one per query.
+        The queries are written by a separate thread while the responses are read.
+        '''
+        stdin = self.process.stdin
+        write_errors = []
+
+        def write_queries():
+            try:
+                for escaped_query in escaped_queries:
+                    stdin.write(escaped_query.encode('utf-8') + b'\n')
+                stdin.flush()
+            except OSError as err:
+                # The process died, read_response usually reports it first
+                write_errors.append(err)
+
+        writer = threading.Thread(target=write_queries, daemon=True)
+        writer.start()
+        try:
+            responses = [self.read_response() for _ in escaped_queries]
+        finally:
+            writer.join(self.timeout)
+        if write_errors:
+            raise ZettairWorkerError(f'Writing the queries to Zettair failed: {write_errors[0]}')
+        return responses
+
+
+class ZettairWorkerPool:
+    '''
+    A pool of interactive Zettair processes of the same index and parameters.
+    The queries are dispatched round-robin and the workers run in parallel threads,
+    a worker that crashes or times out is restarted and its queries retried.
+
+    Attributes
+    ----------
+    command : list
+        Command line of the zet processes
+
+    n_workers : int
+        Number of zet processes
+
+    timeout : float
+        Seconds to wait for each response
+
+    retries : int
+        Number of times the queries of a failed worker are retried after restarting it
+    '''
+
+    def __init__(self, command, n_workers=4, timeout=60, retries=1):
+        self.retries = int(retries)
+        self.workers = [ZettairWorker(command, timeout) for _ in range(max(int(n_workers), 1))]
+        self.lock = threading.Lock()
+        self.next_worker = 0
+
+    def run(self, worker, escaped_queries):
+        with worker.lock:
+            for attempt in range(self.retries + 1):
+                try:
+                    return worker.query_many(escaped_queries)
+                except ZettairWorkerError:
+                    worker.restart()
+                    if attempt == self.retries:
+                        raise
+
+    def query_many(self, escaped_queries):
+        '''
+        Runs the queries in the workers, returns a list of (docno, score) lists, one per query.
+        '''
+        n_workers = len(self.workers)
+        with self.lock:
+            first = self.next_worker
+            self.next_worker = (first + len(escaped_queries)) % n_workers
+        responses = [None] * len(escaped_queries)
+        errors = []
+
+        def run_worker(worker, indexes):
+            try:
+                hits_list = self.run(worker, [escaped_queries[i] for i in indexes])
+                for i, hits in zip(indexes, hits_list):
+                    responses[i] = hits
+            except ZettairWorkerError as err:
+                errors.append(err)
+
+        threads = []
+        for offset in range(min(n_workers, len(escaped_queries))):
+            worker = self.workers[(first + offset) % n_workers]
+            indexes = list(range(offset, len(escaped_queries), n_workers))
+            threads.append(threading.Thread(target=run_worker, args=(worker, indexes)))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return responses
+
+    def query(self, escaped_query):
+        return self.query_many([escaped_query])[0]
+
+    def close(self):
+        for worker in self.workers:
+            worker.stop()
+
+
+class IRResultCache:
+    '''
+    A persistent cache of raw query results, used to avoid sending the same
+    BM25 query to the tools again in repeated experiments.
+    The results are stored in a SQLite file as (id, class, score) lists and
+    the most recently used ones are also kept in memory.
+
+    Attributes
+    ----------
+    path : str
+        Path of the SQLite file
+
+    memory_size : int
+        Maximum number of results kept in the memory (LRU) tier
+    '''
+
+    def __init__(self, path, memory_size=10000):
+        self.path = path
+        self.memory_size = int(memory_size)
+        self.memory = OrderedDict()
+        self.connection = sqlite3.connect(str(path), timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS results '
+                                '(key TEXT PRIMARY KEY, result TEXT NOT NULL)')
+        self.connection.commit()
+
+    def make_key(self, tool, index_name, query, bm25_k1, bm25_b, bm25_k3,
+                 top_k, ignore_first_result, exclude_ids=()):
+        '''
+        Builds the cache key of a query, the query text is replaced by its SHA1 hash.
+        The excluded document ids are only part of the key when there are any,
+        so the keys of the queries without exclusions do not change.
+        '''
+        query_hash = hashlib.sha1(str(query).encode('utf-8')).hexdigest()
+        key = (f'{tool}|{index_name}|{query_hash}|{float(bm25_k1)}|{float(bm25_b)}|'
+               + f'{float(bm25_k3)}|{int(top_k)}|{int(bool(ignore_first_result))}')
+        if exclude_ids:
+            key += '|' + hashlib.sha1('\n'.join(sorted(exclude_ids)).encode('utf-8')).hexdigest()
+        return key
+
+    def memorize(self, key, item_list):
+        self.memory[key] = item_list
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def get(self, key):
+        '''
+        Returns the cached list of [id, class, score] results of the key,
+        or None if the query was never cached.
+        '''
+        item_list = self.memory.get(key)
+        if item_list is not None:
+            self.memory.move_to_end(key)
+            return item_list
+        row = self.connection.execute('SELECT result FROM results WHERE key = ?',
+                                      (key,)).fetchone()
+        if row is None:
+            return None
+        item_list = json.loads(row[0])
+        self.memorize(key, item_list)
+        return item_list
+
+    def put(self, key, item_list):
+        '''
+        Stores the list of [id, class, score] results of the key.
+        '''
+        self.memorize(key, item_list)
+        self.connection.execute('INSERT OR REPLACE INTO results (key, result) VALUES (?, ?)',
+                                (key, json.dumps(item_list)))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+class QueryResult:
+    '''
+    A compact query result, an alternative to the Pandas DataFrame returned
+    by the query methods when they are called with as_arrays=True.
+    Classes and document ids are interned by the IndexToolManager, so each
+    result only stores small NumPy arrays.
+
+    Attributes
+    ----------
+    scores : array
+        float32 BM25 scores, in decreasing order
+
+    classes : array
+        int16 class codes, indexes of class_names
+
+    docs : array
+        int64 document ordinals, indexes of doc_ids
+
+    class_names : list
+        Interning table of the classes, shared by all the results of a manager
+
+    doc_ids : list
+        Interning table of the document ids, shared by all the results of a manager
+    '''
+    __slots__ = ('scores', 'classes', 'docs', 'class_names', 'doc_ids')
+
+    def __init__(self, scores, classes, docs, class_names, doc_ids):
+        self.scores = scores
+        self.classes = classes
+        self.docs = docs
+        self.class_names = class_names
+        self.doc_ids = doc_ids
+
+    def __len__(self):
+        return len(self.scores)
+
+    def ids(self):
+        return [self.doc_ids[doc] for doc in self.docs]
+
+    def labels(self):
+        return [self.class_names[cl] for cl in self.classes]
+
+    def to_dataframe(self):
+        '''
+        Converts the result to the DataFrame returned by the query methods.
+        '''
+        return pd.DataFrame({'score': self.scores.astype(np.float64),
+                             'id': self.ids(),
+                             'class': self.labels()},
+                            columns=['score', 'id', 'class'])
+
 
 class IndexToolManager:
     '''
@@ -47,6 +529,42 @@ class IndexToolManager:
     top_k : int
         Number of results to be retrieved when querying the database
 
+    query_only : bool
+        Only connects to the tools, skipping the creation of databases, collections,
+        views and indices, to be used by processes that only query existing indexes
+
+    ir_cache_path : str
+        Path of the SQLite file used to cache the query results of the
+        *_get_IR_variables methods, the cache is disabled when it is None
+
+    zettair_workers : int
+        Number of interactive Zettair processes of the ZettairWorkerPool used by the
+        Zettair queries, when it is 0 a single process is used
+
+    local_pruning : bool
+        Retrieve the local top_k results with MaxScore dynamic pruning instead of
+        scoring every document, the results are the same
+
+    local_max_terms : int
+        Approximate local queries: only the local_max_terms query terms with the
+        largest score upper bounds are used, None uses all of them
+
+    local_term_mass : float
+        Approximate local queries: only the query terms with the largest score upper
+        bounds that add up to this fraction of the query upper bound are used,
+        1.0 uses all of them. The results lose recall as it decreases
+
+    compact_queries : bool
+        Send every tool the compact form of the queries built by prepare_query
+        instead of the raw text
+
+    query_max_terms : int
+        Compact queries keep only the query_max_terms terms with the largest IDF
+        in the local index, None keeps all of them
+
+    drop_stopwords : bool
+        Compact queries leave out the english_stopwords
+
     Methods
     -------
     initializeArango()
@@ -55,20 +573,62 @@ class IndexToolManager:
     '''
 
     def __init__(self, indexName='default_index',
-                 bm25_b=0.75, bm25_k1=1.2, bm25_k3=0.0, top_k=100):
+                 bm25_b=0.75, bm25_k1=1.2, bm25_k3=0.0, top_k=100,
+                 query_only=False, ir_cache_path=None, ir_cache_size=10000,
+                 zettair_workers=0, zettair_timeout=60,
+                 local_pruning=False, local_max_terms=None, local_term_mass=1.0,
+                 compact_queries=False, query_max_terms=None, drop_stopwords=True):
         self.indexName = indexName
         self.bm25_b = float(bm25_b)
         self.bm25_k1 = float(bm25_k1)
         self.bm25_k3 = float(bm25_k3)
         self.numberResults = int(top_k)
+        self.query_only = bool(query_only)
+        self.compact_queries = bool(compact_queries)
+        self.query_max_terms = query_max_terms
+        self.drop_stopwords = bool(drop_stopwords)
         self.root_path = "/home/ruan/Documentos/git/tcc-ii-ir-features-text-mining/tool-testing/"
 
         self.zettair_query_process = None
+        # Number of results retrieved by the running interactive process
+        self.zettair_query_n_results = None
+        self.zettair_workers = int(zettair_workers)
+        self.zettair_timeout = float(zettair_timeout)
+        # One ZettairWorkerPool per number of results
+        self.zettair_pools = {}
+        # id -> class table of the index, loaded on the first lookup
+        self.doc_classes = None
+
+        self.local_postings_ptr = None
+        self.local_pruning = bool(local_pruning)
+        self.local_max_terms = local_max_terms
+        self.local_term_mass = float(local_term_mass)
+        # Memory-mapped neighbour table, opened on the first read
+        self.neighbours_table = None
+
+        # AQL query texts by (name, view), only the bind variables change between queries
+        self.arango_aql_templates = {}
+
+        self.result_class_names = []
+        self.result_class_codes = {}
+        self.result_doc_ids = []
+        self.result_doc_ordinals = {}
+
+        self.irCache = None
+        if ir_cache_path is not None:
+            self.irCache = IRResultCache(ir_cache_path, ir_cache_size)
 
         self.initializeArango()
         self.initializeElastic()
 
         self.resultsIndexName = 'tcc_results'
+        if self.query_only:
+            self.arangoResultsDb = self.arangoClient.db(
+                self.resultsIndexName, username=None, password=None)
+            self.arangoResultsCollection = self.arangoResultsDb.collection(
+                self.resultsIndexName)
+            return
+
         body = {
             "settings": {
                 "number_of_shards": 1,
@@ -131,6 +691,7 @@ class IndexToolManager:
 
         self.arango_delete(index_list)
         self.elastic_delete(index_list)
+        self.local_delete(index_list)
 
     def log_result(self, itemKey, itemBody):
         '''
@@ -175,10 +736,77 @@ class IndexToolManager:
     def get_documents(self, db='authorprof',
                       documents_xml_folder='db_authorprof/en/',
                       truth_txt='db_authorprof/truth.txt',
-                      append_class_to_id=False):
+                      append_class_to_id=False, processes=1):
         '''
         Generates a list with all documents from db formatted files.
 
+        Parameters
+        ----------
+        db : str
+            Database name.
+
+        documents_xml_folder : str
+            Folder that contains the XML files from the authors' documents (twits),
+            must follow the DB_AUTHORPROF task XML format.
+
+        truth_txt : str
+            Truth TXT file with authors' classifications of gender { female | male },
+            must follow the DB_AUTHORPROF task TXT format.
+
+        processes : int
+            Number of processes parsing the author XML files (authorprof and botgender),
+            None uses all the cores.
+        '''
+        if (processes != 1 and db in ['authorprof', 'botgender']):
+            return list(self.iter_documents_parallel(db, documents_xml_folder, truth_txt,
+                                                     append_class_to_id, processes))
+        return list(self.iter_documents(db, documents_xml_folder, truth_txt, append_class_to_id))
+
+    def iter_documents_parallel(self, db='authorprof',
+                                documents_xml_folder='db_authorprof/en/',
+                                truth_txt='db_authorprof/truth.txt',
+                                append_class_to_id=False, processes=None, chunksize=16):
+        '''
+        Yields the documents of a per-author database (authorprof or botgender),
+        the authors of the truth file are parsed by a pool of processes and
+        the documents are yielded in the truth file order, as in iter_documents.
+
+        Parameters
+        ----------
+        db : str
+            Database name { authorprof | botgender }.
+
+        documents_xml_folder : str
+            Folder that contains the XML files from the authors' documents (twits).
+
+        truth_txt : str
+            Truth TXT file with authors' classifications.
+
+        processes : int
+            Number of worker processes, None uses all the cores.
+
+        chunksize : int
+            Number of authors sent to a worker at a time.
+        '''
+        with open(truth_txt) as f:
+            lines = f.read().splitlines()
+
+        parse = partial(parse_author_documents, db, documents_xml_folder,
+                        append_class_to_id=append_class_to_id)
+        with Pool(processes=processes) as pool:
+            # imap keeps the order of the lines
+            for documents in pool.imap(parse, lines, chunksize):
+                yield from documents
+
+    def iter_documents(self, db='authorprof',
+                       documents_xml_folder='db_authorprof/en/',
+                       truth_txt='db_authorprof/truth.txt',
+                       append_class_to_id=False):
+        '''
+        Generator version of get_documents, yields the documents one by one
+        while the files are parsed, so they can be indexed without keeping
+        the whole database in memory.
+
         Parameters
         ----------
         db : str
@@ -193,15 +821,15 @@ class IndexToolManager:
             must follow the DB_AUTHORPROF task TXT format.
         '''
         if (db == 'authorprof'):
-            return self.get_documents_DB_AUTHORPROF(documents_xml_folder, truth_txt, append_class_to_id)
+            return self.iter_documents_DB_AUTHORPROF(documents_xml_folder, truth_txt, append_class_to_id)
         if (db == 'botgender'):
-            return self.get_documents_DB_BOTGENDER(documents_xml_folder, truth_txt, append_class_to_id)
+            return self.iter_documents_DB_BOTGENDER(documents_xml_folder, truth_txt, append_class_to_id)
         if (db == 'hyperpartisan'):
-            return self.get_documents_DB_HYPERPARTISAN(documents_xml_folder, truth_txt, append_class_to_id)
+            return self.iter_documents_DB_HYPERPARTISAN(documents_xml_folder, truth_txt, append_class_to_id)
         if (db == 'hyperpartisan_split_42'):
-            return self.get_documents_DB_HYPERPARTISAN_split(documents_xml_folder, truth_txt, append_class_to_id)
+            return self.iter_documents_DB_HYPERPARTISAN_split(documents_xml_folder, truth_txt, append_class_to_id)
 
-        return []
+        return iter([])
 
     def get_documents_DB_AUTHORPROF(self,
                                     documents_xml_folder='db_authorprof/en/',
@@ -220,38 +848,35 @@ class IndexToolManager:
             Truth TXT file with authors' classifications of gender { female | male },
             must follow the DB_AUTHORPROF task TXT format.
         '''
-        documents = []
+        return list(self.iter_documents_DB_AUTHORPROF(documents_xml_folder, truth_txt,
+                                                      append_class_to_id))
 
-        lines = []
-        separator = ':::'
+    def iter_documents_DB_AUTHORPROF(self,
+                                     documents_xml_folder='db_authorprof/en/',
+                                     truth_txt='db_authorprof/truth.txt',
+                                     append_class_to_id=False):
+        '''
+        Yields the documents from DB_AUTHORPROF formatted files,
+        one author XML file is parsed at a time.
+
+        Parameters
+        ----------
+        documents_xml_folder : str
+            Folder that contains the XML files from the authors' documents (twits),
+            must follow the DB_AUTHORPROF task XML format.
 
+        truth_txt : str
+            Truth TXT file with authors' classifications of gender { female | male },
+            must follow the DB_AUTHORPROF task TXT format.
+        '''
         # Open the truth file
         with open(truth_txt) as f:
             lines = f.read().splitlines()
 
-        # Iterates over the lines, and reads each author's XML file adding the documents to the list
+        # Iterates over the lines, and reads each author's XML file yielding its documents
         for line in lines:
-            author_id, gender = line.split(separator)
-            author_xml = documents_xml_folder + author_id + '.xml'
-
-            # Open the author XML file
-            tree_author = ET.parse(str(author_xml),
-                                   parser=ET.XMLParser(encoding="utf-8"))
-            root_author = tree_author.getroot()
-
-            number = 1
-            for child in root_author[0]:
-                document = {'id': str(author_id + '-' + str(number)),
-                            'author_id': str(author_id),
-                            'gender': str(gender), 'class': str(gender),
-                            'text': child.text
-                            }
-                if append_class_to_id:
-                    document['id'] += str(':' + str(document['class']))
-                number = number + 1
-                documents.append(document)
-
-        return documents
+            yield from parse_author_documents('authorprof', documents_xml_folder, line,
+                                              append_class_to_id)
 
     def get_documents_DB_BOTGENDER(self,
                                    documents_xml_folder='db_botgender/en/',
@@ -270,38 +895,60 @@ class IndexToolManager:
             Truth TXT file with authors' classifications of kind {bot | human} and gender { bot | female | male },
             must follow the DB_BOTGENDER task TXT format.
         '''
-        documents = []
+        return list(self.iter_documents_DB_BOTGENDER(documents_xml_folder, truth_txt,
+                                                     append_class_to_id))
 
-        lines = []
-        separator = ':::'
+    def iter_documents_DB_BOTGENDER(self,
+                                    documents_xml_folder='db_botgender/en/',
+                                    truth_txt='db_authorprof/truth.txt',
+                                    append_class_to_id=False):
+        '''
+        Yields the documents from DB_BOTGENDER formatted files,
+        one author XML file is parsed at a time.
+
+        Parameters
+        ----------
+        documents_xml_folder : str
+            Folder that contains the XML files from the authors' documents (twits),
+            must follow the DB_BOTGENDER task XML format.
 
+        truth_txt : str
+            Truth TXT file with authors' classifications of kind {bot | human} and gender { bot | female | male },
+            must follow the DB_BOTGENDER task TXT format.
+        '''
         # Open the truth file
         with open(truth_txt) as f:
             lines = f.read().splitlines()
 
-        # Iterates over the lines, and reads each author's XML file adding the documents to the list
+        # Iterates over the lines, and reads each author's XML file yielding its documents
         for line in lines:
-            author_id, kind, gender = line.split(separator)
-            author_xml = documents_xml_folder + author_id + '.xml'
-
-            # Open the author XML file
-            tree_author = ET.parse(str(author_xml),
-                                   parser=ET.XMLParser(encoding="utf-8"))
-            root_author = tree_author.getroot()
-
-            number = 1
-            for child in root_author[0]:
-                document = {'id': str(author_id + '-' + str(number)),
-                            'author_id': str(author_id),
-                            'kind': str(kind), 'gender': str(gender),
-                            'text': child.text, 'class': str(kind),
-                            }
-                if append_class_to_id:
-                    document['id'] += str(':' + str(document['class']))
-                number = number + 1
-                documents.append(document)
+            yield from parse_author_documents('botgender', documents_xml_folder, line,
+                                              append_class_to_id)
+
+    def iter_xml_articles(self, xml_file, encoding=None):
+        '''
+        Yields the <article> elements of a DB_HYPERPARTISAN XML file using iterparse,
+        each article is cleared (and detached from the root) after being used,
+        so the memory used does not grow with the size of the file.
 
-        return documents
+        Parameters
+        ----------
+        xml_file : str
+            XML file name, the file must have articles surrounded by <article> tags.
+
+        encoding : str
+            Encoding that overrides the one declared by the XML file.
+        '''
+        parser = ET.XMLParser(encoding=encoding) if encoding is not None else None
+        root = None
+        for event, elem in ET.iterparse(str(xml_file), events=('start', 'end'), parser=parser):
+            if root is None:
+                root = elem
+            if event == 'end' and elem.tag == 'article' and elem is not root:
+                yield elem
+                elem.clear()
+                # The processed articles are the only children of the root
+                root.clear()
 
     def get_documents_DB_HYPERPARTISAN(self,
                                        articles_xml='db_hyperpartisan/articles.xml',
@@ -320,24 +967,36 @@ class IndexToolManager:
             Articles ground truth XML file with articles surrounded by <article> tags,
             must follow the DB_HYPERPARTISAN task XML format.
         '''
+        return list(self.iter_documents_DB_HYPERPARTISAN(articles_xml, ground_truth_xml,
+                                                         append_class_to_id))
+
+    def iter_documents_DB_HYPERPARTISAN(self,
+                                        articles_xml='db_hyperpartisan/articles.xml',
+                                        ground_truth_xml='db_hyperpartisan/ground_truth.xml',
+                                        append_class_to_id=False):
+        '''
+        Yields the documents from DB_HYPERPARTISAN formatted files,
+        both XML files are parsed incrementally.
 
-        documents = []
-        # Openning the XML files
-        tree_articles = ET.parse(str(articles_xml),
-                                 parser=ET.XMLParser(encoding="utf-8"))
-        root_articles = tree_articles.getroot()
-        tree_ground_truth = ET.parse(str(ground_truth_xml))
-        root_ground_truth = tree_ground_truth.getroot()
+        Parameters
+        ----------
+        articles_xml : str
+            Articles XML file name, the file must have articles surrounded by <article> tags,
+            must follow the DB_HYPERPARTISAN task XML format.
 
-        for a_child, g_child in zip(root_articles, root_ground_truth):
+        ground_truth_xml : str
+            Articles ground truth XML file with articles surrounded by <article> tags,
+            must follow the DB_HYPERPARTISAN task XML format.
+        '''
+        for a_child, g_child in zip(self.iter_xml_articles(articles_xml, "utf-8"),
+                                    self.iter_xml_articles(ground_truth_xml)):
             document = {**a_child.attrib, **g_child.attrib,
                         'text': str(self.get_text_from_child(a_child)),
                         'class': str(g_child.get('hyperpartisan')),
                         }
             if append_class_to_id:
                 document['id'] += str(':' + str(document['class']))
-            documents.append(document)
-        return documents
+            yield document
 
     def get_documents_DB_HYPERPARTISAN_split(self,
                                              articles_xml='db_hyperpartisan/articles.xml',
@@ -356,27 +1015,35 @@ class IndexToolManager:
             Articles ground truth XML file with articles surrounded by <article> tags,
             must follow the DB_HYPERPARTISAN task XML format.
         '''
+        return list(self.iter_documents_DB_HYPERPARTISAN_split(articles_xml, ground_truth_xml,
+                                                               append_class_to_id))
 
-        df = pd.read_csv('db_hyperpartisan/train_set.csv', dtype=str)
+    def iter_documents_DB_HYPERPARTISAN_split(self,
+                                              articles_xml='db_hyperpartisan/articles.xml',
+                                              ground_truth_xml='db_hyperpartisan/ground_truth.xml',
+                                              append_class_to_id=False):
+        '''
+        Yields the documents from DB_HYPERPARTISAN formatted files
+        that are in the train split (db_hyperpartisan/train_set.csv).
 
-        documents = []
-        # Openning the XML files
-        tree_articles = ET.parse(str(articles_xml),
-                                 parser=ET.XMLParser(encoding="utf-8"))
-        root_articles = tree_articles.getroot()
-        tree_ground_truth = ET.parse(str(ground_truth_xml))
-        root_ground_truth = tree_ground_truth.getroot()
+        Parameters
+        ----------
+        articles_xml : str
+            Articles XML file name, the file must have articles surrounded by <article> tags,
+            must follow the DB_HYPERPARTISAN task XML format.
 
-        for a_child, g_child in zip(root_articles, root_ground_truth):
-            document = {**a_child.attrib, **g_child.attrib,
-                        'text': str(self.get_text_from_child(a_child)),
-                        'class': str(g_child.get('hyperpartisan')),
-                        }
-            if (df['0'].str.contains(document['id']).any()):
+        ground_truth_xml : str
+            Articles ground truth XML file with articles surrounded by <article> tags,
+            must follow the DB_HYPERPARTISAN task XML format.
+        '''
+
+        train_ids = load_split_ids('db_hyperpartisan/train_set.csv')
+
+        for document in self.iter_documents_DB_HYPERPARTISAN(articles_xml, ground_truth_xml):
+            if (split_id_key(document['id']) in train_ids):
                 if append_class_to_id:
                     document['id'] += str(':' + str(document['class']))
-                documents.append(document)
-        return documents
+                yield document
 
     def calc_IR(self, result_df, positive_class='true'):
         '''
@@ -391,7 +1058,7 @@ class IndexToolManager:
 
         Parameters
         ----------
-        result_df : DataFrame
+        result_df : DataFrame or QueryResult
             A query result dataframe produced by the query methods.
             Must have the columns:
                 * score
@@ -400,104 +1067,704 @@ class IndexToolManager:
         positive_class : str
             Specifies which 'class' is the positive class.
         '''
-        df = result_df.copy()
-        CLASS_0 = df.loc[(df['class'] != positive_class)]['score']
-        CLASS_1 = df.loc[(df['class'] == positive_class)]['score']
+        if isinstance(result_df, QueryResult):
+            scores = result_df.scores.astype(np.float64)
+            positive = result_df.classes == self.result_class_codes.get(str(positive_class), -1)
+        else:
+            scores = result_df['score'].to_numpy(dtype=np.float64)
+            positive = (result_df['class'] == positive_class).to_numpy(dtype=bool)
+        CLASS_0 = scores[~positive]
+        CLASS_1 = scores[positive]
         attrib_IR = {
-            'CLASS_0_BM25_AVG': (0 if math.isnan(CLASS_0.mean())
-                                 else CLASS_0.mean()),
-            'CLASS_0_BM25_COUNT': CLASS_0.count(),
+            'CLASS_0_BM25_AVG': (CLASS_0.mean() if len(CLASS_0) > 0
+                                 else 0),
+            'CLASS_0_BM25_COUNT': len(CLASS_0),
             'CLASS_0_BM25_SUM': CLASS_0.sum(),
-            'CLASS_1_BM25_AVG': (0 if math.isnan(CLASS_1.mean())
-                                 else CLASS_1.mean()),
-            'CLASS_1_BM25_COUNT': CLASS_1.count(),
+            'CLASS_1_BM25_AVG': (CLASS_1.mean() if len(CLASS_1) > 0
+                                 else 0),
+            'CLASS_1_BM25_COUNT': len(CLASS_1),
             'CLASS_1_BM25_SUM': CLASS_1.sum(),
         }
         return attrib_IR
 
-    def initializeArango(self):
+    def calc_IR_per_class(self, scores, class_codes, n_classes):
         '''
-        Initialize ArangoDB with the specific parameters used by the repository,
-        also sets it up to the research, creating the collection and view needed.
+        Calculates the BM25 average, count and sum of every class for many
+        queries at once, returns a NumPy array of shape (n_queries, n_classes, 3).
 
         Parameters
         ----------
-        none :
-            none
-        '''
-
-        # Initialize the ArangoDB client.
-        self.arangoClient = ArangoClient(hosts='http://localhost:8529')
-
-        # Connect to "_system" database as root user.
-        # This returns an API wrapper for "_system" database.
-        self.arango_sys_db = self.arangoClient.db(
-            '_system', username=None, password=None)
+        scores : array
+            Matrix (n_queries, top_k) with the scores of the results of each query,
+            NaN where a query has less than top_k results.
 
-        index_name = self.indexName
-        # Create a new database named "test" if it does not exist.
-        if not self.arango_sys_db .has_database(index_name):
-            self.arango_sys_db .create_database(index_name)
+        class_codes : array
+            Matrix (n_queries, top_k) with the class code (0 to n_classes-1)
+            of each result, negative codes are ignored.
 
-        # Connect to "test" database as root user.
-        # This returns an API wrapper for "test" database.
-        self.arangoDb = self.arangoClient.db(
-            index_name, username=None, password=None)
+        n_classes : int
+            Number of classes.
+        '''
+        scores = np.asarray(scores, dtype=np.float64)
+        class_codes = np.asarray(class_codes)
+        valid = ~np.isnan(scores) & (class_codes >= 0)
+        one_hot = (class_codes[..., None] == np.arange(n_classes)) & valid[..., None]
+        counts = one_hot.sum(axis=1).astype(np.float64)
+        sums = np.einsum('qk,qkc->qc', np.where(valid, scores, 0.0), one_hot)
+        averages = np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)
+        return np.stack([averages, counts, sums], axis=2)
 
-        db = self.arangoDb
-        # Create a new collection named "students" if it does not exist.
-        # This returns an API wrapper for "students" collection.
-        if db.has_collection(index_name):
-            self.arangoCollection = db.collection(index_name)
-        else:
-            self.arangoCollection = db.create_collection(index_name)
+    def calc_IR_batch(self, scores, classes, positive_class='true'):
+        '''
+        Vectorized calc_IR, calculates the IR attributes of many queries at once,
+        returns a NumPy array of shape (n_queries, 6), columns in the IR_VARIABLE_NAMES order.
 
-        # Retrieve list of views.
-        view_list = db.views()
+        Parameters
+        ----------
+        scores : array
+            Matrix (n_queries, top_k) with the scores of the results of each query,
+            NaN where a query has less than top_k results.
 
-        # Creates the view used by the Analyzer to Search and use BM25
-        self.arangoViewName = str('v_' + index_name)
-        if not view_list:
-            db.create_view(
-                name=self.arangoViewName,
-                view_type='arangosearch',
-                properties={
-                    'cleanupIntervalStep': 0,
-                    'consolidationIntervalMsec': 0,
-                    'writebufferSizeMax': 0,
-                    'links': {
-                        index_name: {
-                            "analyzers": [
-                                "text_en"
-                            ],
-                            "includeAllFields": True,
-                            "storeValues": 'id'
-                        }
-                    }
-                }
-            )
+        classes : array
+            Matrix (n_queries, top_k) with the class of each result.
 
-        # Configure AQL query cache properties
-        db.aql.cache.configure(mode='off', max_results=100000)
+        positive_class : str
+            Specifies which 'class' is the positive class.
+        '''
+        scores = np.asarray(scores, dtype=np.float64)
+        class_codes = (np.asarray(classes, dtype=object) == positive_class).astype(np.int64)
+        class_codes[np.isnan(scores)] = -1
+        return self.calc_IR_per_class(scores, class_codes, 2).reshape(len(scores), 6)
 
-    def arango_delete(self, databases):
+    def results_to_matrix(self, results, n_columns=None):
         '''
-        Deletes the databases from ArangoDB.
+        Pads a list of query result DataFrames into a (n_queries, n_columns) score matrix,
+        with NaN where a query has less results, and a class matrix with None padding.
 
         Parameters
         ----------
-        databases : list
-            String list of the database names.
+        results : list
+            Query result DataFrames or QueryResults produced by the query methods.
+
+        n_columns : int
+            Number of columns of the matrices, defaults to the size of the largest result.
+        '''
+        if n_columns is None:
+            n_columns = max([len(result_df) for result_df in results] + [0])
+        scores = np.full((len(results), n_columns), np.nan)
+        classes = np.full((len(results), n_columns), None, dtype=object)
+        class_names = np.array(self.result_class_names + [None], dtype=object)
+        for i, result_df in enumerate(results):
+            n = min(len(result_df), n_columns)
+            if isinstance(result_df, QueryResult):
+                scores[i, :n] = result_df.scores[:n]
+                classes[i, :n] = class_names[result_df.classes[:n]]
+            else:
+                scores[i, :n] = result_df['score'].to_numpy(dtype=np.float64)[:n]
+                classes[i, :n] = result_df['class'].to_numpy(dtype=object)[:n]
+        return scores, classes
+
+    def calc_IR_results(self, results, positive_class='true', class_names=None):
+        '''
+        Calculates the IR variables of a list of query results, returns a NumPy array
+        of shape (len(results), 6), columns in the IR_VARIABLE_NAMES order, or of shape
+        (len(results), 3 * len(class_names)) when class_names is given.
+
+        Parameters
+        ----------
+        results : list
+            Query result DataFrames or QueryResults produced by the query methods.
+
+        positive_class : str
+            Specifies which 'class' is the positive class.
+
+        class_names : list
+            Classes used for the per class IR variables, e.g. ['bot', 'female', 'male'].
         '''
+        scores, classes = self.results_to_matrix(results)
+        if class_names is None:
+            return self.calc_IR_batch(scores, classes, positive_class)
 
-        for db in databases:
-            # Delete database named 'db' if it does exist.
-            if self.arango_sys_db.has_database(str(db)):
-                self.arango_sys_db.delete_database(str(db))
+        class_index = {str(cl): i for i, cl in enumerate(class_names)}
+        class_codes = np.array([[class_index.get(cl, -1) for cl in row] for row in classes],
+                               dtype=np.int64).reshape(classes.shape)
+        return self.calc_IR_per_class(scores, class_codes, len(class_names)).reshape(len(results), -1)
 
-    def insertArango(self, itemKey, itemBody):
+    def make_query_result(self, scores, doc_ids, classes):
         '''
-        Inserts a document in the ArangoDB 'indexName' collection.
+        Builds a QueryResult, interning the classes and document ids
+        in the tables of this manager.
+
+        Parameters
+        ----------
+        scores : list
+            Scores of the results, in decreasing order.
+
+        doc_ids : list
+            Document ids of the results.
+
+        classes : list
+            Classes of the results.
+        '''
+        class_codes = self.result_class_codes
+        doc_ordinals = self.result_doc_ordinals
+        n = len(scores)
+        class_array = np.empty(n, dtype=np.int16)
+        doc_array = np.empty(n, dtype=np.int64)
+        for i, (doc_id, cl) in enumerate(zip(doc_ids, classes)):
+            cl = str(cl)
+            code = class_codes.get(cl)
+            if code is None:
+                code = class_codes[cl] = len(self.result_class_names)
+                self.result_class_names.append(cl)
+            class_array[i] = code
+            doc_id = str(doc_id)
+            ordinal = doc_ordinals.get(doc_id)
+            if ordinal is None:
+                ordinal = doc_ordinals[doc_id] = len(self.result_doc_ids)
+                self.result_doc_ids.append(doc_id)
+            doc_array[i] = ordinal
+        return QueryResult(np.asarray(scores, dtype=np.float32), class_array, doc_array,
+                           self.result_class_names, self.result_doc_ids)
+
+    def make_result(self, item_list, as_arrays=False):
+        '''
+        Builds the result of a query from a list of [score, id, class],
+        a QueryResult when as_arrays is True, a Pandas DataFrame otherwise.
+        '''
+        if not as_arrays:
+            return pd.DataFrame(item_list, columns=['score', 'id', 'class'])
+        return self.make_query_result([item[0] for item in item_list],
+                                      [item[1] for item in item_list],
+                                      [item[2] for item in item_list])
+
+    def prepare_query(self, query):
+        '''
+        Query preprocessing shared by every tool: tokenizes the query once, collapses
+        the repeated terms into one term with its frequency in the query, drops the
+        stopwords (drop_stopwords) and keeps the query_max_terms terms with the largest IDF.
+        Returns the list of (term, qtf) pairs, in order of first occurrence.
+
+        Parameters
+        ----------
+        query : str
+            Text to be queried.
+        '''
+        counts = Counter(tokenize_text(query))
+        terms = [(term, qtf) for term, qtf in counts.items()
+                 if not (self.drop_stopwords and term in english_stopwords)]
+        if self.query_max_terms is not None and len(terms) > int(self.query_max_terms):
+            idf = self.query_idf([term for term, _ in terms])
+            kept = np.sort(np.argsort(-idf, kind='stable')[:int(self.query_max_terms)])
+            terms = [terms[i] for i in kept]
+        return terms
+
+    def query_idf(self, terms):
+        '''
+        IDF of the query terms in the local BM25 index of the collection, used to select
+        the terms of the compact queries. The terms missing from the index can not match
+        any document, they get -inf and are the first ones left out.
+        '''
+        if self.local_postings_ptr is None:
+            if not os.path.exists(self.local_index_path()):
+                raise FileNotFoundError(
+                    f'query_max_terms needs the IDF of the local index {self.local_index_path()}'
+                    + ', build it with local_index')
+            self.local_load()
+        term_ids = np.array([self.local_vocabulary.get(term, -1) for term in terms], dtype=np.int64)
+        return np.where(term_ids >= 0, self.local_idf[term_ids], -np.inf)
+
+    def compact_query(self, query):
+        '''
+        Text form of the prepared query sent to the tools, each term once. When bm25_k3
+        is not 0 a term is repeated as in the query, for the tools that apply k3
+        themselves. Returns the query unchanged if compact_queries is False.
+        '''
+        if not self.compact_queries:
+            return query
+        if self.bm25_k3 == 0:
+            return ' '.join(term for term, _ in self.prepare_query(query))
+        return ' '.join(' '.join([term] * qtf) for term, qtf in self.prepare_query(query))
+
+    def query_groups(self, query):
+        '''
+        Groups the terms of the prepared query by their BM25 k3 query weight,
+        returns the (weight, text) list sorted by decreasing weight.
+        '''
+        groups = {}
+        for term, qtf in self.prepare_query(query):
+            groups.setdefault(float(self.local_query_weight(qtf)), []).append(term)
+        return [(weight, ' '.join(groups[weight])) for weight in sorted(groups, reverse=True)]
+
+    def cache_key(self, tool, query, ignore_first_result=False, exclude_ids=None):
+        '''
+        Builds the IR results cache key of a query for the current index and parameters.
+        '''
+        if (tool == 'local' and self.local_approximate()):
+            # Approximate local results must not be mixed with the exact ones
+            tool = f'local~{self.local_max_terms}~{self.local_term_mass}'
+        if self.compact_queries:
+            tool = f'{tool}~compact~{self.query_max_terms}~{int(self.drop_stopwords)}'
+        return self.irCache.make_key(tool, self.indexName, query,
+                                     self.bm25_k1, self.bm25_b, self.bm25_k3,
+                                     self.numberResults, ignore_first_result,
+                                     self.exclusion_keys(exclude_ids))
+
+    def exclusion_keys(self, exclude_ids):
+        '''
+        Normalizes the exclude_ids argument of the queries (None, an id or a list of ids)
+        to a sorted list of document ids without the ':class' suffix.
+        '''
+        if exclude_ids is None:
+            return []
+        if isinstance(exclude_ids, str):
+            exclude_ids = [exclude_ids]
+        return sorted(set(str(doc_id).split(':')[0] for doc_id in exclude_ids))
+
+    def batch_exclusion_keys(self, queries, exclude_ids):
+        '''
+        Normalizes the exclude_ids argument of the batch queries,
+        a list with the excluded ids of each query (or None), to a list of exclusion_keys.
+        '''
+        if exclude_ids is None:
+            return [[] for _ in queries]
+        if len(exclude_ids) != len(queries):
+            raise ValueError('exclude_ids must have one item per query')
+        return [self.exclusion_keys(ids) for ids in exclude_ids]
+
+    def drop_excluded(self, item_list, exclude):
+        '''
+        Removes the [score, id, class] items of the excluded documents from a result
+        that was over-fetched by len(exclude), keeping at most top_k items.
+        Used by the tools that can not filter the documents while ranking.
+        '''
+        if not exclude:
+            return item_list
+        exclude = set(exclude)
+        return [item for item in item_list
+                if str(item[1]).split(':')[0] not in exclude][:int(self.numberResults)]
+
+    def cache_get(self, key, as_arrays=False):
+        '''
+        Returns the cached result (DataFrame or QueryResult) of the key,
+        or None when it is not cached.
+        '''
+        item_list = self.irCache.get(key)
+        if item_list is None:
+            return None
+        if as_arrays:
+            return self.make_query_result([item[2] for item in item_list],
+                                          [item[0] for item in item_list],
+                                          [item[1] for item in item_list])
+        return pd.DataFrame([[score, doc_id, cl] for doc_id, cl, score in item_list],
+                            columns=['score', 'id', 'class'])
+
+    def cache_put(self, key, result_df):
+        '''
+        Stores a result (DataFrame or QueryResult) in the cache as a list of [id, class, score].
+        '''
+        if isinstance(result_df, QueryResult):
+            items = zip(result_df.scores.tolist(), result_df.ids(), result_df.labels())
+        else:
+            items = zip(result_df['score'], result_df['id'], result_df['class'])
+        self.irCache.put(key, [[str(doc_id), str(cl), float(score)]
+                               for score, doc_id, cl in items])
+
+    def cached_query(self, tool, query, ignore_first_result, query_function, as_arrays=False,
+                     exclude_ids=None):
+        '''
+        Returns the result of a query, calling query_function only
+        when the IR results cache is disabled or does not have the query.
+
+        Parameters
+        ----------
+        tool : str
+            Tool used to run the query { arango | elastic | zettair | local }.
+
+        query : str
+            Text to be queried.
+
+        query_function : function
+            Function without arguments that runs the query in the tool.
+
+        as_arrays : bool
+            Return cached results as QueryResult, must match the query_function result type.
+
+        exclude_ids : list
+            Ids of the documents excluded by query_function, part of the cache key.
+        '''
+        if self.irCache is None:
+            return query_function()
+        key = self.cache_key(tool, query, ignore_first_result, exclude_ids)
+        result_df = self.cache_get(key, as_arrays=as_arrays)
+        if result_df is None:
+            result_df = query_function()
+            self.cache_put(key, result_df)
+        return result_df
+
+    def get_IR_variables_batch(self, texts, tool='elastic', positive_class='true',
+                               ignore_first_result=False, class_names=None, exclude_ids=None):
+        '''
+        Query a list of texts in as few requests as the tool allows,
+        returns a NumPy array of shape (len(texts), 6) with the IR variables
+        of each text, columns in the IR_VARIABLE_NAMES order.
+        When class_names is given, returns a (len(texts), 3 * len(class_names)) array
+        instead, with the BM25 AVG, COUNT and SUM of each class in that order.
+
+        Parameters
+        ----------
+        texts : list
+            Texts to be queried using BM25.
+
+        tool : str
+            Tool used to run the queries { arango | elastic | zettair | local }.
+
+        positive_class : str
+            Specifies which 'class' is the positive class.
+
+        class_names : list
+            Classes used for the per class IR variables, e.g. ['bot', 'female', 'male'].
+
+        exclude_ids : list
+            Ids of the documents excluded from the results of each text, e.g. the id of
+            the text itself when it is part of the index (see the *_query methods).
+        '''
+        texts = list(texts)
+        exclude_ids = self.batch_exclusion_keys(texts, exclude_ids)
+        results = [None] * len(texts)
+        keys = [None] * len(texts)
+        if self.irCache is not None:
+            for i, text in enumerate(texts):
+                keys[i] = self.cache_key(tool, text, ignore_first_result, exclude_ids[i])
+                results[i] = self.cache_get(keys[i], as_arrays=True)
+        missing = [i for i, result_df in enumerate(results) if result_df is None]
+        missing_texts = [texts[i] for i in missing]
+        missing_exclude = [exclude_ids[i] for i in missing]
+
+        if (len(missing) == 0):
+            missing_results = []
+        elif (tool == 'arango'):
+            missing_results = self.arango_query_batch(
+                missing_texts, ignore_first_result=ignore_first_result, as_arrays=True,
+                exclude_ids=missing_exclude)
+        elif (tool == 'elastic'):
+            missing_results = self.elastic_query_batch(
+                missing_texts, ignore_first_result=ignore_first_result, as_arrays=True,
+                exclude_ids=missing_exclude)
+        elif (tool == 'zettair'):
+            missing_results = self.zettair_query_batch(
+                missing_texts, ignore_first_result=ignore_first_result, as_arrays=True,
+                exclude_ids=missing_exclude)
+        elif (tool == 'local'):
+            missing_results = self.local_query_many(
+                missing_texts, ignore_first_result=ignore_first_result, as_arrays=True,
+                exclude_ids=missing_exclude)
+        else:
+            raise ValueError(f'Unknown tool: {tool}')
+
+        for i, result_df in zip(missing, missing_results):
+            results[i] = result_df
+            if self.irCache is not None:
+                self.cache_put(keys[i], result_df)
+
+        return self.calc_IR_results(results, positive_class, class_names)
+
+    def calc_IR_aggregate(self, ir_array):
+        '''
+        Aggregates the IR variables of many queries (e.g. all the tweets of an author)
+        into a single vector: the mean of the BM25 AVG columns and the sum of the
+        BM25 COUNT and SUM columns, in the same column order.
+
+        Parameters
+        ----------
+        ir_array : array
+            Matrix (n_queries, 3 * n_classes) produced by get_IR_variables_batch.
+        '''
+        ir_array = np.asarray(ir_array, dtype=np.float64)
+        per_class = ir_array.reshape(len(ir_array), ir_array.shape[1] // 3, 3)
+        if len(per_class) == 0:
+            return np.zeros(ir_array.shape[1])
+        aggregate = per_class.sum(axis=0)
+        aggregate[:, 0] /= len(per_class)
+        return aggregate.reshape(-1)
+
+    def get_IR_variables_author(self, texts, tool='elastic', positive_class='true',
+                                ignore_first_result=False, class_names=None, exclude_ids=None):
+        '''
+        Author mode: queries all the texts of an author at once, returns a NumPy array with
+        the aggregated IR variables of the author (see calc_IR_aggregate), the same vector
+        given by averaging and summing the IR variables of each text.
+        The local index scores all the texts in one pass sharing the postings lookups
+        (local_score_many), the other tools receive them in batched requests.
+
+        Parameters
+        ----------
+        texts : list
+            Texts of the author to be queried using BM25.
+
+        tool : str
+            Tool used to run the queries { arango | elastic | zettair | local }.
+
+        positive_class : str
+            Specifies which 'class' is the positive class.
+
+        exclude_ids : list
+            Ids of the documents excluded from the results of each text.
+        '''
+        return self.calc_IR_aggregate(self.get_IR_variables_batch(
+            texts, tool, positive_class, ignore_first_result=ignore_first_result,
+            class_names=class_names, exclude_ids=exclude_ids))
+
+    def manifest_path(self, tool):
+        '''
+        Path of the content hash manifest of the index in a tool.
+        '''
+        return self.root_path + str(self.indexName) + '.' + str(tool) + '.manifest.tsv'
+
+    def load_manifest(self, tool):
+        '''
+        Loads the manifest of the index in a tool, returns a dict
+        key -> (indexed id, content hash), empty when there is no manifest.
+        The key is the document id without the ':class' suffix.
+        '''
+        manifest = {}
+        path = self.manifest_path(tool)
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    key, doc_id, content_hash = line.rstrip('\n').split('\t')
+                    manifest[key] = (doc_id, content_hash)
+        return manifest
+
+    def save_manifest(self, tool, manifest):
+        path = self.manifest_path(tool)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            for key, (doc_id, content_hash) in manifest.items():
+                f.write(f'{key}\t{doc_id}\t{content_hash}\n')
+        os.replace(path + '.tmp', path)
+
+    def document_hash(self, document):
+        '''
+        Content hash of a document, all its fields (text, class, metadata) are hashed.
+        '''
+        return hashlib.sha1(json.dumps(document, sort_keys=True, default=str)
+                            .encode('utf-8')).hexdigest()
+
+    def manifest_entry(self, document):
+        '''
+        Returns the manifest (key, (id, content hash)) of a document.
+        '''
+        return (str(document['id']).split(':')[0],
+                (str(document['id']), self.document_hash(document)))
+
+    def record_manifest(self, bulkItems, manifest, timer=None):
+        '''
+        Passes the bulk items through, adding their entries to the manifest dict,
+        used to write the manifest of a full indexation.
+        If timer (a dict) is given, the seconds spent hashing are added to timer['manifest'].
+        '''
+        for document in bulkItems:
+            start = time.time()
+            key, entry = self.manifest_entry(document)
+            manifest[key] = entry
+            if timer is not None:
+                timer['manifest'] = timer.get('manifest', 0.0) + time.time() - start
+            yield document
+
+    def upsert_documents(self, bulkItems, tool='arango', delete_missing=False):
+        '''
+        Incremental indexing: compares the bulk items with the manifest of the index
+        in the tool and only sends the new and changed documents, returns a dict with
+        the number of documents added, updated, deleted and unchanged.
+
+        Parameters
+        ----------
+        bulkItems : iterable
+            Bulk items to be indexed, must contain the 'id', 'text' and 'class' fields.
+
+        tool : str
+            Tool of the index { arango | elastic | zettair | local }.
+
+        delete_missing : bool
+            bulkItems is the whole database, the indexed documents missing from it are deleted.
+        '''
+        manifest = self.load_manifest(tool)
+        stats = {'added': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0}
+        changed = []
+        remove_ids = []
+        seen = set()
+        for document in bulkItems:
+            key, entry = self.manifest_entry(document)
+            seen.add(key)
+            previous = manifest.get(key)
+            if previous is not None and previous[1] == entry[1]:
+                stats['unchanged'] += 1
+                continue
+            if previous is None:
+                stats['added'] += 1
+            else:
+                stats['updated'] += 1
+                if previous[0] != str(document['id']):
+                    # The id changed (e.g. its ':class' suffix), the old one is removed
+                    remove_ids.append(previous[0])
+            changed.append(dict(document))
+            manifest[key] = entry
+        if delete_missing:
+            for key in [key for key in manifest if key not in seen]:
+                remove_ids.append(manifest.pop(key)[0])
+                stats['deleted'] += 1
+
+        if len(changed) > 0 or len(remove_ids) > 0:
+            self.update_index(tool, changed, remove_ids)
+        self.save_manifest(tool, manifest)
+        return stats
+
+    def delete_documents(self, doc_ids, tool='arango'):
+        '''
+        Deletes documents from the index in a tool and from its manifest.
+
+        Parameters
+        ----------
+        doc_ids : list
+            Ids of the documents to be deleted.
+
+        tool : str
+            Tool of the index { arango | elastic | zettair | local }.
+        '''
+        manifest = self.load_manifest(tool)
+        remove_ids = []
+        for doc_id in doc_ids:
+            previous = manifest.pop(str(doc_id).split(':')[0], None)
+            remove_ids.append(previous[0] if previous is not None else str(doc_id))
+        self.update_index(tool, [], remove_ids)
+        self.save_manifest(tool, manifest)
+
+    def update_index(self, tool, documents, remove_ids):
+        '''
+        Sends the documents to be added or replaced and the ids to be removed to a tool.
+        '''
+        if (tool == 'arango'):
+            self.arango_update(documents, remove_ids)
+        elif (tool == 'elastic'):
+            self.elastic_update(documents, remove_ids)
+        elif (tool == 'zettair'):
+            self.zettair_update(documents, remove_ids)
+        elif (tool == 'local'):
+            self.local_update(documents, remove_ids)
+        else:
+            raise ValueError(f'Unknown tool: {tool}')
+
+    def initializeArango(self):
+        '''
+        Initialize ArangoDB with the specific parameters used by the repository,
+        also sets it up to the research, creating the collection and view needed.
+        In query only mode it just connects to the existing database and collection.
+
+        Parameters
+        ----------
+        none :
+            none
+        '''
+
+        # Initialize the ArangoDB client.
+        self.arangoClient = ArangoClient(hosts='http://localhost:8529')
+
+        # Connect to "_system" database as root user.
+        # This returns an API wrapper for "_system" database.
+        self.arango_sys_db = self.arangoClient.db(
+            '_system', username=None, password=None)
+
+        index_name = self.indexName
+        self.arangoViewName = str('v_' + index_name)
+        if self.query_only:
+            self.arangoDb = self.arangoClient.db(
+                index_name, username=None, password=None)
+            self.arangoCollection = self.arangoDb.collection(index_name)
+            return
+
+        # Create a new database named "test" if it does not exist.
+        if not self.arango_sys_db .has_database(index_name):
+            self.arango_sys_db .create_database(index_name)
+
+        # Connect to "test" database as root user.
+        # This returns an API wrapper for "test" database.
+        self.arangoDb = self.arangoClient.db(
+            index_name, username=None, password=None)
+
+        db = self.arangoDb
+        # Create a new collection named "students" if it does not exist.
+        # This returns an API wrapper for "students" collection.
+        if db.has_collection(index_name):
+            self.arangoCollection = db.collection(index_name)
+        else:
+            self.arangoCollection = db.create_collection(index_name)
+
+        # Retrieve list of views.
+        view_list = db.views()
+
+        # Creates the view used by the Analyzer to Search and use BM25
+        if not view_list:
+            db.create_view(
+                name=self.arangoViewName,
+                view_type='arangosearch',
+                properties={
+                    'cleanupIntervalStep': 0,
+                    'consolidationIntervalMsec': 0,
+                    'writebufferSizeMax': 0,
+                    'links': self.arango_view_links()
+                }
+            )
+
+        # Configure AQL query cache properties
+        db.aql.cache.configure(mode='off', max_results=100000)
+
+    def arango_view_links(self):
+        '''
+        Links of the ArangoSearch view, the collection fields analyzed with text_en.
+        '''
+        return {
+            self.indexName: {
+                "analyzers": [
+                    "text_en"
+                ],
+                "includeAllFields": True,
+                "storeValues": 'id'
+            }
+        }
+
+    def arango_unlink_view(self):
+        '''
+        Removes the collection link of the view, so ArangoSearch does not
+        index the documents while they are imported.
+        '''
+        self.arangoDb.update_view(self.arangoViewName,
+                                  {'links': {self.indexName: None}})
+
+    def arango_link_view(self):
+        '''
+        Links the collection to the view, ArangoSearch indexes all its documents once.
+        '''
+        self.arangoDb.update_view(self.arangoViewName,
+                                  {'links': self.arango_view_links()})
+
+    def arango_delete(self, databases):
+        '''
+        Deletes the databases from ArangoDB.
+
+        Parameters
+        ----------
+        databases : list
+            String list of the database names.
+        '''
+
+        for db in databases:
+            # Delete database named 'db' if it does exist.
+            if self.arango_sys_db.has_database(str(db)):
+                self.arango_sys_db.delete_database(str(db))
+
+    def insertArango(self, itemKey, itemBody):
+        '''
+        Inserts a document in the ArangoDB 'indexName' collection.
 
         Parameters
         ----------
@@ -546,6 +1813,152 @@ class IndexToolManager:
 
         return documentList
 
+    def bulkGeneratorArango(self, bulkItems):
+        '''
+        Generator version of bulkListGeneratorArango, yields the documents
+        ready to import to the ArangoDB collection without copying the list.
+
+        Parameters
+        ----------
+        bulkItems : iterable
+            Bulk items to be processed, must contain an 'id' field.
+        '''
+        for item in bulkItems:
+            document = dict(item)
+            document['_key'] = document.pop('id')
+            yield document
+
+    def bulkImportArangoStream(self, bulkItems, batch_size=10000):
+        '''
+        Bulk import to ArangoDB collection from an iterable of bulk items,
+        importing batch_size documents at a time, returns the number of documents imported.
+
+        Parameters
+        ----------
+        bulkItems : iterable
+            Bulk items to be imported, must contain an 'id' field.
+
+        batch_size : int
+            Number of documents sent in each import request.
+        '''
+        total = 0
+        batch = []
+        for document in self.bulkGeneratorArango(bulkItems):
+            batch.append(document)
+            if len(batch) >= batch_size:
+                self.bulkImportArango(batch)
+                total += len(batch)
+                batch = []
+        if len(batch) > 0:
+            self.bulkImportArango(batch)
+            total += len(batch)
+        return total
+
+    def arango_update(self, documents, remove_ids=()):
+        '''
+        Adds or replaces documents and removes documents by id in the ArangoDB collection.
+
+        Parameters
+        ----------
+        documents : list
+            Documents to be added or replaced, must contain an 'id' field.
+
+        remove_ids : list
+            Ids of the documents to be removed.
+        '''
+        if len(remove_ids) > 0:
+            self.arangoCollection.delete_many([{'_key': str(doc_id)} for doc_id in remove_ids])
+        if len(documents) > 0:
+            self.arangoCollection.import_bulk(list(self.bulkGeneratorArango(documents)),
+                                              on_duplicate='replace', halt_on_error=False)
+
+    def bulkImportArangoBatch(self, documentList, retries=3, backoff=1.0):
+        '''
+        Imports a batch of documents to the ArangoDB collection, retrying the whole batch
+        (with exponential backoff) when the request fails, returns the import result.
+        Documents rejected by the server are counted in the result 'errors', not retried.
+
+        Parameters
+        ----------
+        documentList : list of dicts
+            Documents to be imported, every document must have an '_key' field.
+
+        retries : int
+            Number of times a failed batch is sent again.
+
+        backoff : float
+            Seconds to wait before the first retry, doubled at each retry.
+        '''
+        for attempt in range(retries + 1):
+            try:
+                return self.arangoCollection.import_bulk(documentList, halt_on_error=False)
+            # Server and connection errors, anything else is a bug and is not retried
+            except (DocumentInsertError, ServerConnectionError, RequestsConnectionError):
+                if attempt == retries:
+                    raise
+                time.sleep(backoff * 2 ** attempt)
+
+    def bulkImportArangoConcurrent(self, bulkItems, batch_size=5000, workers=4,
+                                   retries=3, defer_view_links=True):
+        '''
+        Imports bulk items to the ArangoDB collection in batches of batch_size documents,
+        with up to workers batches being imported concurrently, returns a dict with the
+        number of documents created, errors, batches, seconds and documents per second.
+        At most 2 * workers batches are kept in memory, so bulkItems can be a generator.
+
+        Parameters
+        ----------
+        bulkItems : iterable
+            Bulk items to be imported, must contain an 'id' field.
+
+        batch_size : int
+            Number of documents sent in each import request.
+
+        workers : int
+            Number of concurrent import requests.
+
+        retries : int
+            Number of times a failed batch is sent again.
+
+        defer_view_links : bool
+            Unlinks the view during the import and links it afterwards,
+            so ArangoSearch indexes the collection only once.
+        '''
+        stats = {'documents': 0, 'errors': 0, 'batches': 0}
+
+        def collect(futures):
+            for future in futures:
+                result = future.result()
+                stats['documents'] += int(result.get('created', 0))
+                stats['errors'] += int(result.get('errors', 0))
+                stats['batches'] += 1
+
+        if defer_view_links:
+            self.arango_unlink_view()
+        initial = time.time()
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                pending = set()
+                batch = []
+                for document in self.bulkGeneratorArango(bulkItems):
+                    batch.append(document)
+                    if len(batch) >= batch_size:
+                        pending.add(executor.submit(self.bulkImportArangoBatch, batch, retries))
+                        batch = []
+                        if len(pending) >= 2 * workers:
+                            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                            collect(done)
+                if len(batch) > 0:
+                    pending.add(executor.submit(self.bulkImportArangoBatch, batch, retries))
+                collect(pending)
+        finally:
+            if defer_view_links:
+                self.arango_link_view()
+        stats['seconds'] = time.time() - initial
+        stats['docs_per_second'] = (stats['documents'] / stats['seconds']
+                                    if stats['seconds'] > 0 else 0.0)
+        return stats
+
     def bulkImportArango(self, documentList):
         '''
         Bulk import to ArangoDB collection.
@@ -562,46 +1975,75 @@ class IndexToolManager:
 
         self.arangoCollection.import_bulk(documentList)
 
-    def arango_query(self, query, ignore_first_result=False):
+    def arango_aql(self, name):
+        '''
+        Returns the AQL text of the named query of the current view, built once.
+        The texts, the excluded keys and the BM25 parameters are bind variables, so the
+        query text never changes and ArangoDB does not get a new query to parse per text.
+
+        Parameters
+        ----------
+        name : str
+            'query' (one text, @text) or 'batch' (a list of {text, exclude} objects, @queries).
+        '''
+        key = (name, self.arangoViewName)
+        if key not in self.arango_aql_templates:
+            search = (f"FOR d IN {str(self.arangoViewName)} SEARCH "
+                      + "ANALYZER(d.text IN TOKENS({text}, 'text_en'), 'text_en') "
+                      + "FILTER d._key NOT IN {exclude} "
+                      + "LET sco = BM25(d, @k1, @b) "
+                      + "SORT sco DESC LIMIT @limit "
+                      + "RETURN {{ id: d._key, class: d.class, score: sco }}")
+            if name == 'query':
+                aql = search.format(text='@text', exclude='@exclude_ids')
+            elif name == 'batch':
+                aql = ("FOR q IN @queries LET hits = ("
+                       + search.format(text='q.text', exclude='q.exclude')
+                       + ") RETURN hits")
+            else:
+                raise ValueError(f'Unknown AQL query: {name}')
+            self.arango_aql_templates[key] = aql
+        return self.arango_aql_templates[key]
+
+    def arango_bind_vars(self, **bind_vars):
+        '''
+        Bind variables of an arango_aql query, with the BM25 parameters.
+        '''
+        bind_vars.update({'k1': self.bm25_k1, 'b': self.bm25_b})
+        return bind_vars
+
+    def arango_query(self, query, ignore_first_result=False, as_arrays=False, exclude_ids=None):
         '''
         Query ArangoDB view and returns a Pandas DataFrame with the results.
+        The text is sent as a bind variable of the arango_aql('query') text, without escaping.
 
         Parameters
         ----------
         query : str
             Text to be queried to the view using BM25 analyzer.
-        '''
-        initial = time.time()
-        escaped_query = str(query).replace('\\', '')
-        escaped_query = str(escaped_query).replace("'", "\\\'")
 
+        as_arrays : bool
+            Return a QueryResult instead of a Pandas DataFrame.
+
+        exclude_ids : list
+            Keys of the documents filtered out of the results (e.g. the queried document).
+        '''
         nResults = int(self.numberResults)
         if ignore_first_result:
             nResults += 1
-        aqlquery = (f"FOR d IN {str(self.arangoViewName)} SEARCH "
-                    + f"ANALYZER(d.text IN TOKENS('{escaped_query}'"
-                    + f", 'text_en'), 'text_en') "
-                    + f"SORT BM25(d, {self.bm25_k1}, {self.bm25_b}) "
-                    + f"DESC LIMIT {nResults} "
-                    + f"LET sco = BM25(d, {self.bm25_k1}, "
-                    + f"{self.bm25_b}) RETURN {{ doc: d, score: sco }}")
-        # print(aqlquery)
-        cursor = self.arangoDb.aql.execute(query=aqlquery,
+        cursor = self.arangoDb.aql.execute(query=self.arango_aql('query'),
+                                           bind_vars=self.arango_bind_vars(
+                                               text=str(self.compact_query(query)),
+                                               exclude_ids=self.exclusion_keys(exclude_ids),
+                                               limit=nResults),
                                            count=True,
-                                           batch_size=self.numberResults,
+                                           batch_size=nResults,
                                            optimizer_rules=['+all'],
                                            cache=True)
-        item_list = []
-        # print(1, time.time()-initial)
-        initial = time.time()
-        for item in cursor.batch():
-            # print(item)
-            item_list.append([item['score'], item['doc']['_id'].split('/')[-1],
-                              item['doc']['class']])
-        # print(2, time.time()-initial)
+        item_list = [[item['score'], item['id'], item['class']] for item in cursor.batch()]
         if ignore_first_result and (len(item_list) > 0):
             item_list.pop(0)
-        return pd.DataFrame(item_list, columns=['score', 'id', 'class'])
+        return self.make_result(item_list, as_arrays)
 
     def arango_get_document(self, key):
         '''
@@ -615,7 +2057,8 @@ class IndexToolManager:
         result = self.arangoCollection.get(str(key))
         return result
 
-    def arango_get_IR_variables(self, query, positive_class='true', ignore_first_result=False):
+    def arango_get_IR_variables(self, query, positive_class='true', ignore_first_result=False,
+                                exclude_ids=None):
         '''
          Query ArangoDB view and returns a dict with the IR variables.
 
@@ -623,15 +2066,65 @@ class IndexToolManager:
         ----------
         query : str
             Text to be queried to the view using BM25 analyzer.
+
+        exclude_ids : list
+            Keys of the documents filtered out of the results (e.g. the queried document).
         '''
-        result_df = self.arango_query(query, ignore_first_result=ignore_first_result)
+        result_df = self.cached_query(
+            'arango', query, ignore_first_result,
+            lambda: self.arango_query(query, ignore_first_result=ignore_first_result,
+                                      as_arrays=True, exclude_ids=exclude_ids),
+            as_arrays=True, exclude_ids=exclude_ids)
 
         return self.calc_IR(result_df=result_df, positive_class=positive_class)
 
+    def arango_query_batch(self, queries, ignore_first_result=False, batch_size=100,
+                           as_arrays=False, exclude_ids=None):
+        '''
+        Query ArangoDB view with a list of queries, sending each batch of
+        queries as a single AQL query with a subquery per text.
+        Returns a list with one Pandas DataFrame per query.
+
+        Parameters
+        ----------
+        queries : list
+            Texts to be queried to the view using BM25 analyzer.
+
+        batch_size : int
+            Number of queries sent in each AQL query.
+
+        as_arrays : bool
+            Return QueryResults instead of Pandas DataFrames.
+
+        exclude_ids : list
+            Keys of the documents filtered out of the results of each query.
+        '''
+        nResults = int(self.numberResults)
+        if ignore_first_result:
+            nResults += 1
+        exclude_ids = self.batch_exclusion_keys(queries, exclude_ids)
+        results = []
+        for i in range(0, len(queries), batch_size):
+            batch = [{'text': str(self.compact_query(query)), 'exclude': exclude}
+                     for query, exclude in zip(queries[i:i + batch_size],
+                                               exclude_ids[i:i + batch_size])]
+            cursor = self.arangoDb.aql.execute(query=self.arango_aql('batch'),
+                                               bind_vars=self.arango_bind_vars(
+                                                   queries=batch, limit=nResults),
+                                               optimizer_rules=['+all'])
+            for hits in cursor:
+                item_list = [[hit['score'], hit['id'], hit['class']]
+                             for hit in hits]
+                if ignore_first_result and (len(item_list) > 0):
+                    item_list.pop(0)
+                results.append(self.make_result(item_list, as_arrays))
+        return results
+
     def initializeElastic(self):
         '''
         Initialize Elasticsearch with the specific parameters used by the repository,
         setting it up to the research.
+        In query only mode the index is neither checked nor created.
 
         Parameters
         ----------
@@ -642,6 +2135,9 @@ class IndexToolManager:
         self.elasticClient = Elasticsearch(hosts='http://localhost:9200')
 
         self.elasticDocumentType = '_doc'
+        if self.query_only:
+            return
+
         body = {
             "settings": {
                 "number_of_shards": 1,
@@ -736,6 +2232,43 @@ class IndexToolManager:
 
         return bulkItems
 
+    def bulkHelperActionsElastic(self, bulkItems):
+        '''
+        Generator version of bulkHelperInsertGeneratorElastic, yields the
+        bulk helper actions one by one so they can be streamed to bulkHelperElastic.
+
+        Parameters
+        ----------
+        bulkItems : iterable
+            Bulk items to be processed, must contain an 'id' field.
+        '''
+        for item in bulkItems:
+            item['_index'] = self.indexName
+            item['_id'] = item.pop('id')
+            item['_type'] = self.elasticDocumentType
+            yield item
+
+    def elastic_update(self, documents, remove_ids=()):
+        '''
+        Adds or replaces documents and removes documents by id in the Elasticsearch index,
+        then refreshes it.
+
+        Parameters
+        ----------
+        documents : list
+            Documents to be added or replaced, must contain an 'id' field.
+
+        remove_ids : list
+            Ids of the documents to be removed.
+        '''
+        actions = [{'_op_type': 'delete', '_index': self.indexName, '_id': str(doc_id)}
+                   for doc_id in remove_ids]
+        actions.extend(self.bulkHelperActionsElastic(dict(document) for document in documents))
+        # Deleting a document that does not exist is not an error here
+        ElasticsearchHelpers.bulk(client=self.elasticClient, actions=actions,
+                                  index=self.indexName, raise_on_error=False)
+        self.refreshElastic()
+
     def bulkElastic(self, bulkBody):
         '''
         Bulk Elasticsearch operations.
@@ -772,6 +2305,64 @@ class IndexToolManager:
             chunk_size=500, max_chunk_bytes=1000*1024*1024)
         # print(r)
 
+    def bulkStreamElastic(self, bulkItems, thread_count=4, chunk_size=5000,
+                          max_chunk_bytes=10*1024*1024, queue_size=4):
+        '''
+        Streams bulk items to the Elasticsearch index with parallel_bulk, returns a dict
+        with the number of documents indexed, errors, seconds and documents per second.
+        The chunks are closed by max_chunk_bytes (chunk_size is only an upper bound),
+        so their size adapts to the size of the documents, and at most queue_size chunks
+        wait for the thread_count senders, so the items are generated as they are sent.
+        The index refresh and replicas are disabled during the load and restored afterwards.
+
+        Parameters
+        ----------
+        bulkItems : iterable
+            Bulk items to be indexed, must contain an 'id' field.
+
+        thread_count : int
+            Number of threads sending bulk requests.
+
+        chunk_size : int
+            Maximum number of documents of a bulk request.
+
+        max_chunk_bytes : int
+            Maximum size of a bulk request in bytes.
+
+        queue_size : int
+            Number of chunks waiting to be sent.
+        '''
+        settings = self.elasticClient.indices.get_settings(index=self.indexName)
+        index_settings = settings[self.indexName]['settings']['index']
+        previous = {'refresh_interval': index_settings.get('refresh_interval', None),
+                    'number_of_replicas': index_settings.get('number_of_replicas', 1)}
+        self.elasticClient.indices.put_settings(index=self.indexName,
+                                                body={'index': {'refresh_interval': '-1',
+                                                                'number_of_replicas': 0}})
+        documents = 0
+        errors = 0
+        initial = time.time()
+        try:
+            for ok, info in ElasticsearchHelpers.parallel_bulk(
+                    client=self.elasticClient,
+                    actions=self.bulkHelperActionsElastic(bulkItems),
+                    thread_count=thread_count, chunk_size=chunk_size,
+                    max_chunk_bytes=max_chunk_bytes, queue_size=queue_size,
+                    raise_on_error=False, index=self.indexName):
+                if ok:
+                    documents += 1
+                else:
+                    errors += 1
+        finally:
+            # refresh_interval None restores the default
+            self.elasticClient.indices.put_settings(index=self.indexName,
+                                                    body={'index': previous})
+        seconds = time.time() - initial
+        return {'documents': documents,
+                'errors': errors,
+                'seconds': seconds,
+                'docs_per_second': (documents / seconds if seconds > 0 else 0.0)}
+
     def refreshElastic(self):
         '''
         Refresh Elasticsearch indices.
@@ -782,7 +2373,32 @@ class IndexToolManager:
         '''
         self.elasticClient.indices.refresh(index=self.indexName)
 
-    def elastic_query(self, query, ignore_first_result=False):
+    def elastic_match(self, query):
+        '''
+        Builds the match query of a text. The compact queries with several
+        k3 query weights have one match per weight, boosted by it.
+        '''
+        if not self.compact_queries:
+            return {"match": {"text": str(query).replace("'", " ")}}
+        groups = self.query_groups(query)
+        if len(groups) <= 1:
+            # A bool query without clauses would match every document
+            return {"match": {"text": groups[0][1] if groups else ''}}
+        return {"bool": {"should": [{"match": {"text": {"query": text, "boost": weight}}}
+                                    for weight, text in groups]}}
+
+    def elastic_query_body(self, query, exclude=()):
+        '''
+        Builds the match query of a text, with a must_not ids filter
+        when there are excluded documents (it does not change the scores).
+        '''
+        match = self.elastic_match(query)
+        if not exclude:
+            return match
+        return {"bool": {"must": match,
+                         "must_not": {"ids": {"values": list(exclude)}}}}
+
+    def elastic_query(self, query, ignore_first_result=False, as_arrays=False, exclude_ids=None):
         '''
         Query Elasticsearch index, returns a Pandas DataFrame with the results.
 
@@ -791,23 +2407,21 @@ class IndexToolManager:
         query : str
             Text to be queried to the index using BM25 similarity
             implemented by Elasticsearch.
+
+        as_arrays : bool
+            Return a QueryResult instead of a Pandas DataFrame.
+
+        exclude_ids : list
+            Ids of the documents filtered out of the results (e.g. the queried document).
         '''
-        # escaped_query = str(query).replace('\\', '')
-        # escaped_query = str(query).replace('"', '\\\"')
-        # escaped_query = json.JSONEncoder.encode(query)
-        escaped_query = str(query).replace("'", " ")
-        # escaped_query = str(query).replace("\\", "\'")
-        # escaped_query = query
-        # print('text\n\n\n\n\nHERE')
-        # print(escaped_query)        
         nResults = int(self.numberResults)
         if ignore_first_result:
             nResults += 1
         result = self.elasticClient.search(index=self.indexName,
                                            body={
-                                               "query": {"match": {
-                                                   "text": escaped_query}
-                                               }
+                                               "query": self.elastic_query_body(
+                                                   query,
+                                                   self.exclusion_keys(exclude_ids))
                                            },
                                            size=nResults)
         hit_list = []
@@ -816,7 +2430,7 @@ class IndexToolManager:
                 [hit['_score'], hit['_id'], hit['_source']['class']])
         if ignore_first_result and (len(hit_list) > 0):
             hit_list.pop(0)
-        return pd.DataFrame(hit_list, columns=['score', 'id', 'class'])
+        return self.make_result(hit_list, as_arrays)
 
     def elastic_get_document(self, id):
         '''
@@ -831,7 +2445,8 @@ class IndexToolManager:
                                                id=str(id))
         return result
 
-    def elastic_get_IR_variables(self, query, positive_class='true', ignore_first_result=False):
+    def elastic_get_IR_variables(self, query, positive_class='true', ignore_first_result=False,
+                                 exclude_ids=None):
         '''
         Query Elasticsearch index, returns a dict with the IR variables.
 
@@ -840,21 +2455,116 @@ class IndexToolManager:
         query : str
             Text to be queried to the index using BM25 similarity
             implemented by Elasticsearch.
+
+        exclude_ids : list
+            Ids of the documents filtered out of the results (e.g. the queried document).
         '''
-        result_df = self.elastic_query(query, ignore_first_result=ignore_first_result)
+        result_df = self.cached_query(
+            'elastic', query, ignore_first_result,
+            lambda: self.elastic_query(query, ignore_first_result=ignore_first_result,
+                                       as_arrays=True, exclude_ids=exclude_ids),
+            as_arrays=True, exclude_ids=exclude_ids)
 
         return self.calc_IR(result_df=result_df, positive_class=positive_class)
 
+    def elastic_query_batch(self, queries, ignore_first_result=False, batch_size=100,
+                            as_arrays=False, exclude_ids=None):
+        '''
+        Query Elasticsearch index with a list of queries using the
+        multi search API, each batch of queries is a single request.
+        Returns a list with one Pandas DataFrame per query.
+
+        Parameters
+        ----------
+        queries : list
+            Texts to be queried to the index using BM25 similarity
+            implemented by Elasticsearch.
+
+        batch_size : int
+            Number of queries sent in each _msearch request.
+
+        as_arrays : bool
+            Return QueryResults instead of Pandas DataFrames.
+
+        exclude_ids : list
+            Ids of the documents filtered out of the results of each query.
+        '''
+        nResults = int(self.numberResults)
+        if ignore_first_result:
+            nResults += 1
+        exclude_ids = self.batch_exclusion_keys(queries, exclude_ids)
+        results = []
+        for i in range(0, len(queries), batch_size):
+            body = []
+            for query, exclude in zip(queries[i:i + batch_size], exclude_ids[i:i + batch_size]):
+                body.append({})
+                body.append({"query": self.elastic_query_body(query, exclude),
+                             "size": nResults})
+            response = self.elasticClient.msearch(body=body, index=self.indexName)
+            for result in response['responses']:
+                if 'error' in result:
+                    raise RuntimeError(f'Elasticsearch msearch error: {result["error"]}')
+                hit_list = [[hit['_score'], hit['_id'], hit['_source']['class']]
+                            for hit in result['hits']['hits']]
+                if ignore_first_result and (len(hit_list) > 0):
+                    hit_list.pop(0)
+                results.append(self.make_result(hit_list, as_arrays))
+        return results
+
     def initializeZettair(self):
         print('')
 
     def saveToTrecFileZettair(self, bulkItems):
         filename = str(self.indexName) + '.txt'
         f = open(filename, "w+")
+        # The id -> class sidecar is written in the same pass, bulkItems may be a generator
+        f_classes = open(self.class_table_path(), 'w', encoding='utf-8')
 
         for d in bulkItems:
             f.write(f'<DOC>\n<DOCNO>{d["id"]}</DOCNO>\n{d["text"]}\n</DOC>\n')
+            f_classes.write(f'{str(d["id"]).split(":")[0]}\t{d["class"]}\n')
         f.close()
+        f_classes.close()
+        self.doc_classes = None
+
+    def class_table_path(self, index_name=None):
+        '''
+        Path of the id -> class sidecar file of an index.
+        '''
+        if index_name is None:
+            index_name = self.indexName
+        return self.root_path + str(index_name) + '.classes.tsv'
+
+    def load_class_table(self):
+        '''
+        Loads the id -> class sidecar file of the index into memory,
+        the table starts empty when the file does not exist.
+        '''
+        self.doc_classes = {}
+        path = self.class_table_path()
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    doc_id, _, cl = line.rstrip('\n').partition('\t')
+                    self.doc_classes[doc_id] = cl
+
+    def document_class(self, doc_id):
+        '''
+        Returns the class of a document from the id -> class table, documents
+        missing from it are fetched from Elasticsearch once and then remembered.
+
+        Parameters
+        ----------
+        doc_id : str
+            Document id.
+        '''
+        if self.doc_classes is None:
+            self.load_class_table()
+        cl = self.doc_classes.get(doc_id)
+        if cl is None:
+            cl = self.elastic_get_document(str(doc_id))['class']
+            self.doc_classes[doc_id] = cl
+        return cl
 
     def zettair_index(self):
         trecfile = str(self.indexName) + '.txt'
@@ -870,7 +2580,231 @@ class IndexToolManager:
         # p.terminate()
         print(res)
 
-    def zettair_query(self, query, interactive=True, ignore_first_result=False):
+    def zettair_update(self, documents, remove_ids=()):
+        '''
+        Zettair can not update an index in place, so the TREC file (and the id -> class
+        sidecar) is rewritten without the removed and replaced documents, the new
+        documents are appended and the Zettair index is rebuilt from it.
+        The XML files of the database are not parsed again.
+
+        Parameters
+        ----------
+        documents : list
+            Documents to be added or replaced, must contain the 'id', 'text' and 'class' fields.
+
+        remove_ids : list
+            Ids of the documents to be removed.
+        '''
+        drop = set(str(doc_id).split(':')[0] for doc_id in remove_ids)
+        drop.update(str(d['id']).split(':')[0] for d in documents)
+        trecfile = str(self.indexName) + '.txt'
+        classesfile = self.class_table_path()
+
+        with open(trecfile + '.tmp', 'w') as f:
+            if os.path.exists(trecfile):
+                with open(trecfile, 'r') as f_old:
+                    keep = True
+                    for line in f_old:
+                        if line.startswith('<DOCNO>'):
+                            docno = line[len('<DOCNO>'):].split('</DOCNO>')[0]
+                            keep = docno.split(':')[0] not in drop
+                            if keep:
+                                f.write('<DOC>\n')
+                        if keep and line != '<DOC>\n':
+                            f.write(line)
+            for d in documents:
+                f.write(f'<DOC>\n<DOCNO>{d["id"]}</DOCNO>\n{d["text"]}\n</DOC>\n')
+        os.replace(trecfile + '.tmp', trecfile)
+
+        with open(classesfile + '.tmp', 'w', encoding='utf-8') as f:
+            if os.path.exists(classesfile):
+                with open(classesfile, 'r', encoding='utf-8') as f_old:
+                    for line in f_old:
+                        if line.split('\t')[0] not in drop:
+                            f.write(line)
+            for d in documents:
+                f.write(f'{str(d["id"]).split(":")[0]}\t{d["class"]}\n')
+        os.replace(classesfile + '.tmp', classesfile)
+        self.doc_classes = None
+
+        # The running zet processes have the old index open
+        self.zettair_close_pools()
+        if self.zettair_query_process is not None:
+            self.zettair_query_process.kill()
+            self.zettair_query_process = None
+        self.zettair_index()
+
+    def zettair_start_process(self, nResults):
+        '''
+        Starts the interactive Zettair query process, if it is not running.
+        A process retrieving another number of results is restarted.
+
+        Parameters
+        ----------
+        nResults : int
+            Number of results to be retrieved by each query.
+        '''
+        if (self.zettair_query_process is not None
+                and self.zettair_query_n_results != nResults):
+            self.zettair_query_process.kill()
+            self.zettair_query_process = None
+        if (self.zettair_query_process is None):
+            self.zettair_query_n_results = nResults
+            self.zettair_query_process = subprocess.Popen(self.zettair_command(nResults),
+                                                          stdin=subprocess.PIPE,
+                                                          stdout=subprocess.PIPE,
+                                                          stderr=subprocess.PIPE)
+
+    def zettair_command(self, nResults):
+        '''
+        Command line of the interactive Zettair query process.
+        '''
+        return ['zet', '-f', self.root_path + self.indexName,
+                '-n', str(nResults),
+                '--okapi', f'--b={self.bm25_b}',
+                f'--k1={self.bm25_k1}',
+                f'--k3={self.bm25_k3}',
+                '--summary=none',
+                '--big-and-fast']
+
+    def zettair_get_pool(self, nResults):
+        '''
+        Returns the ZettairWorkerPool that retrieves nResults per query, starting it if needed.
+        '''
+        if nResults not in self.zettair_pools:
+            self.zettair_pools[nResults] = ZettairWorkerPool(
+                self.zettair_command(nResults), n_workers=self.zettair_workers,
+                timeout=self.zettair_timeout)
+        return self.zettair_pools[nResults]
+
+    def zettair_close_pools(self):
+        for pool in self.zettair_pools.values():
+            pool.close()
+        self.zettair_pools = {}
+
+    def zettair_hits_to_result(self, hits, ignore_first_result=False, as_arrays=False,
+                               exclude=()):
+        '''
+        Builds the result of a query from the (docno, score) list of a ZettairWorker,
+        the class is taken from the docno (id:class) or from the id -> class table.
+        The hits of the excluded documents are removed (see drop_excluded).
+        '''
+        res_list = []
+        for docno, score in hits:
+            stuff = docno.split(':')
+            cur_id = stuff[0]
+            if (len(stuff) > 1):
+                cl = stuff[1]
+            else:
+                cl = self.document_class(cur_id)
+            res_list.append([score, cur_id, cl])
+        if ignore_first_result and (len(res_list) > 0):
+            res_list.pop(0)
+        return self.make_result(self.drop_excluded(res_list, exclude), as_arrays)
+
+    def zettair_query_pool(self, queries, ignore_first_result=False, as_arrays=False,
+                           exclude_ids=None):
+        '''
+        Query Zettair index with a list of queries using the ZettairWorkerPool,
+        the queries are spread round-robin among its processes.
+        Returns a list with one Pandas DataFrame (or QueryResult, if as_arrays) per query.
+
+        Parameters
+        ----------
+        queries : list
+            Texts to be queried to the index using BM25 metric.
+
+        exclude_ids : list
+            Ids of the documents removed from the results of each query.
+        '''
+        exclude_ids = self.batch_exclusion_keys(queries, exclude_ids)
+        nResults = int(self.numberResults)
+        if ignore_first_result:
+            nResults += 1
+        # Zettair can not filter documents, enough extra results are retrieved
+        # to remove the excluded ones afterwards
+        nResults += max([len(exclude) for exclude in exclude_ids], default=0)
+        pool = self.zettair_get_pool(nResults)
+        hits_list = pool.query_many([self.zettair_escape_query(query) for query in queries])
+        return [self.zettair_hits_to_result(hits, ignore_first_result, as_arrays, exclude)
+                for hits, exclude in zip(hits_list, exclude_ids)]
+
+    def zettair_escape_query(self, query):
+        '''
+        Escapes a query to be written to the interactive Zettair process,
+        returns it as a single line.
+        '''
+        escaped_query = str(self.compact_query(query)).replace('\\', '')
+        escaped_query = str(escaped_query).replace('"', ' ')
+        escaped_query = str(escaped_query).replace('`', '\\`')
+        escaped_query = str(escaped_query).replace("'", " ")
+        escaped_query = "'" + escaped_query + "'"
+        escaped_query = str(escaped_query).replace('\n', ' ')
+        return escaped_query
+
+    def zettair_read_line(self):
+        '''
+        Reads a line of the interactive Zettair process, raises ZettairWorkerError
+        (and forgets the process, so the next query starts a new one) if it exited.
+        '''
+        process = self.zettair_query_process
+        fl = process.stdout.readline()
+        if fl == b'':
+            self.zettair_query_process = None
+            process.kill()
+            code = process.wait()
+            err = process.stderr.read().decode('utf-8', errors='replace').strip()
+            raise ZettairWorkerError(f'Zettair exited with code {code}: {err}')
+        return fl
+
+    def zettair_read_response(self):
+        '''
+        Reads the response of one query from the interactive Zettair process,
+        returns the result lines.
+        '''
+        lines = []
+        fl = self.zettair_read_line()
+        while len(fl.decode('utf-8').split()) > 7:
+            # print(fl)
+            fl = self.zettair_read_line()
+        # print(fl.decode('utf-8').split('>'))
+        lines.append(fl.decode('utf-8').split('>')[1])
+        while fl != b'\n' and fl != b'> \n':
+            fl = self.zettair_read_line()
+            lines.append(fl.decode('utf-8'))
+        return lines
+
+    def zettair_parse_lines(self, lines, ignore_first_result=False, as_arrays=False,
+                            exclude=()):
+        '''
+        Extracts the id, class and score of the Zettair result lines,
+        returns a Pandas DataFrame (or a QueryResult, if as_arrays) with the results.
+        The lines of the excluded documents are removed (see drop_excluded).
+        '''
+        res_list = []
+        len_lines = len(lines)
+        # if not (len_lines <= 2 and lines[0] == ' '):
+        if (len_lines > 2 and (not lines[0] == ' ')):
+            for line in lines:
+                line_split = line.split()
+                if (len(line_split) >= 4):
+                    stuff = line_split[1].split(':')
+                    cur_id = stuff[0]
+                    # print(f'stuff: {stuff}')
+                    if (len(stuff) > 1):
+                        cl = stuff[1]
+                    else:
+                        cl = self.document_class(cur_id)
+                    score = line_split[3].split(',')[0]
+                    # cl = 'true'
+                    res_list.append(
+                        [float(score), cur_id, cl])
+        if ignore_first_result and (len(res_list) > 0):
+            res_list.pop(0)
+        return self.make_result(self.drop_excluded(res_list, exclude), as_arrays)
+
+    def zettair_query(self, query, interactive=True, ignore_first_result=False,
+                      as_arrays=False, exclude_ids=None):
         '''
         Query Zettair index, returns a Pandas DataFrame with the results.
 
@@ -878,64 +2812,37 @@ class IndexToolManager:
         ----------
         query : str
             Text to be queried to the index using BM25 metric.
+
+        as_arrays : bool
+            Return a QueryResult instead of a Pandas DataFrame.
+
+        exclude_ids : list
+            Ids of the documents removed from the results (e.g. the queried document),
+            len(exclude_ids) extra results are retrieved to replace them.
         '''
-        escaped_query = str(query).replace('\\', '')
-        escaped_query = str(escaped_query).replace('"', ' ')
-        escaped_query = str(escaped_query).replace('`', '\\`')
-        nResults = int(self.numberResults)
+        exclude = self.exclusion_keys(exclude_ids)
+        nResults = int(self.numberResults) + len(exclude)
         if ignore_first_result:
             nResults += 1
-        if (self.zettair_query_process is None):
-            self.zettair_query_process = subprocess.Popen(['zet',  '-f',
-                                                           self.root_path + self.indexName,
-                                                           '-n', str(nResults),
-                                                           '--okapi', f'--b={self.bm25_b}',
-                                                           f'--k1={self.bm25_k1}',
-                                                           f'--k3={self.bm25_k3}',
-                                                           '--summary=none',
-                                                           '--big-and-fast'],
-                                                          stdin=subprocess.PIPE,
-                                                          stdout=subprocess.PIPE,
-                                                          stderr=subprocess.PIPE)
         # print(escaped_query)
         # p.terminate()
         out = ''
         lines = []
-        if interactive:
-            escaped_query = str(escaped_query).replace("'", " ")
-            escaped_query = "'" + escaped_query + "'"
-            # out, err = self.zettair_query_process.communicate(
-            #     escaped_query.encode('utf-8'))
-            # out = out.decode('utf-8')
-            # print(out.decode('utf-8'))
-            escaped_query = str(escaped_query).replace('\n', ' ')
+        if interactive and self.zettair_workers > 0:
+            return self.zettair_query_pool([query], ignore_first_result, as_arrays,
+                                           [exclude])[0]
+        elif interactive:
+            self.zettair_start_process(nResults)
+            escaped_query = self.zettair_escape_query(query)
             # print(escaped_query)
             self.zettair_query_process.stdin.write(
                 escaped_query.encode('utf-8') + b'\n')
-            # self.zettair_query_process.stdin.write(escaped_query+'\n')
             self.zettair_query_process.stdin.flush()
-            # print(escaped_query)
-            fl = self.zettair_query_process.stdout.readline()
-            while len(fl.decode('utf-8').split()) > 7:
-                # print(fl)
-                fl = self.zettair_query_process.stdout.readline()
-            # print(fl.decode('utf-8').split('>'))
-            lines.append(fl.decode('utf-8').split('>')[1])
-            while fl != b'\n' and fl != b'> \n':
-                fl = self.zettair_query_process.stdout.readline()
-                self.zettair_query_process.stdout.flush()
-                if not self.zettair_query_process.poll() is None:
-                    print('POOL\n', self.zettair_query_process.poll())
-                    err = self.zettair_query_process.stderr.readline()
-                    if err != "":
-                        print('ERROR\n', err)
-                lines.append(fl.decode('utf-8'))
-            # for line in iter(self.zettair_query_process.stdout.readline, b'\n'):
-            #     lines.append(line.decode('utf-8'))
-            #     self.zettair_query_process.stdout.flush()
-            #     # print(line)
-            # print('END')
+            lines = self.zettair_read_response()
         else:
+            escaped_query = str(self.compact_query(query)).replace('\\', '')
+            escaped_query = str(escaped_query).replace('"', ' ')
+            escaped_query = str(escaped_query).replace('`', '\\`')
             escaped_query = '"' + escaped_query + '"'
             cmd = f'zet -f {self.root_path}{self.indexName} -n {str(nResults)} --okapi ' + \
                 f'--b={self.bm25_b} --k1={self.bm25_k1} --k3={self.bm25_k3} ' + \
@@ -957,29 +2864,32 @@ class IndexToolManager:
                 else:  # breaks after first blank line, next line is the summary
                     break
         # Iterates over the lines, extracts the id and score
-        res_list = []
-        len_lines = len(lines)
-        # if not (len_lines <= 2 and lines[0] == ' '):
-        if (len_lines > 2 and (not lines[0] == ' ')):
-            for line in lines:
-                line_split = line.split()
-                if (len(line_split) >= 4):
-                    stuff = line_split[1].split(':')
-                    cur_id = stuff[0]
-                    # print(f'stuff: {stuff}')
-                    if (len(stuff) > 1):
-                        cl = stuff[1]
-                    else:
-                        cl = self.elastic_get_document(str(cur_id))['class']
-                    score = line_split[3].split(',')[0]
-                    # cl = 'true'
-                    res_list.append(
-                        [float(score), cur_id, cl])
-        if ignore_first_result and (len(res_list) > 0):
-            res_list.pop(0)
-        return pd.DataFrame(res_list, columns=['score', 'id', 'class'])
+        return self.zettair_parse_lines(lines, ignore_first_result, as_arrays, exclude)
+
+    def zettair_query_batch(self, queries, ignore_first_result=False, as_arrays=False,
+                            exclude_ids=None):
+        '''
+        Query Zettair index with a list of queries in interactive sessions,
+        returns a list with one Pandas DataFrame per query.
+        The queries run on the ZettairWorkerPool (a single process when zettair_workers
+        is 0), whose workers write the queries while reading the responses, time out
+        and are restarted when zet exits.
+
+        Parameters
+        ----------
+        queries : list
+            Texts to be queried to the index using BM25 metric.
+
+        as_arrays : bool
+            Return QueryResults instead of Pandas DataFrames.
+
+        exclude_ids : list
+            Ids of the documents removed from the results of each query.
+        '''
+        return self.zettair_query_pool(queries, ignore_first_result, as_arrays, exclude_ids)
 
-    def zettair_get_IR_variables(self, query, positive_class='true', interactive=True, ignore_first_result=False):
+    def zettair_get_IR_variables(self, query, positive_class='true', interactive=True, ignore_first_result=False,
+                                 exclude_ids=None):
         '''
         Query Zettair index, returns a dict with the IR variables.
 
@@ -987,8 +2897,15 @@ class IndexToolManager:
         ----------
         query : str
             Text to be queried to the index using BM25 metric.
+
+        exclude_ids : list
+            Ids of the documents removed from the results (e.g. the queried document).
         '''
-        result_df = self.zettair_query(query, interactive, ignore_first_result=ignore_first_result)
+        result_df = self.cached_query(
+            'zettair', query, ignore_first_result,
+            lambda: self.zettair_query(query, interactive, ignore_first_result=ignore_first_result,
+                                       as_arrays=True, exclude_ids=exclude_ids),
+            as_arrays=True, exclude_ids=exclude_ids)
 
         return self.calc_IR(result_df=result_df, positive_class=positive_class)
 
@@ -1007,6 +2924,756 @@ class IndexToolManager:
         #     if self.arango_sys_db.has_database(str(db)):
         #         self.arango_sys_db.delete_database(str(db))
 
+    def local_index_path(self, index_name=None):
+        '''
+        Returns the path of the file that stores the local BM25 index.
+
+        Parameters
+        ----------
+        index_name : str
+            Name of the index, defaults to the current 'indexName'.
+        '''
+        if index_name is None:
+            index_name = self.indexName
+        return self.root_path + str(index_name) + '.local.npz'
+
+    def local_index(self, bulkItems):
+        '''
+        Builds the in-process BM25 index and saves it to disk.
+        The postings are kept in CSR form: the postings of the term 't' are
+        the positions local_postings_ptr[t] to local_postings_ptr[t+1] of the
+        document ordinals and term frequencies arrays.
+
+        Parameters
+        ----------
+        bulkItems : list
+            Bulk items to be indexed, must contain the 'id', 'text' and 'class' fields.
+        '''
+        vocabulary = {}
+        term_array, doc_array, tf_array, doc_ids, doc_classes, doc_len = \
+            self.local_postings(bulkItems, vocabulary)
+        self.local_build(vocabulary, term_array, doc_array, tf_array,
+                         doc_ids, doc_classes, doc_len)
+
+    def local_postings(self, bulkItems, vocabulary, first_ordinal=0):
+        '''
+        Tokenizes the bulk items, returns the (term, document, tf) postings in COO form
+        and the ids, classes and lengths of the documents.
+        New terms are added to the vocabulary dict, the documents are numbered from first_ordinal.
+        '''
+        doc_ids = []
+        doc_classes = []
+        doc_len = []
+        term_list = []
+        tf_list = []
+        doc_list = []
+
+        for item in bulkItems:
+            doc_ordinal = first_ordinal + len(doc_ids)
+            tokens = tokenize_text(item['text'])
+            counts = Counter(tokens)
+            for term, tf in counts.items():
+                term_id = vocabulary.setdefault(term, len(vocabulary))
+                term_list.append(term_id)
+                tf_list.append(tf)
+            doc_list.extend([doc_ordinal] * len(counts))
+            doc_ids.append(str(item['id']))
+            doc_classes.append(str(item['class']))
+            doc_len.append(len(tokens))
+
+        return (np.array(term_list, dtype=np.int64), np.array(doc_list, dtype=np.int32),
+                np.array(tf_list, dtype=np.int64), doc_ids, doc_classes, doc_len)
+
+    def local_build(self, vocabulary, term_array, doc_array, tf_array,
+                    doc_ids, doc_classes, doc_len):
+        '''
+        Builds the CSR postings from postings in COO form and saves the index.
+        The postings of each term must be in increasing document order in the COO arrays.
+        '''
+        # Stable sort keeps the documents of each term in increasing order
+        order = np.argsort(term_array, kind='stable')
+        postings_docs = doc_array[order].astype(np.int32)
+        postings_tf = np.minimum(tf_array[order],
+                                 np.iinfo(np.uint16).max).astype(np.uint16)
+        postings_ptr = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        postings_ptr[1:] = np.cumsum(
+            np.bincount(term_array, minlength=len(vocabulary)))
+
+        class_names, doc_class = np.unique(
+            np.array(doc_classes, dtype=str), return_inverse=True)
+        terms = np.array(sorted(vocabulary, key=vocabulary.get), dtype=str)
+
+        self.local_save(terms, postings_ptr, postings_docs, postings_tf,
+                        np.array(doc_len, dtype=np.int32),
+                        np.array(doc_ids, dtype=str),
+                        doc_class.astype(np.int16), class_names)
+
+    def local_update(self, documents=(), remove_ids=()):
+        '''
+        Updates the local BM25 index without tokenizing the documents already indexed:
+        the postings are expanded to COO form, the postings of the removed (and replaced)
+        documents are dropped, the postings of the new documents are appended and
+        the CSR arrays are rebuilt.
+
+        Parameters
+        ----------
+        documents : list
+            Documents to be added or replaced, must contain the 'id', 'text' and 'class' fields.
+
+        remove_ids : list
+            Ids of the documents to be removed.
+        '''
+        if not os.path.exists(self.local_index_path()):
+            self.local_index(documents)
+            return
+        if self.local_postings_ptr is None:
+            self.local_load()
+
+        documents = list(documents)
+        drop = set(str(doc_id) for doc_id in remove_ids)
+        drop.update(str(document['id']) for document in documents)
+        keep = ~np.isin(self.local_doc_ids, np.array(sorted(drop), dtype=str))
+        # New ordinals of the kept documents
+        new_ordinal = np.cumsum(keep) - 1
+
+        df = np.diff(self.local_postings_ptr)
+        old_terms = np.repeat(np.arange(len(df), dtype=np.int64), df)
+        kept_postings = keep[self.local_postings_docs]
+
+        vocabulary = dict(self.local_vocabulary)
+        term_array, doc_array, tf_array, doc_ids, doc_classes, doc_len = \
+            self.local_postings(documents, vocabulary, first_ordinal=int(keep.sum()))
+
+        self.local_build(
+            vocabulary,
+            np.concatenate([old_terms[kept_postings], term_array]),
+            np.concatenate([new_ordinal[self.local_postings_docs[kept_postings]], doc_array]),
+            np.concatenate([self.local_postings_tf[kept_postings].astype(np.int64), tf_array]),
+            self.local_doc_ids[keep].tolist() + doc_ids,
+            self.local_class_names[self.local_doc_class[keep]].tolist() + doc_classes,
+            self.local_doc_len[keep].tolist() + doc_len)
+
+    def local_save(self, terms, postings_ptr, postings_docs, postings_tf,
+                   doc_len, doc_ids, doc_class, class_names):
+        '''
+        Saves the local BM25 index arrays in a compressed NumPy file.
+        The document ordinals are stored as gaps inside each postings list,
+        which are small numbers and compress much better than the ordinals.
+        '''
+        postings_gaps = np.diff(postings_docs, prepend=0).astype(np.int32)
+        starts = postings_ptr[:-1][postings_ptr[:-1] < postings_ptr[1:]]
+        postings_gaps[starts] = postings_docs[starts]
+
+        np.savez_compressed(self.local_index_path(),
+                            terms=terms, postings_ptr=postings_ptr,
+                            postings_gaps=postings_gaps,
+                            postings_tf=postings_tf, doc_len=doc_len,
+                            doc_ids=doc_ids, doc_class=doc_class,
+                            class_names=class_names)
+        self.local_postings_ptr = None
+
+    def local_load(self):
+        '''
+        Loads the local BM25 index from disk, decoding the postings and
+        precomputing the IDF and the document length normalization
+        for the current BM25 parameters.
+        '''
+        with np.load(self.local_index_path()) as data:
+            terms = data['terms']
+            postings_ptr = data['postings_ptr']
+            postings_gaps = data['postings_gaps']
+            self.local_postings_tf = data['postings_tf']
+            self.local_doc_len = data['doc_len']
+            self.local_doc_ids = data['doc_ids']
+            self.local_doc_class = data['doc_class']
+            self.local_class_names = data['class_names']
+
+        # Undo the gaps: cumulative sum restarted at the beginning of each postings list
+        df = np.diff(postings_ptr)
+        cumulative = np.cumsum(postings_gaps, dtype=np.int64)
+        starts = postings_ptr[:-1][df > 0]
+        base = cumulative[starts] - postings_gaps[starts]
+        self.local_postings_docs = (cumulative - np.repeat(base, df[df > 0])
+                                    ).astype(np.int32)
+
+        self.local_vocabulary = {term: i for i, term in enumerate(terms.tolist())}
+        # Ordinal of each document id (without the ':class' suffix), used by exclude_ids
+        self.local_doc_ordinals = {doc_id.split(':')[0]: i
+                                   for i, doc_id in enumerate(self.local_doc_ids.tolist())}
+        n_docs = len(self.local_doc_ids)
+        avgdl = float(self.local_doc_len.mean()) if n_docs > 0 else 0.0
+        self.local_idf = np.log(
+            1.0 + (n_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+        self.local_doc_norm = (self.bm25_k1 * (
+            1.0 - self.bm25_b + self.bm25_b * self.local_doc_len / max(avgdl, 1e-9))
+        ).astype(np.float32)
+        # Largest normalized tf of each postings list, times the weight of the term
+        # it is the upper bound of the term score used by the MaxScore pruning
+        tf = self.local_postings_tf.astype(np.float32)
+        contributions = tf * (self.bm25_k1 + 1.0) / (tf + self.local_doc_norm[self.local_postings_docs])
+        self.local_term_max = np.zeros(len(df), dtype=np.float32)
+        if len(contributions) > 0:
+            self.local_term_max[df > 0] = np.maximum.reduceat(contributions, starts)
+        self.local_postings_ptr = postings_ptr
+
+    def local_delete(self, index_list):
+        '''
+        Deletes the local BM25 index files.
+
+        Parameters
+        ----------
+        index_list : list
+            String list of the index names.
+        '''
+        for index in index_list:
+            path = self.local_index_path(index)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def local_query_weight(self, qtf):
+        '''
+        Weight of a query term given its frequency in the query,
+        following the Okapi BM25 k3 formulation used by Zettair.
+        '''
+        return (self.bm25_k3 + 1.0) * qtf / (self.bm25_k3 + qtf)
+
+    def local_approximate(self):
+        '''
+        True if the local queries are truncated to their top weighted terms.
+        '''
+        return self.local_max_terms is not None or self.local_term_mass < 1.0
+
+    def local_query_terms(self, query):
+        '''
+        Tokenizes the query (prepare_query, if compact_queries), returns the arrays of its
+        term ids in the local vocabulary and of their frequencies in the query,
+        in order of first occurrence.
+        If local_approximate(), only the terms with the largest score upper bounds
+        are kept, as set by local_max_terms and local_term_mass.
+        '''
+        term_ids = []
+        query_tf = []
+        if self.compact_queries:
+            terms = self.prepare_query(query)
+        else:
+            terms = Counter(tokenize_text(query)).items()
+        for term, qtf in terms:
+            term_id = self.local_vocabulary.get(term)
+            if term_id is not None:
+                term_ids.append(term_id)
+                query_tf.append(qtf)
+        term_ids = np.array(term_ids, dtype=np.int64)
+        query_tf = np.array(query_tf, dtype=np.float64)
+        if not self.local_approximate() or len(term_ids) == 0:
+            return term_ids, query_tf
+
+        bounds = self.local_term_bounds(term_ids, query_tf)
+        order = np.argsort(-bounds, kind='stable')
+        keep = len(order)
+        if self.local_max_terms is not None:
+            keep = min(keep, max(int(self.local_max_terms), 1))
+        if self.local_term_mass < 1.0:
+            mass = np.cumsum(bounds[order])
+            keep = min(keep, int(np.searchsorted(mass, self.local_term_mass * mass[-1])) + 1)
+        kept = np.sort(order[:keep])
+        return term_ids[kept], query_tf[kept]
+
+    def local_term_bounds(self, term_ids, query_tf):
+        '''
+        Upper bounds of the score that each query term can add to a document.
+        '''
+        return self.local_query_weight(query_tf) * self.local_idf[term_ids] * self.local_term_max[term_ids]
+
+    def local_term_scores(self, term_id, qtf, docs, tf):
+        '''
+        BM25 score added by the query term to each of the documents docs,
+        whose frequencies of the term are tf.
+        '''
+        weight = np.float32(self.local_query_weight(qtf) * self.local_idf[term_id])
+        return weight * tf * (self.bm25_k1 + 1.0) / (tf + self.local_doc_norm[docs])
+
+    def local_score(self, query):
+        '''
+        Scores every document of the local index against the query,
+        returns an array with one BM25 score per document ordinal.
+
+        Parameters
+        ----------
+        query : str
+            Text to be queried to the index using BM25 metric.
+        '''
+        if self.local_postings_ptr is None:
+            self.local_load()
+        scores = np.zeros(len(self.local_doc_ids), dtype=np.float32)
+        for term_id, qtf in zip(*self.local_query_terms(query)):
+            start = self.local_postings_ptr[term_id]
+            end = self.local_postings_ptr[term_id + 1]
+            docs = self.local_postings_docs[start:end]
+            tf = self.local_postings_tf[start:end].astype(np.float32)
+            # Documents are unique inside a postings list, so fancy indexing is safe
+            scores[docs] += self.local_term_scores(term_id, qtf, docs, tf)
+        return scores
+
+    def local_top_k(self, scores, n_results):
+        '''
+        Selects the ordinals of the best scored (matching) documents,
+        sorted by decreasing score, ties are broken by the lowest ordinal.
+        '''
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > n_results:
+            # Every document tied with the last selected score is kept until the sort,
+            # so the selected documents do not depend on the number of results
+            threshold = -np.partition(-scores[candidates], n_results - 1)[n_results - 1]
+            candidates = candidates[scores[candidates] >= threshold]
+        return candidates[np.lexsort((candidates, -scores[candidates]))][:n_results]
+
+    def local_score_many(self, queries, chunk_size=16):
+        '''
+        Scores every document of the local index against many queries in one pass,
+        yields the array with one BM25 score per document ordinal of each query, in order.
+        The postings of each distinct term are read and normalized once, however many
+        queries contain it, and the scores of each chunk of queries are the product
+        of their term weights by the sparse matrix of normalized postings.
+
+        Parameters
+        ----------
+        queries : list
+            Texts to be queried to the index using BM25 metric.
+
+        chunk_size : int
+            Number of queries scored by each product, each one needs a
+            (chunk_size, n_documents) array.
+        '''
+        if self.local_postings_ptr is None:
+            self.local_load()
+        query_rows = []
+        query_terms = []
+        query_tf = []
+        for row, query in enumerate(queries):
+            term_ids, qtf = self.local_query_terms(query)
+            query_rows.append(np.full(len(term_ids), row, dtype=np.int64))
+            query_terms.append(term_ids)
+            query_tf.append(qtf)
+        if len(queries) == 0:
+            return iter(())
+        return self.local_score_terms(np.concatenate(query_rows),
+                                      np.concatenate(query_terms),
+                                      np.concatenate(query_tf).astype(np.float32),
+                                      len(queries), chunk_size)
+
+    def local_score_terms(self, query_rows, query_terms, query_tf, n_queries, chunk_size=16):
+        '''
+        Multi-query scorer of local_score_many, with the queries already given in COO form:
+        the query query_rows[i] contains the term query_terms[i] query_tf[i] times.
+        Yields the array with one BM25 score per document ordinal of each query, in order.
+        '''
+        # SciPy is only needed by the multi-query scorer
+        from scipy import sparse
+        if self.local_postings_ptr is None:
+            self.local_load()
+        term_ids, query_columns = np.unique(query_terms, return_inverse=True)
+        query_weights = (self.local_query_weight(query_tf)
+                         * self.local_idf[query_terms]).astype(np.float32)
+
+        starts = self.local_postings_ptr[term_ids]
+        lengths = self.local_postings_ptr[term_ids + 1] - starts
+        offsets = np.cumsum(lengths) - lengths
+        positions = np.arange(lengths.sum(), dtype=np.int64) + np.repeat(starts - offsets, lengths)
+        docs = self.local_postings_docs[positions]
+        tf = self.local_postings_tf[positions].astype(np.float32)
+        k1 = self.bm25_k1
+        postings = sparse.csr_matrix(
+            (tf * (k1 + 1.0) / (tf + self.local_doc_norm[docs]), docs,
+             np.concatenate(([0], np.cumsum(lengths)))),
+            shape=(len(term_ids), len(self.local_doc_ids)))
+        weights = sparse.csr_matrix(
+            (query_weights, (query_rows, query_columns)),
+            shape=(n_queries, len(term_ids)))
+        for i in range(0, n_queries, chunk_size):
+            # Dense weights times sparse postings gives dense scores, without sorting indices
+            for scores in np.asarray(weights[i:i + chunk_size].toarray() @ postings,
+                                     dtype=np.float32):
+                yield scores
+
+    def local_query_many(self, queries, ignore_first_result=False, as_arrays=False,
+                         exclude_ids=None):
+        '''
+        Query the local BM25 index with a list of queries scored by local_score_many,
+        returns a list with one Pandas DataFrame (or QueryResult, if as_arrays) per query.
+
+        Parameters
+        ----------
+        queries : list
+            Texts to be queried to the index using BM25 metric.
+
+        exclude_ids : list
+            Ids of the documents left out of the ranking of each query.
+        '''
+        queries = list(queries)
+        exclude_ids = self.batch_exclusion_keys(queries, exclude_ids)
+        nResults = int(self.numberResults)
+        if ignore_first_result:
+            nResults += 1
+        results = []
+        for scores, exclude in zip(self.local_score_many(queries), exclude_ids):
+            excluded = [self.local_doc_ordinals[doc_id] for doc_id in exclude
+                        if doc_id in self.local_doc_ordinals]
+            scores[excluded] = 0.0
+            top = self.local_top_k(scores, nResults)
+            if ignore_first_result:
+                top = top[1:]
+            results.append(self.local_result(scores[top], top, as_arrays))
+        return results
+
+    def local_result(self, scores, ordinals, as_arrays=False):
+        '''
+        Builds the result of a query from the scores and ordinals of the selected documents.
+        '''
+        if as_arrays:
+            return self.make_query_result(scores, self.local_doc_ids[ordinals],
+                                          self.local_class_names[self.local_doc_class[ordinals]])
+
+        item_list = [[float(score), doc_id, cl] for score, doc_id, cl in zip(
+            scores, self.local_doc_ids[ordinals],
+            self.local_class_names[self.local_doc_class[ordinals]])]
+        return pd.DataFrame(item_list, columns=['score', 'id', 'class'])
+
+    def local_postings_find(self, term_ids, ordinals):
+        '''
+        Binary search of the documents ordinals (ascending) in the postings of each term,
+        vectorized over every (term, document) pair. Returns the (len(term_ids), len(ordinals))
+        arrays of the postings positions and of whether the document is found there.
+        '''
+        starts = self.local_postings_ptr[term_ids][:, None]
+        ends = self.local_postings_ptr[term_ids + 1][:, None]
+        low = np.repeat(starts, len(ordinals), axis=1)
+        high = np.repeat(ends, len(ordinals), axis=1)
+        last = max(len(self.local_postings_docs) - 1, 0)
+        active = low < high
+        while active.any():
+            middle = (low + high) // 2
+            before = active & (self.local_postings_docs[np.minimum(middle, last)] < ordinals)
+            low = np.where(before, middle + 1, low)
+            high = np.where(active & ~before, middle, high)
+            active = low < high
+        positions = np.minimum(low, last)
+        found = (low < ends) & (self.local_postings_docs[positions] == ordinals)
+        return positions, found
+
+    def local_maxscore(self, query, n_results, excluded=(), block_size=16):
+        '''
+        Selects the ordinals of the n_results best scored documents like
+        local_top_k(local_score(query), n_results), with MaxScore dynamic pruning:
+        the terms are scored by decreasing score upper bound, whole postings first, and
+        once the n_results-th best partial score exceeds the upper bound of the remaining
+        terms only the documents that can still reach it are looked up in their postings.
+        Returns the ordinals and their scores.
+
+        Parameters
+        ----------
+        query : str
+            Text to be queried to the index using BM25 metric.
+
+        n_results : int
+            Number of documents selected.
+
+        excluded : list
+            Ordinals of the documents left out of the ranking.
+
+        block_size : int
+            Largest number of terms scored between two updates of the threshold.
+        '''
+        if self.local_postings_ptr is None:
+            self.local_load()
+        query_terms, query_tf = self.local_query_terms(query)
+        weights = (self.local_query_weight(query_tf) * self.local_idf[query_terms]).astype(np.float32)
+        bounds = self.local_term_bounds(query_terms, query_tf)
+        order = np.argsort(-bounds, kind='stable')
+        # rest[i] is the largest score the terms order[i:] can add to a document,
+        # with some slack for the float32 rounding of the accumulated scores
+        rest = np.append(np.cumsum(bounds[order][::-1])[::-1], 0.0) * (1.0 + 1e-4) + 1e-6
+        k1 = self.bm25_k1
+
+        def kth_score(values):
+            if len(values) < n_results:
+                return 0.0
+            return float(np.partition(values, len(values) - n_results)[len(values) - n_results])
+
+        def lookup(terms, ordinals):
+            # Scores added by each of the terms (rows) to each of the documents (columns)
+            positions, found = self.local_postings_find(query_terms[terms], ordinals)
+            tf = np.where(found, self.local_postings_tf[positions], 0).astype(np.float32)
+            return (weights[terms][:, None] * tf * (k1 + 1.0)
+                    / (tf + self.local_doc_norm[ordinals])).astype(np.float32)
+
+        def add_term(term, ordinals):
+            # Scores the documents of the term postings, by binary search when the
+            # documents are few compared to the postings, otherwise the whole postings
+            start = self.local_postings_ptr[query_terms[term]]
+            docs = self.local_postings_docs[start:self.local_postings_ptr[query_terms[term] + 1]]
+            if len(ordinals) * 16 > len(docs):
+                tf = self.local_postings_tf[start:start + len(docs)].astype(np.float32)
+                scores[docs] += weights[term] * tf * (k1 + 1.0) / (tf + self.local_doc_norm[docs])
+                return
+            positions = np.searchsorted(docs, ordinals)
+            found = positions < len(docs)
+            found[found] = docs[positions[found]] == ordinals[found]
+            tf = self.local_postings_tf[start + positions[found]].astype(np.float32)
+            scores[ordinals[found]] += (weights[term] * tf * (k1 + 1.0)
+                                        / (tf + self.local_doc_norm[ordinals[found]]))
+
+        n_docs = len(self.local_doc_ids)
+        allowed = np.ones(n_docs, dtype=bool)
+        allowed[np.asarray(excluded, dtype=np.int64)] = False
+        scores = np.zeros(n_docs, dtype=np.float32)
+        threshold = 0.0
+        i = 0
+        block = 4
+        # Essential terms: their whole postings are scored, any document can still be selected
+        while i < len(order) and (threshold <= 0.0 or rest[i] >= threshold):
+            terms = query_terms[order[i:i + block]]
+            starts = self.local_postings_ptr[terms]
+            lengths = self.local_postings_ptr[terms + 1] - starts
+            offsets = np.cumsum(lengths) - lengths
+            positions = np.arange(lengths.sum(), dtype=np.int64) + np.repeat(starts - offsets, lengths)
+            docs = self.local_postings_docs[positions]
+            tf = self.local_postings_tf[positions].astype(np.float32)
+            scores += np.bincount(docs, np.repeat(weights[order[i:i + block]], lengths)
+                                  * tf * (k1 + 1.0) / (tf + self.local_doc_norm[docs]),
+                                  minlength=n_docs).astype(np.float32)
+            candidates = np.flatnonzero((scores > 0) & allowed)
+            threshold = kth_score(scores[candidates])
+            i += block
+            block = min(2 * block, block_size)
+        i = min(i, len(order))
+        candidates = np.flatnonzero((scores > 0) & allowed)
+
+        # Non-essential terms: only the candidates that can still reach the threshold
+        while i < len(order) and len(candidates) > n_results:
+            candidates = candidates[scores[candidates] + rest[i] >= threshold]
+            add_term(order[i], candidates)
+            threshold = max(threshold, kth_score(scores[candidates]))
+            i += 1
+        if len(candidates) > n_results:
+            threshold = kth_score(scores[candidates])
+            candidates = candidates[scores[candidates] + rest[min(i, len(order))] >= threshold]
+
+        # The scores of the survivors are summed again in query order, so the selection
+        # and its ties are the same as the ones of local_score
+        exact = np.zeros(len(candidates), dtype=np.float32)
+        for term_scores in lookup(np.arange(len(query_terms)), candidates):
+            exact += term_scores
+        top = self.local_top_k(exact, n_results)
+        return candidates[top], exact[top]
+
+    def local_query(self, query, ignore_first_result=False, as_arrays=False, exclude_ids=None):
+        '''
+        Query the local BM25 index, returns a Pandas DataFrame with the results.
+
+        Parameters
+        ----------
+        query : str
+            Text to be queried to the index using BM25 metric.
+
+        as_arrays : bool
+            Return a QueryResult instead of a Pandas DataFrame.
+
+        exclude_ids : list
+            Ids of the documents left out of the ranking (e.g. the queried document).
+        '''
+        nResults = int(self.numberResults)
+        if ignore_first_result:
+            nResults += 1
+        if self.local_postings_ptr is None:
+            self.local_load()
+        excluded = [self.local_doc_ordinals[doc_id] for doc_id in self.exclusion_keys(exclude_ids)
+                    if doc_id in self.local_doc_ordinals]
+        if self.local_pruning:
+            top, top_scores = self.local_maxscore(query, nResults, excluded)
+        else:
+            scores = self.local_score(query)
+            # local_top_k only selects the documents with a positive score
+            scores[excluded] = 0.0
+            top = self.local_top_k(scores, nResults)
+            top_scores = scores[top]
+        if ignore_first_result:
+            top = top[1:]
+            top_scores = top_scores[1:]
+        return self.local_result(top_scores, top, as_arrays)
+
+    def local_get_IR_variables(self, query, positive_class='true', ignore_first_result=False,
+                               exclude_ids=None):
+        '''
+        Query the local BM25 index, returns a dict with the IR variables.
+
+        Parameters
+        ----------
+        query : str
+            Text to be queried to the index using BM25 metric.
+
+        exclude_ids : list
+            Ids of the documents left out of the ranking (e.g. the queried document).
+        '''
+        result_df = self.cached_query(
+            'local', query, ignore_first_result,
+            lambda: self.local_query(query, ignore_first_result=ignore_first_result,
+                                     as_arrays=True, exclude_ids=exclude_ids),
+            as_arrays=True, exclude_ids=exclude_ids)
+
+        return self.calc_IR(result_df=result_df, positive_class=positive_class)
+
+    def neighbours_path(self, index_name=None):
+        '''
+        Returns the path of the neighbour table of an index, its metadata
+        is stored in the same path with the '.json' extension.
+        '''
+        if index_name is None:
+            index_name = self.indexName
+        return self.root_path + str(index_name) + '.neighbours.npy'
+
+    def local_neighbours(self, k=100, block_size=1024, chunk_size=16, exclude_self=True):
+        '''
+        Queries every document of the local index against the index itself, with the
+        document terms as the query, in blocks of block_size documents scored by
+        local_score_terms. Yields the first ordinal of each block and two arrays
+        (block_size, k): the ordinals of the k best scored documents (-1 padded)
+        and their scores (NaN padded).
+
+        Parameters
+        ----------
+        k : int
+            Number of neighbours of each document.
+
+        exclude_self : bool
+            Leave each document out of its own neighbours.
+        '''
+        if self.local_postings_ptr is None:
+            self.local_load()
+        n_docs = len(self.local_doc_ids)
+        df = np.diff(self.local_postings_ptr)
+        # The postings sorted by document are the term frequencies of each document
+        order = np.argsort(self.local_postings_docs, kind='stable')
+        doc_terms = np.repeat(np.arange(len(df), dtype=np.int64), df)[order]
+        doc_tf = self.local_postings_tf[order].astype(np.float32)
+        doc_ptr = np.zeros(n_docs + 1, dtype=np.int64)
+        doc_ptr[1:] = np.cumsum(np.bincount(self.local_postings_docs, minlength=n_docs))
+
+        for first in range(0, n_docs, block_size):
+            last = min(first + block_size, n_docs)
+            block = slice(doc_ptr[first], doc_ptr[last])
+            rows = np.repeat(np.arange(last - first, dtype=np.int64),
+                             np.diff(doc_ptr[first:last + 1]))
+            neighbours = np.full((last - first, k), -1, dtype=np.int32)
+            neighbour_scores = np.full((last - first, k), np.nan, dtype=np.float32)
+            for row, scores in enumerate(self.local_score_terms(
+                    rows, doc_terms[block], doc_tf[block], last - first, chunk_size)):
+                if exclude_self:
+                    scores[first + row] = 0.0
+                top = self.local_top_k(scores, k)
+                neighbours[row, :len(top)] = top
+                neighbour_scores[row, :len(top)] = scores[top]
+            yield first, neighbours, neighbour_scores
+
+    def local_save_neighbours(self, k=100, block_size=1024, exclude_self=True):
+        '''
+        Computes the top k neighbours of every document of the local index (see local_neighbours)
+        and stores them in a NumPy file that is read memory-mapped by neighbours_load.
+        Each row of the table is a document: its id, its class code and the
+        ordinals and scores of its neighbours.
+
+        Parameters
+        ----------
+        k : int
+            Number of neighbours of each document, the largest top_k that can be read.
+
+        exclude_self : bool
+            Leave each document out of its own neighbours, as ignore_first_result intends.
+        '''
+        if self.local_postings_ptr is None:
+            self.local_load()
+        path = self.neighbours_path()
+        dtype = np.dtype([('id', self.local_doc_ids.dtype), ('class', np.int16),
+                          ('neighbours', np.int32, (k,)), ('scores', np.float32, (k,))])
+        table = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=dtype,
+                                          shape=(len(self.local_doc_ids),))
+        table['id'] = self.local_doc_ids
+        table['class'] = self.local_doc_class
+        for first, neighbours, scores in self.local_neighbours(k, block_size,
+                                                               exclude_self=exclude_self):
+            table['neighbours'][first:first + len(neighbours)] = neighbours
+            table['scores'][first:first + len(scores)] = scores
+        table.flush()
+        del table
+        os.replace(path + '.tmp', path)
+
+        with open(path + '.json', 'w') as f:
+            json.dump({'k': int(k), 'exclude_self': bool(exclude_self),
+                       'class_names': self.local_class_names.tolist(),
+                       'bm25_k1': self.bm25_k1, 'bm25_b': self.bm25_b,
+                       'bm25_k3': self.bm25_k3}, f)
+        self.neighbours_table = None
+
+    def neighbours_load(self):
+        '''
+        Opens the neighbour table of the index memory-mapped, only the rows
+        that are read are loaded from the disk.
+        '''
+        path = self.neighbours_path()
+        self.neighbours_table = np.load(path, mmap_mode='r')
+        with open(path + '.json', 'r') as f:
+            self.neighbours_meta = json.load(f)
+        self.neighbours_ordinals = {doc_id.split(':')[0]: i for i, doc_id
+                                    in enumerate(self.neighbours_table['id'].tolist())}
+
+    def neighbours_get_IR_variables(self, doc_ids, positive_class='true', top_k=None,
+                                    class_names=None):
+        '''
+        Reads the IR variables of indexed documents from the neighbour table, as if each
+        document was queried against the index with top_k results, without running any query.
+        Returns a NumPy array with the IR variables of each document, with the same columns
+        as get_IR_variables_batch.
+
+        Parameters
+        ----------
+        doc_ids : list
+            Ids of the documents of the index.
+
+        positive_class : str
+            Specifies which 'class' is the positive class.
+
+        top_k : int
+            Number of neighbours used, defaults to the manager top_k,
+            must not be larger than the k of the table.
+
+        class_names : list
+            Classes used for the per class IR variables, e.g. ['bot', 'female', 'male'].
+        '''
+        if self.neighbours_table is None:
+            self.neighbours_load()
+        if top_k is None:
+            top_k = self.numberResults
+        if top_k > self.neighbours_meta['k']:
+            raise ValueError(f'The neighbour table of {self.indexName} has '
+                             + f'{self.neighbours_meta["k"]} neighbours, {top_k} requested')
+        rows = np.array([self.neighbours_ordinals[str(doc_id).split(':')[0]]
+                         for doc_id in doc_ids], dtype=np.int64)
+        records = self.neighbours_table[rows]
+        neighbours = records['neighbours'][:, :top_k]
+        scores = records['scores'][:, :top_k].astype(np.float64)
+        codes = np.where(neighbours >= 0,
+                         self.neighbours_table['class'][np.maximum(neighbours, 0)], -1)
+
+        table_classes = self.neighbours_meta['class_names']
+        if class_names is None:
+            class_index = np.array([int(cl == str(positive_class)) for cl in table_classes]
+                                   + [-1], dtype=np.int64)
+            return self.calc_IR_per_class(scores, class_index[codes], 2).reshape(len(rows), 6)
+        class_names = [str(cl) for cl in class_names]
+        class_index = np.array([class_names.index(cl) if cl in class_names else -1
+                                for cl in table_classes] + [-1], dtype=np.int64)
+        return self.calc_IR_per_class(scores, class_index[codes], len(class_names)
+                                      ).reshape(len(rows), 3 * len(class_names))
+
 # bulkBody = testTool.bulkInsertGeneratorElastic([{'id':'23232', 'text': 'hueheuheu'}, {'id':'12345678', 'text': 'hmmmmmm'}])
 
 # print(bulkBody)
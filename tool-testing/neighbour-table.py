@@ -0,0 +1,84 @@
+from indextoolmanager import IndexToolManager
+import os
+import time
+import datetime
+import logging
+
+variable_name = 'NEIGHBOUR_TABLE'
+datestr = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S',
+                    filename=f'logs/{datestr}-{variable_name}_debug.log',
+                    filemode='w')
+console = logging.StreamHandler()
+console.setLevel(logging.INFO)
+formatter = logging.Formatter('%(name)-12s: %(levelname)-8s %(message)s')
+console.setFormatter(formatter)
+logging.getLogger(variable_name).addHandler(console)
+
+mylogger = logging.getLogger(variable_name)
+handler1 = logging.FileHandler(f'logs/{datestr}-{variable_name}.log')
+handler1.setLevel(logging.INFO)
+formatter = logging.Formatter(
+    '%(asctime)s %(name)-12s %(levelname)-8s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+handler1.setFormatter(formatter)
+mylogger.addHandler(handler1)
+
+db_files = {
+    'authorprof': {
+        'xml_folder': 'db_authorprof/pan18-author-profiling-training-2018-02-27/en/text/',
+        'truth_txt': 'db_authorprof/pan18-author-profiling-training-2018-02-27/en/en.txt'
+    },
+    'botgender': {
+        'xml_folder': 'db_botgender/pan19-author-profiling-training-2019-02-18/en/text/',
+        'truth_txt': 'db_botgender/pan19-author-profiling-training-2019-02-18/en/truth.txt'
+    },
+    'hyperpartisan_split_42': {
+        'xml_folder': 'db_hyperpartisan/articles-training-byarticle-20181122.xml',
+        'truth_txt': 'db_hyperpartisan/ground-truth-training-byarticle-20181122.xml'
+    },
+}
+# Training corpora whose documents are also queries, the tables are built for their *_bulk indexes
+dbs = ['authorprof', 'hyperpartisan_split_42']
+# Neighbours stored per document, the largest ir_top_k the training scripts can read
+neighbours_k = 100
+# Documents scored by each block, each one needs a (16, n_documents) array of scores
+block_size = 1024
+
+
+def build_neighbour_table(db='authorprof', db_name='authorprof_bulk', k=100):
+    '''
+    Computes the top k BM25 neighbours of every document of the local index of db_name,
+    the local index is built first if it does not exist.
+    '''
+    mylogger.info(f'DB: {db}')
+    mylogger.info(f'DB NAME: {db_name}')
+    testTool = IndexToolManager(indexName=db_name)
+
+    if not os.path.exists(testTool.local_index_path()):
+        start = time.time()
+        testTool.local_index(testTool.iter_documents(db,
+                                                     db_files[db]['xml_folder'],
+                                                     db_files[db]['truth_txt']))
+        end = time.time()
+        mylogger.info(f'local_index {end - start}')
+
+    start = time.time()
+    testTool.local_save_neighbours(k=k, block_size=block_size)
+    end = time.time()
+    mylogger.info(f'local_save_neighbours {end - start}')
+    mylogger.info(f'TABLE {testTool.neighbours_path()}')
+
+
+def measure_NEIGHBOUR_TABLE():
+    mylogger.info('START OF NEIGHBOUR_TABLE')
+    mylogger.info(str(datetime.datetime.now()))
+    for db in dbs:
+        build_neighbour_table(db=db, db_name=str(db+'_bulk'), k=neighbours_k)
+    mylogger.info(str(datetime.datetime.now()))
+    mylogger.info('END OF NEIGHBOUR_TABLE')
+
+
+measure_NEIGHBOUR_TABLE()
@@ -70,6 +70,12 @@ db_files = {
 }
 dbs = ['authorprof', 'botgender', 'hyperpartisan', 'hyperpartisan_split_42']
 # dbs = []
+# Processes parsing the per-author XML files (authorprof and botgender), 1 parses them in the
+# main process like the previous runs, None uses all the cores
+parse_processes = 1
+# Write the content hash manifest of normal/bulk/stream indexations, so the index can be updated
+# later with the upsert type. The hashing is left out of TIME_INDEX and logged apart
+record_manifest = False
 authorprof_db_name = 'authorprof'
 botgender_db_name = 'botgender'
 hyperpartisan_db_name = 'hyperpartisan'
@@ -89,8 +95,18 @@ hyperpartisan_ground_truth_xml = 'db_hyperpartisan/ground-truth-training-byartic
 # hyperpartisan_articles_xml = 'db_hyperpartisan/articles.xml'
 # hyperpartisan_ground_truth_xml = 'db_hyperpartisan/ground_truth.xml'
 
+def count_documents(documents, counter):
+    '''
+    Passes the documents through, counting them in counter['documents'].
+    '''
+    for document in documents:
+        counter['documents'] += 1
+        yield document
+
+
 # DB_AUTHORPROF
-def index(idx_type='normal', db='authorprof', tool='arango', db_name='authorprof', exp_id='unamed'):
+def index(idx_type='normal', db='authorprof', tool='arango', db_name='authorprof', exp_id='unamed',
+          record_manifest=record_manifest):
     mylogger.info('')
     mylogger.info(f'INDEX TYPE: {idx_type}')
     mylogger.info(f'DB: {db}')
@@ -104,16 +120,56 @@ def index(idx_type='normal', db='authorprof', tool='arango', db_name='authorprof
     append_class_to_id = False
     if (tool == 'zettair'):
         append_class_to_id = True
-    bulk = testTool.get_documents(db,
-                                  db_files[db]['xml_folder'],
-                                  db_files[db]['truth_txt'],
-                                  append_class_to_id)
-    end = time.time()
-    mylogger.info(f'get_documents {end - start}')
-    mylogger.info(f'TOTAL documents {len(bulk)}')
+    # Content hashes of the documents, so the index can be updated with upsert_documents later
+    manifest = {}
+    timer = {'manifest': 0.0}
+    if (idx_type in ['stream', 'upsert']):
+        # The documents are parsed while they are indexed, without building the list
+        counter = {'documents': 0}
+        if (db in ['authorprof', 'botgender'] and parse_processes != 1):
+            documents = testTool.iter_documents_parallel(db,
+                                                         db_files[db]['xml_folder'],
+                                                         db_files[db]['truth_txt'],
+                                                         append_class_to_id,
+                                                         parse_processes)
+        else:
+            documents = testTool.iter_documents(db,
+                                                db_files[db]['xml_folder'],
+                                                db_files[db]['truth_txt'],
+                                                append_class_to_id)
+        if (idx_type == 'stream' and record_manifest):
+            documents = testTool.record_manifest(documents, manifest, timer)
+        bulk = count_documents(documents, counter)
+    else:
+        bulk = testTool.get_documents(db,
+                                      db_files[db]['xml_folder'],
+                                      db_files[db]['truth_txt'],
+                                      append_class_to_id,
+                                      processes=parse_processes)
+        end = time.time()
+        mylogger.info(f'get_documents {end - start}')
+        mylogger.info(f'TOTAL documents {len(bulk)}')
+        if record_manifest:
+            # Hashed before indexing, the normal elastic insert removes the ids of the documents
+            for _ in testTool.record_manifest(bulk, manifest, timer):
+                pass
 
     start = time.time()
-    if (tool == 'arango'):
+    if (idx_type == 'upsert'):
+        # Only the new, changed and removed documents are sent to the tool
+        stats = testTool.upsert_documents(bulk, tool, delete_missing=True)
+        end = time.time()
+        mylogger.info(f'upsert_documents {end - start}')
+        mylogger.info(f'upsert_documents added {stats["added"]} updated {stats["updated"]} '
+                      + f'deleted {stats["deleted"]} unchanged {stats["unchanged"]}')
+    elif (tool == 'arango' and idx_type == 'stream'):
+        stats = testTool.bulkImportArangoConcurrent(bulk)
+        end = time.time()
+        mylogger.info(f'bulkImportArangoConcurrent {end - start}')
+        mylogger.info(f'bulkImportArangoConcurrent documents {stats["documents"]} '
+                      + f'errors {stats["errors"]} batches {stats["batches"]} '
+                      + f'docs/sec {stats["docs_per_second"]:.1f}')
+    elif (tool == 'arango'):
         documentList = testTool.bulkListGeneratorArango(bulk)
         end = time.time()
         mylogger.info(f'bulkListGeneratorArango {end - start}')
@@ -129,7 +185,16 @@ def index(idx_type='normal', db='authorprof', tool='arango', db_name='authorprof
             end = time.time()
             mylogger.info(f'bulkImportArango {end - start}')
 
-    if (tool == 'elastic'):
+    if (tool == 'elastic' and idx_type != 'upsert'):
+        if (idx_type == 'stream'):
+            start = time.time()
+            stats = testTool.bulkStreamElastic(bulk)
+            end = time.time()
+            mylogger.info(f'bulkStreamElastic {end - start}')
+            mylogger.info(f'bulkStreamElastic documents {stats["documents"]} '
+                          + f'errors {stats["errors"]} '
+                          + f'docs/sec {stats["docs_per_second"]:.1f}')
+
         if (idx_type == 'normal'):
             start = time.time()
             for doc in bulk:
@@ -153,7 +218,7 @@ def index(idx_type='normal', db='authorprof', tool='arango', db_name='authorprof
         end = time.time()
         mylogger.info(f'refreshElastic {end - start}')
 
-    if (tool == 'zettair'):
+    if (tool == 'zettair' and idx_type != 'upsert'):
         start = time.time()
         testTool.saveToTrecFileZettair(bulk)
         end = time.time()
@@ -164,7 +229,21 @@ def index(idx_type='normal', db='authorprof', tool='arango', db_name='authorprof
         end = time.time()
         mylogger.info(f'zettair_index {end - start}')
 
+    if (tool == 'local' and idx_type != 'upsert'):
+        start = time.time()
+        testTool.local_index(bulk)
+        end = time.time()
+        mylogger.info(f'local_index {end - start}')
+
+    if (idx_type in ['stream', 'upsert']):
+        mylogger.info(f'TOTAL documents {counter["documents"]}')
+
     final = time.time()
+    if (record_manifest and idx_type != 'upsert'):
+        start = time.time()
+        testTool.save_manifest(tool, manifest)
+        end = time.time()
+        mylogger.info(f'record_manifest {timer["manifest"] + end - start}')
     result_id = datetime.datetime.now().strftime("%Y%m%d-%H%M%S.%f")
     testTool.log_result(result_id, {
         'exp_id': exp_id,
@@ -173,9 +252,9 @@ def index(idx_type='normal', db='authorprof', tool='arango', db_name='authorprof
         'db': db,
         'tool': tool,
         'db_name': db_name,
-        'value': str((final - initial)),
+        'value': str((final - initial - timer['manifest'])),
     })
-    mylogger.info(f'index TOTAL TIME: {final - initial}')
+    mylogger.info(f'index TOTAL TIME: {final - initial - timer["manifest"]}')
 
 
 def index_DB_AUTHORPROF_TOOL_ARANGO():
@@ -679,7 +758,7 @@ def measure_TIME_INDEX_old():
     mylogger.info('END OF TIME_INDEX MEASUREMENTS')
 
 
-def measure_TIME_INDEX(normal=False, clean=False):
+def measure_TIME_INDEX(normal=False, clean=False, stream=False, upsert=False):
     mylogger.info('START OF TIME_INDEX MEASUREMENTS')
     exp_id = str(datetime.datetime.now())
     mylogger.info(exp_id)
@@ -693,7 +772,7 @@ def measure_TIME_INDEX(normal=False, clean=False):
         final = time.time()
         mylogger.info(f'CLEANING FINISHED: {final - initial}')
 
-    tools = ['arango', 'elastic', 'zettair']
+    tools = ['arango', 'elastic', 'zettair', 'local']
     # tools = ['zettair']
     dbs = ['authorprof', 'botgender', 'hyperpartisan', 'hyperpartisan_split_42']
     dbs = ['authorprof', 'hyperpartisan', 'hyperpartisan_split_42']
@@ -703,10 +782,17 @@ def measure_TIME_INDEX(normal=False, clean=False):
         mylogger.info('')
         mylogger.info('DB_' + db)
         for tool in tools:
-            if (normal and tool != 'zettair'):
+            if (normal and tool not in ['zettair', 'local']):
                 index(idx_type='normal', db=db, tool=tool,
                       db_name=db, exp_id=exp_id)
-            index(idx_type='bulk', db=db, tool=tool,
+            # The stream type builds the same *_bulk indexes, parsing while indexing,
+            # the upsert type only updates them with the documents that changed
+            bulk_type = 'bulk'
+            if (upsert):
+                bulk_type = 'upsert'
+            elif (stream):
+                bulk_type = 'stream'
+            index(idx_type=bulk_type, db=db, tool=tool,
                   db_name=str(db+'_bulk'), exp_id=exp_id)
 
     mylogger.info(str(datetime.datetime.now()))